@@ -1,10 +1,11 @@
 from flask import Flask, jsonify, request
-from db.create_tables import create_tables, check_and_add_media, check_and_add_reviews, check_and_add_creators
+from db.create_tables import create_tables
 from db.users import add_user, get_user, update_user_password
 import os
 import jwt
 import datetime
 import hashlib
+import math
 import string
 import random
 from threading import Timer, Thread
@@ -14,7 +15,15 @@ import requests
 from db.media import get_user_media_page
 
 from db.media import get_all_genres, get_media_by_tconst
-from recommendation.knn_recommendation import train_knns, delete_cache, recommend_media
+from recommendation.knn_recommendation import train_knns, update_knns, delete_cache, recommend_media, recommend_popular_media, refresh_popular_media
+from recommendation.room_deck import RoomDeck
+from recommendation.recommendation_cache import recommendation_cache, invalidate_user
+from recommendation.item_cf import record_rating
+from db.user_recommendations import delete_user_recommendation
+from recommendation.executor import get_recommendation_executor, start_recommendation_executor
+from recommendation.model_state import get_model_state
+import startup
+from ingestion import ingest_imdb, refresh_ratings
 from db.user_preferences import add_and_update_user_preference, get_user_preferences, delete_user_preference
 
 rooms = {} #List of rooms that users can interact with
@@ -23,6 +32,8 @@ app = Flask(__name__)
 SECRET_KEY = os.getenv("SECRET_KEY")
 K_RECOMMENDATION = int(os.getenv("K_RECOMMENDATION", 50))
 API_KEY = os.getenv("IMDB_API_KEY")
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 200)) #Largest list a client can ask for in one request
+RATINGS_REFRESH_SECONDS = float(os.getenv("RATINGS_REFRESH_SECONDS", 24 * 60 * 60)) #0 disables the periodic ratings refresh
 socketio = SocketIO(app, cors_allowed_origins="*") #creating socketio instance with CORS allowed for all origins
 CORS(app, resources={r"/*": {"origins": "*"}}) #Enable CORS for all routes
 
@@ -90,6 +101,52 @@ def verify_jwt(token):
     except jwt.InvalidTokenError:
         return None
 
+def parse_catalog_predicates(data):
+    """
+    Optional catalog filters of a request body. Returns (predicates, None)
+    or (None, error message) when a value has the wrong type.
+    """
+    include_adult = data.get('include_adult', True)
+    if isinstance(include_adult, str) and include_adult.lower() in ("true", "false"):
+        include_adult = include_adult.lower() == "true"
+    if not isinstance(include_adult, bool):
+        return None, "include_adult must be true or false"
+
+    title_types = data.get('title_types')
+    if title_types is not None and (not isinstance(title_types, list)
+                                    or not all(isinstance(title_type, str) for title_type in title_types)):
+        return None, "title_types must be a list of strings"
+
+    min_rating = data.get('min_rating')
+    if min_rating is not None:
+        try:
+            # JSON booleans would pass float() as 0 and 1
+            min_rating = None if isinstance(min_rating, bool) else float(min_rating)
+        except (TypeError, ValueError):
+            min_rating = None
+        if min_rating is None or not math.isfinite(min_rating):
+            return None, "min_rating must be a number"
+
+    return {"include_adult": include_adult, "title_types": title_types, "min_rating": min_rating}, None
+
+def parse_int_arg(value, name, default, minimum, maximum=None):
+    """
+    Integer argument of a request (JSON number or query string value).
+    Returns (value, None), clamped to maximum, or (None, error message).
+    """
+    if value is None:
+        return default, None
+    # JSON booleans would pass int() as 0 and 1
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        return None, f"{name} must be an integer"
+    try:
+        value = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None, f"{name} must be an integer"
+    if value < minimum:
+        return None, f"{name} must be at least {minimum}"
+    return (value if maximum is None else min(value, maximum)), None
+
 def generate_jwt(email):
     #getting user
     user = get_user(email)
@@ -121,6 +178,22 @@ def get_media_info(tconst):
 def hello_world():
     return jsonify({"message": "Hello, World!"})
 
+#Liveness, always answers while the process runs
+@app.route('/health', methods=['GET'])
+def health():
+    status = startup.get_status()
+    status["recommendation_cache"] = recommendation_cache.stats()
+    executor = get_recommendation_executor()
+    if executor is not None:
+        status["recommendation_executor"] = executor.stats()
+    return jsonify(status), 200
+
+#Readiness, 503 until ingestion and training are done
+@app.route('/ready', methods=['GET'])
+def ready():
+    status = startup.get_status()
+    return jsonify(status), 200 if status["ready"] else 503
+
 #Register
 @app.route('/auth/register', methods=['POST'])
 def register():
@@ -212,6 +285,16 @@ def get_index_media():
 
     return jsonify(media_page), 200
 
+#Get most popular media, optionally for one genre
+@app.route('/media/popular', methods=['GET'])
+def get_popular_media():
+    k, error = parse_int_arg(request.args.get('k'), "k", 10, 1, MAX_PAGE_SIZE)
+    if error is not None:
+        return jsonify({"message": error}), 400
+    genre = request.args.get('genre', None)
+    media, _ = recommend_popular_media(k, genre)
+    return jsonify({"media": media}), 200
+
 #Get user data
 @app.route('/user_data', methods=['POST'])
 def get_user_data():
@@ -236,6 +319,16 @@ def get_user_data():
 
     return jsonify({"email": email}), 200
 
+#Drops what was derived from the user's ratings once a rating change is committed,
+#a failure here is logged and never turns the committed write into an error
+def preference_changed(user_id, tconst, rating=None):
+    try:
+        invalidate_user(user_id)
+        delete_user_recommendation(user_id)
+        record_rating(user_id, tconst, rating)
+    except Exception as e:
+        print(f"Error refreshing recommendations of user {user_id}: {e}")
+
 #Add preferences
 @app.route('/preferences/add', methods=['POST'])
 def add_preference():
@@ -263,6 +356,7 @@ def add_preference():
     res = add_and_update_user_preference(user_id, tconst, rating)
     
     if res:
+        preference_changed(user_id, tconst, rating)
         return jsonify({"message": "Preference added"}), 200
     else:
         return jsonify({"message": "Error adding preference"}), 500
@@ -291,6 +385,7 @@ def delete_preference():
     res = delete_user_preference(user_id, tconst)
     
     if res:
+        preference_changed(user_id, tconst)
         return jsonify({"message": "Preference deleted"}), 200
     else:
         return jsonify({"message": "Error deleting preference"}), 500
@@ -344,7 +439,7 @@ def create_room():
         "creator": user_id,
         "members": [],
         "active": False,
-        "recommended_media": [],
+        "deck": None,
         "liked_media": {},
         "created_at": datetime.datetime.now(),
     }
@@ -401,7 +496,12 @@ def get_recommendations():
     if not user_id:
         return jsonify({"message": "User not found"}), 404
 
-    recommendations = create_recommendation_for_member(user_id)
+    #Optional catalog filters
+    predicates, error = parse_catalog_predicates(data)
+    if error:
+        return jsonify({"message": error}), 400
+
+    recommendations = create_recommendation_for_member(user_id, **predicates)
 
     return jsonify({"recommendations": recommendations}), 200
 
@@ -441,8 +541,8 @@ def handle_start(data):
 
     if room_id in rooms and user_id == rooms[room_id]["creator"] and not rooms[room_id]["active"]:
         rooms[room_id]["active"] = True
-        recommendations = create_recommendation_list(rooms[room_id]["members"])
-        rooms[room_id]["recommended_media"] = recommendations
+        #Only the first page is computed now, the deck grows as members swipe
+        rooms[room_id]["deck"] = RoomDeck(rooms[room_id]["members"], data.get('strategy'))
         emit('message-started', {'message': 'Room has started'}, room=room_id)
         print('Room has started: {room_id}')
 
@@ -495,10 +595,22 @@ def get_room_recommendations():
     if room_id not in rooms or user_id not in rooms[room_id]["members"]:
         return jsonify({"message": "Room does not exist or user is not in the room"}), 400
 
-    if not rooms[room_id]["active"]:
+    if not rooms[room_id]["active"] or rooms[room_id]["deck"] is None:
         return jsonify({"message": "Room is not active yet"}), 400
 
-    return jsonify({"recommended_media": rooms[room_id]["recommended_media"]}), 200
+    #Paginated with offset/limit, without them the first K_RECOMMENDATION media as before
+    offset, error = parse_int_arg(data.get('offset'), "offset", 0, 0)
+    if error is None:
+        limit, error = parse_int_arg(data.get('limit'), "limit", K_RECOMMENDATION, 1, MAX_PAGE_SIZE)
+    if error is not None:
+        return jsonify({"message": error}), 400
+    media, has_more = rooms[room_id]["deck"].page(offset, limit)
+    return jsonify({
+        "recommended_media": media,
+        "offset": offset,
+        "next_offset": offset + len(media),
+        "has_more": has_more,
+    }), 200
 
 #Get media details
 @app.route('/media/<tconst>', methods=['POST'])
@@ -538,33 +650,12 @@ def get_media_for_user(tconst):
     }
     return jsonify({"media": media_data}), 200
 
-#Create recommendation list for room based on member without duplicates
-def create_recommendation_list(members):
-    recommendation_list_per_member = [
-        create_recommendation_for_member(member) for member in members
-    ]
-    seen = set()
-    recommendation_list = []
-    for sublist in recommendation_list_per_member:
-        for item in sublist:
-            if item not in seen:
-                seen.add(item)
-                recommendation_list.append(item)
-    return recommendation_list
-
-def create_recommendation_for_member(member_id):
-    media, distances = recommend_media(member_id, k=K_RECOMMENDATION)
+def create_recommendation_for_member(member_id, **predicates):
+    media, distances = recommend_media(member_id, k=K_RECOMMENDATION, **predicates)
     return media
 
-if __name__ == '__main__':
-    create_tables()
-    delete_cache()
-    check_and_add_media()
-    check_and_add_reviews()
-    check_and_add_creators()
-    train_knns()
-    
-    #Testing of knn
+#Testing of knn
+def test_recommendations():
     user = get_user("test@gmail.com")
   
     #List of sample medias with Animation genre
@@ -573,7 +664,9 @@ if __name__ == '__main__':
         add_user("test@gmail.com", "password")
         user = get_user("test@gmail.com")
         for media in media_list:
-            add_and_update_user_preference(user.id, media, random.uniform(5, 10))
+            rating = random.uniform(5, 10)
+            if add_and_update_user_preference(user.id, media, rating):
+                preference_changed(user.id, media, rating)
     media, distances = recommend_media(user.id, 100)
     count = 0
     for m, n in zip(media, distances):
@@ -587,4 +680,54 @@ if __name__ == '__main__':
     print(f"Media count: {count}")
     #End of test
 
+#Reapplies the ratings dump (replace title.ratings.tsv or .tsv.gz to publish new ratings), then patches
+#only the media whose rating changed and reloads the popular list. The server is the only writer of the feature store.
+def refresh_ratings_and_model():
+    try:
+        reviewed_media = refresh_ratings()
+        if reviewed_media:
+            update_knns(reviewed_media)
+        refresh_popular_media()
+    except Exception as e:
+        print(f"Ratings refresh failed: {e}")
+    schedule_ratings_refresh()
+
+def schedule_ratings_refresh():
+    if RATINGS_REFRESH_SECONDS > 0:
+        timer = Timer(RATINGS_REFRESH_SECONDS, refresh_ratings_and_model)
+        timer.daemon = True
+        timer.start()
+
+#Ingestion and training run in the background, recommendations fall back to popular media until the model is ready
+def startup_steps():
+    loaded = {}
+
+    def load_data():
+        #Media first, then ratings and crew side by side, parsed on every core
+        result = ingest_imdb(on_phase=startup.set_phase, on_progress=startup.set_progress)
+        loaded["media"] = result["media"]
+        loaded["reviewed_media"] = result["reviewed_media"]
+        if loaded["media"]:
+            delete_cache() #New catalog, stored features are stale
+        refresh_popular_media()
+
+    def train():
+        train_knns(progress=startup.set_progress) #Loads the feature store when it exists
+
+    def update():
+        if loaded["reviewed_media"] and not loaded["media"]:
+            update_knns(loaded["reviewed_media"]) #Patch only the media that got new ratings
+        start_recommendation_executor(get_model_state().version) #No-op unless RECOMMENDATION_WORKERS is set
+        schedule_ratings_refresh()
+
+    return [
+        ("loading_media", load_data),
+        ("training", train),
+        ("updating", update),
+        ("self_test", test_recommendations),
+    ]
+
+if __name__ == '__main__':
+    create_tables()
+    startup.start_background(startup_steps())
     socketio.run(app, host='0.0.0.0', port=5000, allow_unsafe_werkzeug=True)
@@ -0,0 +1,74 @@
+# Offline precomputation of the recommendations of every user.
+#
+#     python batch_recommendations.py [--k 50] [--workers 4] [--batch-size 512]
+#
+# The model is loaded once in this process, then workers are forked and share
+# it: the feature store is memory mapped and the indexes are inherited copy on
+# write. Users are streamed in id order and dealt to the workers in chunks,
+# every chunk is one batched knn query and one bulk upsert into
+# user_recommendations. /recommendations/get serves those lists while they are
+# fresh (see get_stored_recommendation).
+import argparse
+import functools
+import multiprocessing
+import os
+import time
+import db.users
+import db.media
+import db.creators
+import db.user_preferences
+import db.user_recommendations
+from recommendation.model_state import get_model_state
+from recommendation.knn_recommendation import load_knns, compute_media_for_users
+from recommendation.executor import init_worker
+from recommendation.feature_store import STORE_DIR
+
+BATCH_K = int(os.getenv("BATCH_RECOMMENDATION_K", os.getenv("K_RECOMMENDATION", 50)))
+BATCH_USERS = int(os.getenv("BATCH_RECOMMENDATION_USERS", 512))  # Users per batched query and upsert
+BATCH_WORKERS = int(os.getenv("BATCH_RECOMMENDATION_WORKERS", os.cpu_count() or 1))
+
+def recommend_chunk(args):
+    user_ids, k = args
+    state = get_model_state()
+    recommendations = compute_media_for_users(user_ids, k)
+    return len(user_ids), db.user_recommendations.save_user_recommendations(recommendations, state.version)
+
+def run_batch(k=BATCH_K, workers=BATCH_WORKERS, batch_size=BATCH_USERS):
+    start = time.perf_counter()
+    # The server owns training and the store versions, the batch only reads CURRENT
+    state = load_knns()
+    if state is None:
+        raise RuntimeError(f"No feature store in {STORE_DIR}, start the server to train the model first")
+    print(f"Model {state.version} loaded in {time.perf_counter() - start:.1f}s")
+
+    chunks = ((user_ids, k) for user_ids in db.users.iter_user_ids(batch_size))
+    users = saved = 0
+    start = time.perf_counter()
+    if workers <= 1:
+        results = map(recommend_chunk, chunks)
+        pool = None
+    else:
+        # fork: workers inherit the loaded model instead of loading it again
+        pool = multiprocessing.get_context("fork").Pool(workers, initializer=functools.partial(
+            init_worker, (db.users, db.media, db.creators, db.user_preferences, db.user_recommendations)))
+        results = pool.imap_unordered(recommend_chunk, chunks)
+    try:
+        for chunk_users, chunk_saved in results:
+            users += chunk_users
+            saved += chunk_saved
+            elapsed = time.perf_counter() - start
+            print(f"{users} users, {saved} saved, {users / max(elapsed, 1e-9):.0f} users/s")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print(f"Batch recommendations done: {saved}/{users} users in {time.perf_counter() - start:.1f}s")
+    return saved
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute recommendations for all users")
+    parser.add_argument("--k", type=int, default=BATCH_K)
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=BATCH_USERS)
+    args = parser.parse_args()
+    run_batch(args.k, args.workers, args.batch_size)
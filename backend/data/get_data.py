@@ -1,15 +1,74 @@
-import csv
+import gzip
+import itertools
+import os
 
-def get_media_from_tsv(file_path):
-    print("Reading file...")
+TSV_BATCH_ROWS = int(os.getenv("TSV_BATCH_ROWS", 50000))  # Rows per yielded column batch
+NULL = '\\N'  # IMDb null marker
+
+# Field converters, every one maps \N to None
+def tsv_str(value):
+    return None if value == NULL else value
+
+def tsv_int(value):
+    return int(value) if value.isdigit() else None
+
+def tsv_float(value):
     try:
-        with open(file_path, mode='r', encoding='utf-8-sig') as file:
-            reader = csv.DictReader(file, delimiter='\t')
-            rows = [row for row in reader]
+        return float(value)
+    except ValueError:
+        return None
+
+def tsv_bool(value):
+    return value == '1'
 
-        print(rows[0])
-        return rows
+def tsv_list(value):
+    # Comma separated field (genres, directors, writers), \N is an empty list
+    return [] if value == NULL or not value else value.split(',')
+
+def open_tsv(file_path):
+    """
+    Text stream of a TSV dump, read directly from the official .tsv.gz when
+    the path ends in .gz or only the compressed file exists.
+    """
+    if not file_path.endswith('.gz') and not os.path.exists(file_path) and os.path.exists(file_path + '.gz'):
+        file_path += '.gz'
+    if file_path.endswith('.gz'):
+        return gzip.open(file_path, mode='rt', encoding='utf-8-sig', newline='')
+    return open(file_path, mode='r', encoding='utf-8-sig', newline='')
+
+def iter_tsv_chunks(file_path, batch_size=TSV_BATCH_ROWS):
+    """
+    Streams a TSV file as (header, lines) with at most batch_size raw lines
+    per chunk, for parse_tsv_lines to run here or in another process.
+    """
+    print(f"Reading {file_path}...")
+    try:
+        file = open_tsv(file_path)
     except FileNotFoundError:
         print(f"Error: The file {file_path} does not exist")
-    except Exception as e:
-        print(f"An error occured: {e}")
\ No newline at end of file
+        return
+    with file:
+        header = file.readline().rstrip('\r\n').split('\t')
+        while True:
+            lines = list(itertools.islice(file, batch_size))
+            if not lines:
+                return
+            yield header, lines
+
+def parse_tsv_lines(header, lines, columns=None, types=None):
+    """
+    Column batch {column: tuple of values} of raw TSV lines.
+    columns: header names to keep (all by default). types: {column:
+    converter}, other columns are kept as str with \\N as None.
+    IMDb dumps are not quoted, lines are split on tabs only.
+    """
+    types = types or {}
+    columns = columns or header
+    rows = [line.rstrip('\r\n').split('\t') for line in lines]
+    # Truncated lines would shift the columns of the whole batch
+    rows = [row for row in rows if len(row) == len(header)]
+    fields = list(zip(*rows)) if rows else [()] * len(header)
+    return {
+        column: tuple(map(types.get(column, tsv_str), fields[header.index(column)]))
+        for column in columns
+    }
@@ -0,0 +1,166 @@
+from sqlalchemy import create_engine
+import io
+import os
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+engine = create_engine(DATABASE_URL)
+
+def _copy_text(value):
+    # One field in COPY text format, None is NULL
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (list, tuple)):
+        return _copy_text('{' + ','.join(_array_element(element) for element in value) + '}')
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def _array_element(value):
+    # Array literal element, quoted when it holds separators or quotes
+    if value is None:
+        return 'NULL'
+    value = str(value)
+    if value == '' or value.upper() == 'NULL' or any(c in value for c in ',{}"\\ '):
+        return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return value
+
+def copy_buffer(rows):
+    buffer = io.StringIO()
+    buffer.writelines('\t'.join(_copy_text(value) for value in row) + '\n' for row in rows)
+    buffer.seek(0)
+    return buffer
+
+def _column_list(columns):
+    return ', '.join(f'"{column}"' for column in columns)
+
+def insert_statement(table, columns, conflict_columns=None):
+    # Moves the staging rows into table, keys already stored (or repeated in the batch) are skipped
+    column_list = _column_list(columns)
+    insert = f"INSERT INTO {table} ({column_list}) SELECT "
+    if conflict_columns:
+        keys = _column_list(conflict_columns)
+        return insert + f"DISTINCT ON ({keys}) {column_list} FROM {{staging}} ON CONFLICT ({keys}) DO NOTHING"
+    return insert + f"{column_list} FROM {{staging}}"
+
+def update_statement(table, key_column, columns):
+    # Sets columns from the staging rows with the same key, only where a value differs
+    assignments = ', '.join(f'"{column}" = s."{column}"' for column in columns)
+    changed = ' OR '.join(f't."{column}" IS DISTINCT FROM s."{column}"' for column in columns)
+    return (f'UPDATE {table} AS t SET {assignments} FROM {{staging}} AS s '
+            f'WHERE t."{key_column}" = s."{key_column}" AND ({changed}) RETURNING t."{key_column}"')
+
+class StagedLoader:
+    """
+    One connection loading batches through its own temporary staging table,
+    which has the column types of table but no constraints or indexes. Every
+    load() streams a batch with COPY ... FROM STDIN. batch_statements (SQL
+    with a {staging} placeholder) then apply it set-based and are committed
+    with it. Without them the rows accumulate and final_statement applies
+    them all in finish(), in the same single transaction.
+    Several loaders can run side by side, temporary tables are per
+    connection. With shared=True the loader copies into the table of a
+    SharedStaging instead and commits every batch as is.
+    """
+    def __init__(self, table, columns, batch_statements=(), final_statement=None, staging=None, shared=False):
+        self.column_list = _column_list(columns)
+        self.staging = staging or f"{table}_staging"
+        self.batch_statements = [statement.format(staging=self.staging) for statement in batch_statements]
+        self.final_statement = final_statement.format(staging=self.staging) if final_statement else None
+        self.shared = shared
+        self.rows = 0
+        self.affected = [0] * len(self.batch_statements)
+        self.connection = engine.raw_connection()
+        self.cursor = self.connection.cursor()
+        if not shared:
+            self.cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS {self.staging} AS SELECT {self.column_list} FROM {table} WITH NO DATA")
+
+    def load(self, rows):
+        self.cursor.copy_expert(f"COPY {self.staging} ({self.column_list}) FROM STDIN", copy_buffer(rows))
+        self.rows += len(rows)
+        if self.shared:
+            self.connection.commit()
+        elif self.batch_statements:
+            for i, statement in enumerate(self.batch_statements):
+                self.cursor.execute(statement)
+                self.affected[i] += self.cursor.rowcount
+            self.cursor.execute(f"TRUNCATE {self.staging}")
+            self.connection.commit()
+
+    def finish(self):
+        # Rows returned by final_statement, None without one
+        returned = None
+        try:
+            if self.shared:
+                # The rows are applied by SharedStaging.apply() once every loader is done
+                self.connection.commit()
+                return None
+            if self.final_statement:
+                # Row estimates for the join plan
+                self.cursor.execute(f"ANALYZE {self.staging}")
+                self.cursor.execute(self.final_statement)
+                returned = self.cursor.fetchall() if self.cursor.description else []
+            self.cursor.execute(f"DROP TABLE IF EXISTS {self.staging}")
+            self.connection.commit()
+        finally:
+            self.connection.close()
+        return returned
+
+    def abort(self):
+        # Uncommitted rows are lost, the staging table must not outlive the pooled connection
+        try:
+            self.connection.rollback()
+            if not self.shared:
+                self.cursor.execute(f"DROP TABLE IF EXISTS {self.staging}")
+                self.connection.commit()
+        finally:
+            self.connection.close()
+
+class SharedStaging:
+    """
+    One UNLOGGED staging table that several shared StagedLoader connections
+    COPY into side by side. apply() then runs statement over all the rows
+    on a single connection and commits it together with dropping the
+    table, so table either gets the whole load or nothing of it.
+    """
+    def __init__(self, table, columns, statement, staging=None):
+        self.table = table
+        self.columns = list(columns)
+        self.staging = staging or f"{table}_shared_staging"
+        self.statement = statement.format(staging=self.staging)
+        # Left over by an interrupted load, its rows are stale
+        self._execute(f"DROP TABLE IF EXISTS {self.staging}",
+                      f"CREATE UNLOGGED TABLE {self.staging} AS SELECT {_column_list(self.columns)} FROM {table} WITH NO DATA")
+
+    def _execute(self, *statements):
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            for statement in statements:
+                cursor.execute(statement)
+            connection.commit()
+        finally:
+            connection.close()
+
+    def loader(self):
+        return StagedLoader(self.table, self.columns, staging=self.staging, shared=True)
+
+    def apply(self):
+        # Rows returned by statement
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            # Row estimates for the join plan
+            cursor.execute(f"ANALYZE {self.staging}")
+            cursor.execute(self.statement)
+            returned = cursor.fetchall() if cursor.description else []
+            cursor.execute(f"DROP TABLE {self.staging}")
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+        return returned
+
+    def drop(self):
+        self._execute(f"DROP TABLE IF EXISTS {self.staging}")
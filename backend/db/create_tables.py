@@ -1,10 +1,8 @@
 import os
 from sqlalchemy import create_engine
-from db.models import Base, Media
+from db.models import Base, Media, media_creators_pair_index
 from sqlalchemy.orm import sessionmaker
-from data.get_data import get_media_from_tsv
-from db.media import check_media, add_media, check_reviews, add_review, get_media_by_tconst
-from db.creators import check_creators, add_creator, associate_creator_with_media
+from data.get_data import tsv_bool, tsv_int, tsv_float, tsv_list
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 engine = create_engine(DATABASE_URL)
@@ -13,70 +11,51 @@ Session = sessionmaker(bind=engine)
 def create_tables():
     print("Creating tables...")
     Base.metadata.create_all(engine)
+    media_creators_pair_index.create(engine, checkfirst=True) #Tables created before the index existed
     print("Tables created!")
 
-def check_and_add_media():
-    media = check_media()
-    if not media:
-        print("Adding media...")
-        rows_of_media = get_media_from_tsv("title.basics.tsv")
-        for row in rows_of_media:
+MEDIA_COLUMNS = ["tconst", "titleType", "primaryTitle", "originalTitle", "isAdult",
+                 "startYear", "endYear", "runtimeMinutes", "genres"]
+MEDIA_TYPES = {"isAdult": tsv_bool, "startYear": tsv_int, "endYear": tsv_int, "runtimeMinutes": tsv_int, "genres": tsv_list}
+
+#Yields MEDIA_COLUMNS tuples of title.basics column batches
+def media_values(batches):
+    for batch in batches:
+        for values in zip(*(batch[column] for column in MEDIA_COLUMNS)):
+            tconst, title_type, primary_title, original_title, is_adult, start_year, end_year, runtime, genres = values
 
             # Skiping individual episodes
-            if row['titleType'] == 'tvEpisode' and 'Episode' in row['primaryTitle']:
+            if title_type == 'tvEpisode' and 'Episode' in (primary_title or ''):
                 continue
 
-            genres = ''.join(str(row['genres'])).split(',')
-            add_media(
-                tconst=row['tconst'] if row['tconst'] != '\\N' else '',
-                titleType=row['titleType'] if row['titleType'] != '\\N' else '',
-                primaryTitle=row['primaryTitle'] if row['primaryTitle'] != '\\N' else '',
-                originalTitle=row['originalTitle'] if row['originalTitle'] != '\\N' else '',
-                isAdult=bool(int(row['isAdult'])) if row['isAdult'] != '\\N' else False,
-                startYear=row['startYear'] if row['startYear'] != '\\N' else None,
-                endYear=int(row['endYear']) if row['endYear'] != '\\N' else None,
-                runtimeMinutes=int(row['runtimeMinutes']) if row['runtimeMinutes'].isdigit() else None,
-                genres=genres if genres != ['\\N'] else []
-            )
-        print("Media added...")
-    else:
-        print("Media exists")
+            yield (tconst or '', title_type or '', primary_title or '', original_title or '',
+                   is_adult, start_year, end_year, runtime, genres)
 
-def check_and_add_reviews():
-    review_check = check_reviews()
-    if not review_check:
-        print("Adding reviews...")
-        rows_of_reviews = get_media_from_tsv('title.ratings.tsv')
-        for row in rows_of_reviews:
-            add_review(
-                tconst = row['tconst'],
-                averageRating = row['averageRating'],
-                numVotes = row['numVotes']
-            )
-        print("Reviews added...")
-    else:
-        print("Reviews exists")
+REVIEW_COLUMNS = ["tconst", "averageRating", "numVotes"]
+REVIEW_TYPES = {"averageRating": tsv_float, "numVotes": tsv_int}
 
-def check_and_add_creators():
-    creator_check = check_creators()
-    if not creator_check:
-        print("Adding creators...")
-        session = Session()
-        rows_of_creators = get_media_from_tsv('title.crew.tsv')
-        for row in rows_of_creators:
-            tconst = row['tconst']
-            media = get_media_by_tconst(tconst)
-            if not media:
-                continue
-            directors = [d for d in row['directors'].split(',') if d and d != '\\N']
-            writers = [w for w in row['writers'].split(',') if w and w != '\\N']
-            for director in directors:
-                add_creator(session, director)
-                associate_creator_with_media(session, tconst, director)
-            for writer in writers:
-                add_creator(session, writer)
-                associate_creator_with_media(session, tconst, writer)
-        session.close()
-        print("Creators added...")
-    else:
-        print("Creators already exist")
\ No newline at end of file
+#Yields REVIEW_COLUMNS tuples of title.ratings column batches
+def review_values(batches):
+    for batch in batches:
+        yield from zip(*(batch[column] for column in REVIEW_COLUMNS))
+
+CREW_COLUMNS = ["tconst", "directors", "writers"]
+CREW_TYPES = {"directors": tsv_list, "writers": tsv_list}
+#Pairs of unknown media are dropped by the join with medias, creators and pairs already stored are skipped.
+#Creators are inserted in id order so concurrent loaders lock them in the same order.
+CREW_STATEMENTS = [
+    "INSERT INTO creators (id) SELECT DISTINCT s.creator_id FROM {staging} s "
+    "JOIN medias m ON m.tconst = s.media_id ORDER BY s.creator_id ON CONFLICT (id) DO NOTHING",
+    "INSERT INTO media_creators (media_id, creator_id) SELECT s.media_id, s.creator_id FROM {staging} s "
+    "JOIN medias m ON m.tconst = s.media_id WHERE NOT EXISTS ("
+    "SELECT 1 FROM media_creators mc WHERE mc.media_id = s.media_id AND mc.creator_id = s.creator_id)",
+]
+
+#Yields deduplicated (tconst, creator_id) pairs of title.crew column batches
+def crew_pairs(batches):
+    for batch in batches:
+        pairs = set()
+        for tconst, directors, writers in zip(batch['tconst'], batch['directors'], batch['writers']):
+            pairs.update((tconst, creator_id) for creator_id in directors)
+            pairs.update((tconst, creator_id) for creator_id in writers)
+        yield from pairs
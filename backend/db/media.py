@@ -26,74 +26,77 @@ def check_reviews():
     session.close()
     return review_count > 0
 
-def add_media(tconst, titleType, primaryTitle, originalTitle, isAdult, startYear, endYear, runtimeMinutes, genres):
-    new_media = Media(
-        tconst=tconst,
-        titleType=titleType,
-        primaryTitle=primaryTitle,
-        originalTitle=originalTitle,
-        isAdult=isAdult,
-        startYear=startYear,
-        endYear=endYear,
-        runtimeMinutes=runtimeMinutes,
-        genres=genres
-    )
-    
-    try:
-        session = Session()
-        session.add(new_media)
-        session.commit()
-    except Exception as e:
-        session.rollback()
-        print(f"Error adding media: {e}")
-    finally:
-        session.close()
-
 def get_media_by_tconst(tconst):
     session = Session()
     media = session.query(Media).filter(Media.tconst == tconst).first()
     session.close()
     return media
 
-def get_all_genres():
+def _feature_columns(details):
+    columns = [Media.tconst, Media.titleType, Media.isAdult, Media.genres, Media.averageRating, Media.numVotes]
+    if details:
+        columns += [Media.startYear, Media.runtimeMinutes]
+    return columns
+
+#Returns (tconst, titleType, isAdult, genres, averageRating, numVotes) rows for many tconsts,
+#details adds (startYear, runtimeMinutes). One query per batch_size tconsts keeps the IN list bounded.
+def get_media_features_by_tconsts(tconsts, details=False, batch_size=10000):
+    tconsts = list(tconsts)
+    if not tconsts:
+        return []
     session = Session()
-    genres = session.query(Media.genres).all()
-    session.close()
-    distinct_genres = set()
-    for genre in genres:
-        for g in genre.genres:
-            distinct_genres.add(g)
-    return distinct_genres
-
-#Returns media page with minimum number of votes and containing any genres
-def get_media_page(page, page_size, min_num_votes=0):
-    offset = page * page_size
-    session = Session()
-    media = (
-        session.query(Media)
-        .filter(
-            Media.numVotes >= min_num_votes,
-            Media.genres != '{}',
-            Media.titleType != 'tvEpisode'  # skip TV episodes
+    media = []
+    for start in range(0, len(tconsts), batch_size):
+        media.extend(
+            session.query(*_feature_columns(details))
+            .filter(Media.tconst.in_(tconsts[start:start + batch_size]))
+            .all()
         )
-        .offset(offset)
-        .limit(page_size)
-        .all()
-    )
     session.close()
     return media
 
+def get_all_genres():
+    session = Session()
+    genres = session.query(func.unnest(Media.genres)).distinct().all()
+    session.close()
+    return {genre for (genre,) in genres}
+
+def _catalog_media_filters(min_num_votes):
+    return (
+        Media.numVotes >= min_num_votes,
+        Media.genres != '{}',
+        Media.titleType != 'tvEpisode'  # skip TV episodes
+    )
 
-def add_review(tconst, averageRating, numVotes):
+#Same rules as _catalog_media_filters for a row already loaded
+def is_catalog_media(media, min_num_votes=0):
+    return (media.numVotes is not None and media.numVotes >= min_num_votes
+            and bool(media.genres) and media.titleType != 'tvEpisode')
+
+def count_catalog_media(min_num_votes=0):
     session = Session()
-    media = session.query(Media).filter(Media.tconst == tconst).first()
-    if not media:
-        session.close()
-        return
-    media.averageRating = averageRating
-    media.numVotes = numVotes
-    session.commit()
+    count = session.query(Media).filter(*_catalog_media_filters(min_num_votes)).count()
     session.close()
+    return count
+
+#Streams batches of (tconst, titleType, isAdult, genres, averageRating, numVotes) tuples in tconst order.
+#Keyset pagination (tconst > last seen) walks the primary key index, unlike OFFSET
+#which rescans every skipped row for each page.
+def iter_catalog_media(batch_size=10000, min_num_votes=0, details=False):
+    last_tconst = None
+    while True:
+        session = Session()
+        query = session.query(*_feature_columns(details)).filter(
+            *_catalog_media_filters(min_num_votes)
+        )
+        if last_tconst is not None:
+            query = query.filter(Media.tconst > last_tconst)
+        media = query.order_by(Media.tconst).limit(batch_size).all()
+        session.close()
+        if not media:
+            return
+        yield media
+        last_tconst = media[-1].tconst
 
 def get_user_media_page(page=1, page_size=6, sort_by="primaryTitle", sort_dir="asc",
                    min_rating=0, categories=None, search=""):
@@ -151,7 +154,7 @@ def get_user_media_page(page=1, page_size=6, sort_by="primaryTitle", sort_dir="a
 
 def get_most_pupular_media(limit=10):
     session = Session()
-    query = session.quert(Media)
+    query = session.query(Media)
     #ignoring tvEpisode
     query = query.filter(Media.titleType != "tvEpisode")
     #ignoring media with no number of votes
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Float, ARRAY, Table
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, ForeignKey, Float, ARRAY, Table, DateTime, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -10,6 +10,8 @@ media_creators_association = Table(
     Column('media_id', String, ForeignKey('medias.tconst')),
     Column('creator_id', String, ForeignKey('creators.id'))
 )
+# Creator lookups by media and the duplicate check of the bulk crew load
+media_creators_pair_index = Index('media_creators_pair_idx', media_creators_association.c.media_id, media_creators_association.c.creator_id)
 
 class User(Base):
     __tablename__ = 'users'
@@ -62,4 +64,13 @@ class Creators(Base):
     __tablename__ = "creators"
 
     id = Column(String, primary_key=True)
-    works = relationship("Media", secondary=media_creators_association, back_populates="creators")
\ No newline at end of file
+    works = relationship("Media", secondary=media_creators_association, back_populates="creators")
+
+class UserRecommendation(Base):
+    __tablename__ = "user_recommendations"
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    model_version = Column(BigInteger, nullable=False)  # Feature store version the list was computed with
+    media = Column(ARRAY(String), nullable=False)  # Recommended tconsts, best first
+    distances = Column(ARRAY(Float), nullable=False)
+    computed_at = Column(DateTime, nullable=False)
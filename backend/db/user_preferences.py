@@ -14,6 +14,36 @@ def get_user_preferences(user_id):
     session.close()
     return user_preferences
 
+#Returns {user_id: [UserPreference, ...]} for many users in one query
+def get_preferences_for_users(user_ids):
+    preferences = {user_id: [] for user_id in user_ids}
+    if not user_ids:
+        return preferences
+    session = Session()
+    rows = session.query(UserPreference).filter(UserPreference.user_id.in_(list(user_ids))).all()
+    session.close()
+    for preference in rows:
+        preferences[preference.user_id].append(preference)
+    return preferences
+
+#Streams (user_id, media_id, rating) of every preference in pages, keyset pagination on id
+def iter_all_preferences(batch_size=10000):
+    last_id = 0
+    while True:
+        session = Session()
+        rows = (
+            session.query(UserPreference.id, UserPreference.user_id, UserPreference.media_id, UserPreference.rating)
+            .filter(UserPreference.id > last_id)
+            .order_by(UserPreference.id)
+            .limit(batch_size)
+            .all()
+        )
+        session.close()
+        if not rows:
+            return
+        yield [(row.user_id, row.media_id, row.rating) for row in rows]
+        last_id = rows[-1].id
+
 def add_and_update_user_preference(user_id, tconst, rating):
     new_user_preference = UserPreference(
         user_id=user_id,
@@ -0,0 +1,55 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects.postgresql import insert
+from db.models import UserRecommendation
+import datetime
+import os
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+engine = create_engine(DATABASE_URL)
+Session = sessionmaker(bind=engine)
+
+def get_user_recommendation(user_id):
+    session = Session()
+    recommendation = session.query(UserRecommendation).filter(UserRecommendation.user_id == user_id).first()
+    session.close()
+    return recommendation
+
+#Upserts {user_id: (media, distances)} in one statement
+def save_user_recommendations(recommendations, model_version):
+    if not recommendations:
+        return 0
+    computed_at = datetime.datetime.utcnow()
+    rows = [
+        {
+            "user_id": user_id,
+            "model_version": model_version,
+            "media": list(media),
+            "distances": [float(distance) for distance in distances],
+            "computed_at": computed_at,
+        }
+        for user_id, (media, distances) in recommendations.items()
+    ]
+    statement = insert(UserRecommendation).values(rows)
+    statement = statement.on_conflict_do_update(
+        index_elements=[UserRecommendation.user_id],
+        set_={name: statement.excluded[name] for name in ("model_version", "media", "distances", "computed_at")},
+    )
+    session = Session()
+    try:
+        session.execute(statement)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        print(f"Error saving user recommendations: {e}")
+        return 0
+    finally:
+        session.close()
+    return len(rows)
+
+#Stored list is stale once the user rates something
+def delete_user_recommendation(user_id):
+    session = Session()
+    session.query(UserRecommendation).filter(UserRecommendation.user_id == user_id).delete()
+    session.commit()
+    session.close()
@@ -52,3 +52,15 @@ def get_user(email):
     session.close()
     return user
     
+
+#Streams lists of user ids in pages, keyset pagination on id
+def iter_user_ids(batch_size=1000):
+    last_id = 0
+    while True:
+        session = Session()
+        rows = session.query(User.id).filter(User.id > last_id).order_by(User.id).limit(batch_size).all()
+        session.close()
+        if not rows:
+            return
+        yield [row.id for row in rows]
+        last_id = rows[-1].id
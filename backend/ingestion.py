@@ -0,0 +1,247 @@
+# Parallel loading of the IMDb dumps into a fresh database.
+#
+#     python ingestion.py [--parsers 4] [--loaders 4]
+#
+# The main thread reads (and decompresses) raw line chunks, a pool of
+# processes parses and transforms them into rows, and loader threads, each
+# with its own connection, COPY the rows into Postgres.
+# A bounded queue between parsers and loaders keeps memory flat when one side
+# is slower. Media are loaded first, ratings and crew then run side by side
+# as both only need the media rows. refresh_ratings() reapplies a newer
+# title.ratings dump to an already loaded database.
+import argparse
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from data.get_data import iter_tsv_chunks, parse_tsv_lines, TSV_BATCH_ROWS
+from db.bulk_load import StagedLoader, SharedStaging, insert_statement, update_statement
+from db.media import check_media, check_reviews
+from db.creators import check_creators
+from db.create_tables import (
+    create_tables,
+    MEDIA_COLUMNS, MEDIA_TYPES, media_values, REVIEW_COLUMNS, REVIEW_TYPES, review_values,
+    CREW_COLUMNS, CREW_TYPES, CREW_STATEMENTS, crew_pairs,
+)
+
+INGEST_PARSERS = int(os.getenv("INGEST_PARSERS", max((os.cpu_count() or 1) - 1, 1)))  # 0 parses on the reading thread
+INGEST_LOADERS = int(os.getenv("INGEST_LOADERS", 4))  # Connections per stage
+INGEST_QUEUE_BATCHES = int(os.getenv("INGEST_QUEUE_BATCHES", 8))  # Parsed batches waiting for a loader
+
+class Stage:
+    # One dump: how its lines become rows and how a loader connection applies them
+    # With make_staging the loaders only COPY into its shared table, applied once at the end
+    def __init__(self, name, phase, file_path, columns, types, transform, make_loader=None, make_staging=None):
+        self.name = name
+        self.phase = phase
+        self.file_path = file_path
+        self.columns = columns
+        self.types = types
+        self.transform = transform
+        self.make_loader = make_loader
+        self.make_staging = make_staging
+
+def media_stage():
+    return Stage("media", "loading_media", "title.basics.tsv", MEDIA_COLUMNS, MEDIA_TYPES, media_values,
+                 lambda: StagedLoader("medias", MEDIA_COLUMNS, [insert_statement("medias", MEDIA_COLUMNS, ["tconst"])]))
+
+def reviews_stage():
+    # One UPDATE ... FROM over every loader's rows, committed once: check_reviews() never sees a partial load
+    return Stage("reviews", "loading_reviews", "title.ratings.tsv", REVIEW_COLUMNS, REVIEW_TYPES, review_values,
+                 make_staging=lambda: SharedStaging("medias", REVIEW_COLUMNS, update_statement("medias", "tconst", REVIEW_COLUMNS[1:]),
+                                                    staging="medias_update_staging"))
+
+def creators_stage():
+    return Stage("creators", "loading_creators", "title.crew.tsv", CREW_COLUMNS, CREW_TYPES, crew_pairs,
+                 lambda: StagedLoader("media_creators", ["media_id", "creator_id"], CREW_STATEMENTS))
+
+def parse_chunk(header, lines, columns, types, transform):
+    # Runs in a parser process: raw lines to the rows a loader copies
+    return list(transform([parse_tsv_lines(header, lines, columns, types)]))
+
+def run_stage(stage, pool=None, loaders=INGEST_LOADERS, queue_batches=INGEST_QUEUE_BATCHES,
+              batch_size=TSV_BATCH_ROWS, on_progress=None):
+    """
+    Streams one dump through the parser pool into loaders connections.
+    Returns (rows returned by the loaders' or the shared staging's final
+    statements, metrics).
+    """
+    batches = queue.Queue(maxsize=queue_batches)
+    metrics = {"lines": 0, "rows": 0, "batches": 0, "loaders": loaders, "seconds": 0.0, "rows_per_second": 0.0}
+    returned, errors = [], []
+    lock = threading.Lock()
+    start = time.perf_counter()
+    staging = stage.make_staging() if stage.make_staging else None
+    make_loader = staging.loader if staging else stage.make_loader
+
+    def load():
+        loader = None
+        try:
+            loader = make_loader()
+        except Exception as e:
+            errors.append(e)
+        while True:
+            rows = batches.get()
+            if rows is None:
+                break
+            # After a failure the queue is still drained so the reader never blocks
+            if loader is None or errors:
+                continue
+            try:
+                loader.load(rows)
+            except Exception as e:
+                errors.append(e)
+                loader.abort()
+                loader = None
+                continue
+            with lock:
+                metrics["rows"] += len(rows)
+                metrics["batches"] += 1
+                rows_loaded = metrics["rows"]
+            elapsed = time.perf_counter() - start
+            print(f"Ingestion {stage.name}: {rows_loaded} rows loaded, {rows_loaded / max(elapsed, 1e-9):.0f} rows/s")
+            if on_progress:
+                on_progress(rows_loaded)
+        if loader is None:
+            return
+        if errors:
+            loader.abort()
+            return
+        try:
+            result = loader.finish()
+            if result:
+                with lock:
+                    returned.extend(result)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=load, name=f"ingest-{stage.name}-{i}", daemon=True) for i in range(loaders)]
+    for thread in threads:
+        thread.start()
+    pending = collections.deque()
+    try:
+        for header, lines in iter_tsv_chunks(stage.file_path, batch_size):
+            metrics["lines"] += len(lines)
+            if pool is None:
+                batches.put(parse_chunk(header, lines, stage.columns, stage.types, stage.transform))
+            else:
+                pending.append(pool.submit(parse_chunk, header, lines, stage.columns, stage.types, stage.transform))
+                # Parsed chunks reach the loaders in file order, at most queue_batches are parsed ahead
+                if len(pending) >= queue_batches:
+                    batches.put(pending.popleft().result())
+            if errors:
+                break
+        while pending and not errors:
+            batches.put(pending.popleft().result())
+    except Exception as e:
+        errors.append(e)
+    finally:
+        for future in pending:
+            future.cancel()
+        for _ in threads:
+            batches.put(None)
+        for thread in threads:
+            thread.join()
+    if staging is not None:
+        try:
+            if not errors:
+                returned.extend(staging.apply())
+        except Exception as e:
+            errors.append(e)
+        if errors:
+            staging.drop()
+    if errors:
+        print(f"Ingestion {stage.name} failed: {errors[0]}")
+        raise errors[0]
+
+    metrics["seconds"] = round(time.perf_counter() - start, 2)
+    metrics["rows_per_second"] = round(metrics["rows"] / max(metrics["seconds"], 1e-9))
+    print(f"Ingestion {stage.name}: {metrics['lines']} lines, {metrics['rows']} rows in {metrics['seconds']}s "
+          f"({metrics['rows_per_second']} rows/s, {loaders} loaders)")
+    return returned, metrics
+
+def _parser_pool(parsers):
+    # spawn: the server process already runs threads
+    return concurrent.futures.ProcessPoolExecutor(parsers, mp_context=multiprocessing.get_context("spawn")) if parsers > 0 else None
+
+def refresh_ratings(parsers=INGEST_PARSERS, loaders=INGEST_LOADERS):
+    """
+    Reapplies title.ratings to the loaded media whatever check_reviews()
+    says, in one transaction. Only ratings that differ are written.
+    Returns the tconsts whose rating changed.
+    """
+    pool = _parser_pool(parsers)
+    try:
+        returned, _ = run_stage(reviews_stage(), pool, loaders)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    print(f"Ratings refreshed: {len(returned)} media changed")
+    return [row[0] for row in returned]
+
+def ingest_imdb(parsers=INGEST_PARSERS, loaders=INGEST_LOADERS, on_phase=None, on_progress=None):
+    """
+    Loads whatever the database is missing of media, ratings and crew.
+    Returns {"media": True when media were loaded, "reviewed_media": tconsts
+    whose rating changed, "metrics": {stage: metrics}}.
+    """
+    result = {"media": False, "reviewed_media": [], "metrics": {}}
+    pool = _parser_pool(parsers)
+    start = time.perf_counter()
+    try:
+        if not check_media():
+            stage = media_stage()
+            if on_phase:
+                on_phase(stage.phase)
+            _, result["metrics"]["media"] = run_stage(stage, pool, loaders, on_progress=on_progress)
+            result["media"] = True
+        else:
+            print("Media exists")
+
+        # Ratings and crew only depend on the media rows
+        stages = []
+        if not check_reviews():
+            stages.append(reviews_stage())
+        else:
+            print("Reviews exists")
+        if not check_creators():
+            stages.append(creators_stage())
+        else:
+            print("Creators already exist")
+
+        outputs, errors = {}, []
+        def run(stage):
+            try:
+                outputs[stage.name] = run_stage(stage, pool, loaders, on_progress=on_progress)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=run, args=(stage,), name=f"ingest-{stage.name}") for stage in stages]
+        for thread in threads:
+            thread.start()
+        for stage, thread in zip(stages, threads):
+            # The phase follows the first stage still running
+            if on_phase:
+                on_phase(stage.phase)
+            thread.join()
+        if errors:
+            raise errors[0]
+        for name, (returned, metrics) in outputs.items():
+            result["metrics"][name] = metrics
+        if "reviews" in outputs:
+            result["reviewed_media"] = [row[0] for row in outputs["reviews"][0]]
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    print(f"Ingestion done in {time.perf_counter() - start:.1f}s: {result['metrics']}")
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the IMDb dumps into the database")
+    parser.add_argument("--parsers", type=int, default=INGEST_PARSERS)
+    parser.add_argument("--loaders", type=int, default=INGEST_LOADERS)
+    args = parser.parse_args()
+    create_tables()
+    ingest_imdb(args.parsers, args.loaders)
@@ -0,0 +1,60 @@
+import numpy as np
+from recommendation.knn_index import KNNIndex, expanding_neighbors
+
+class BruteForceKNN(KNNIndex):
+    """
+    Exact euclidean knn for batches of queries. Squared distances come from
+    |x|^2 - 2 * Q.X^T + |q|^2 with precomputed row norms, so a whole batch of
+    profiles costs one matrix multiply per block of the catalog. Blocks keep
+    the temporary distance matrix bounded and only the running top-k
+    (np.argpartition, no full sort) survives between blocks.
+    """
+    def __init__(self, n_neighbors=50, block_size=32768, max_block_elements=2**24):
+        self.n_neighbors = n_neighbors
+        self.block_size = block_size
+        self.max_block_elements = max_block_elements  # queries * block rows, ~64MB of float32
+
+    def fit(self, media_features):
+        self.media_features = media_features
+        self.n_samples = len(media_features)
+        self.row_norms = np.zeros(self.n_samples, dtype=np.float32)
+        for start in range(0, self.n_samples, self.block_size):
+            block = np.asarray(media_features[start:start + self.block_size], dtype=np.float32)
+            self.row_norms[start:start + len(block)] = np.einsum('ij,ij->i', block, block)
+        return self
+
+    def kneighbors(self, X, n_neighbors=None):
+        X = np.atleast_2d(np.asarray(X, dtype=np.float64))
+        k = min(n_neighbors or self.n_neighbors, self.n_samples)
+        n_queries = len(X)
+        if k == 0:
+            return np.zeros((n_queries, 0)), np.zeros((n_queries, 0), dtype=np.int64)
+
+        queries = X.astype(np.float32)
+        block_size = max(k, min(self.block_size, self.max_block_elements // max(n_queries, 1)))
+        best_dist = np.full((n_queries, 0), np.inf, dtype=np.float32)
+        best_rows = np.zeros((n_queries, 0), dtype=np.int64)
+
+        for start in range(0, self.n_samples, block_size):
+            block = np.asarray(self.media_features[start:start + block_size], dtype=np.float32)
+            # |q|^2 is the same for every row of a query, it is left out of the ranking
+            dist = self.row_norms[start:start + len(block)][None, :] - 2 * (queries @ block.T)
+            dist = np.concatenate([best_dist, dist], axis=1)
+            rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, start + len(block)), (n_queries, len(block)))], axis=1)
+            if dist.shape[1] > k:
+                keep = np.argpartition(dist, k - 1, axis=1)[:, :k]
+                dist = np.take_along_axis(dist, keep, axis=1)
+                rows = np.take_along_axis(rows, keep, axis=1)
+            best_dist, best_rows = dist, rows
+
+        # Exact float64 distances for the k survivors, then sort them
+        candidates = np.asarray(self.media_features[best_rows.ravel()], dtype=np.float64).reshape(n_queries, -1, X.shape[1])
+        distances = np.sqrt(((candidates - X[:, None, :]) ** 2).sum(axis=2))
+        order = np.lexsort((best_rows, distances))
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(best_rows, order, axis=1)
+
+    def iter_neighbors(self, query):
+        def search(query, n):
+            distances, rows = self.kneighbors([query], n_neighbors=n)
+            return distances[0], rows[0]
+        return expanding_neighbors(search, query, self.n_samples, self.n_neighbors)
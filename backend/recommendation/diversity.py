@@ -0,0 +1,67 @@
+import os
+import numpy as np
+import scipy.sparse as sp
+
+# 1 keeps the plain distance order, lower values trade relevance for variety
+DIVERSITY_LAMBDA = float(os.getenv("DIVERSITY_LAMBDA", 0.7))
+# Candidates retrieved per requested recommendation when re-ranking
+DIVERSITY_OVERFETCH = int(os.getenv("DIVERSITY_OVERFETCH", 3))
+
+def candidate_count(k, lambda_=DIVERSITY_LAMBDA):
+    return k * DIVERSITY_OVERFETCH if lambda_ < 1 else k
+
+def relevance_from_distances(distances):
+    # Nearest candidate 1, farthest 0
+    distances = np.asarray(distances, dtype=np.float64)
+    if len(distances) == 0:
+        return distances
+    spread = distances.max() - distances.min()
+    if spread <= 0:
+        return np.ones(len(distances))
+    return 1.0 - (distances - distances.min()) / spread
+
+def cosine_similarities(features):
+    # (n x n) cosine similarity of the candidate rows, dense or sparse features
+    if sp.issparse(features):
+        features = sp.csr_matrix(features, dtype=np.float64)
+        norms = np.sqrt(np.asarray(features.multiply(features).sum(axis=1)).ravel())
+        similarity = (features @ features.T).toarray()
+    else:
+        features = np.asarray(features, dtype=np.float64)
+        norms = np.linalg.norm(features, axis=1)
+        similarity = features @ features.T
+    inverse = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+    return similarity * inverse[:, None] * inverse[None, :]
+
+def mmr_select(relevance, similarity, k, lambda_=DIVERSITY_LAMBDA):
+    """
+    Greedy maximal marginal relevance: each step picks the candidate with
+    the best lambda * relevance - (1 - lambda) * (max similarity to the
+    already picked ones). The max similarity of every candidate is kept in
+    one vector and updated with the row of the last pick, so a step is a
+    couple of vector operations over the candidates.
+    Returns candidate positions in pick order.
+    """
+    n = len(relevance)
+    k = min(k, n)
+    selected = np.empty(k, dtype=np.int64)
+    max_similarity = np.zeros(n)
+    available = np.ones(n, dtype=bool)
+    for i in range(k):
+        scores = lambda_ * relevance - (1 - lambda_) * max_similarity
+        scores[~available] = -np.inf
+        pick = int(np.argmax(scores))  # ties go to the nearest candidate
+        selected[i] = pick
+        available[pick] = False
+        np.maximum(max_similarity, similarity[pick], out=max_similarity)
+    return selected
+
+def diversify(distances, features, k, lambda_=DIVERSITY_LAMBDA):
+    """
+    Order of the k candidates to keep out of an over-fetched candidate set
+    sorted by distance. features holds one row per candidate.
+    """
+    n = len(distances)
+    if lambda_ >= 1 or n <= 1:
+        return np.arange(min(k, n))
+    return mmr_select(relevance_from_distances(distances), cosine_similarities(features), k, lambda_)
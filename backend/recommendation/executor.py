@@ -0,0 +1,156 @@
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+import time
+
+RECOMMENDATION_WORKERS = int(os.getenv("RECOMMENDATION_WORKERS", 0))  # 0 computes in the request thread
+RECOMMENDATION_DEADLINE = float(os.getenv("RECOMMENDATION_DEADLINE", 2.0))  # seconds a request waits for its job
+RECOMMENDATION_QUEUE_LIMIT = int(os.getenv("RECOMMENDATION_QUEUE_LIMIT", 64))  # distinct jobs queued or running
+
+_executor = None  # RecommendationExecutor, None while disabled or not started
+_executor_lock = threading.Lock()
+
+def init_worker(db_modules=()):
+    # Pooled connections of a forked parent must not be reused, forked pools (batch_recommendations)
+    # pass their db modules to drop the engines. Spawned workers start without connections
+    for module in db_modules:
+        module.engine.dispose(close=False)
+    # The pool uses every core, one BLAS thread per worker
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)
+    except ImportError:
+        pass
+
+def _ensure_model_state(version):
+    """
+    Worker side: maps the feature store version the server is serving. The
+    base segment indexes are kept when only the delta changed. Workers only
+    map what the server already published and stored, they never build: a
+    missing store, popularity ranking or hybrid feature set raises.
+    """
+    from recommendation.model_state import get_model_state, swap_model_state
+    from recommendation.feature_store import load_feature_store
+    from recommendation.knn_recommendation import build_model_state
+
+    state = get_model_state()
+    if state is not None and state.version == version:
+        return state
+    try:
+        store = load_feature_store(version)
+    except FileNotFoundError:
+        # Version already removed, the current one is at least as new
+        store = load_feature_store()
+    if store is None:
+        raise FileNotFoundError("No published feature store version to map")
+    state = build_model_state(store, state, load_only=True)
+    swap_model_state(state)
+    return state
+
+def _compute(version, user_id, k, predicates):
+    from recommendation.knn_recommendation import compute_media_for_user
+    _ensure_model_state(version)
+    return compute_media_for_user(user_id, k, **predicates)
+
+class RecommendationExecutor:
+    """
+    Runs recommendation compute in a pool of worker processes so concurrent
+    requests are not serialised behind the GIL of the server process. Workers
+    are spawned (the server runs threads) and memory map the same feature
+    store version as the server.
+
+    Concurrent identical jobs (same cache key) share one future. A request
+    waits at most deadline seconds, a late result still reaches on_done.
+    With queue_limit distinct jobs in flight new ones are refused.
+    """
+    def __init__(self, workers, deadline=RECOMMENDATION_DEADLINE, queue_limit=RECOMMENDATION_QUEUE_LIMIT):
+        self.workers = workers
+        self.deadline = deadline
+        self.queue_limit = queue_limit
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker)
+        self._inflight = {}  # key -> Future
+        self._lock = threading.Lock()
+        self.coalesced = self.rejected = self.timeouts = 0
+
+    def submit(self, key, version, user_id, k, predicates, on_done=None):
+        # Future of the job, None when the queue is full
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            if len(self._inflight) >= self.queue_limit:
+                self.rejected += 1
+                return None
+            future = self._pool.submit(_compute, version, user_id, k, predicates)
+            self._inflight[key] = future
+
+        def done(future):
+            with self._lock:
+                self._inflight.pop(key, None)
+            if on_done is not None and not future.cancelled() and future.exception() is None:
+                on_done(future.result())
+        future.add_done_callback(done)
+        return future
+
+    def run(self, key, version, user_id, k, predicates, on_done=None):
+        """
+        Result of the job, None when it was refused, missed the deadline or
+        failed in the worker.
+        """
+        future = self.submit(key, version, user_id, k, predicates, on_done)
+        if future is None:
+            print(f"Recommendation queue full ({self.queue_limit} jobs), job for user {user_id} refused")
+            return None
+        try:
+            return future.result(timeout=self.deadline)
+        except concurrent.futures.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            print(f"Recommendation for user {user_id} missed its {self.deadline}s deadline")
+        except Exception as e:
+            print(f"Recommendation worker failed for user {user_id}: {e}")
+        return None
+
+    def warm_up(self, version):
+        # Every worker maps the model before the first request, not during it
+        start = time.perf_counter()
+        futures = [self._pool.submit(_ensure_model_state_version, version) for _ in range(self.workers)]
+        concurrent.futures.wait(futures)
+        print(f"{self.workers} recommendation workers ready in {time.perf_counter() - start:.1f}s")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "inflight": len(self._inflight),
+                "coalesced": self.coalesced,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+            }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+def _ensure_model_state_version(version):
+    # Picklable warm up job, returns the version the worker serves
+    return _ensure_model_state(version).version
+
+def get_recommendation_executor():
+    return _executor
+
+def start_recommendation_executor(version, workers=RECOMMENDATION_WORKERS):
+    """
+    Starts the worker pool once the model is trained, a no-op when workers
+    is 0. Returns the executor or None.
+    """
+    global _executor
+    if workers <= 0:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = RecommendationExecutor(workers)
+    _executor.warm_up(version)
+    return _executor
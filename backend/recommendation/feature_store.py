@@ -0,0 +1,274 @@
+import json
+import os
+import shutil
+import numpy as np
+import scipy.sparse as sp
+
+# On disk layout:
+#   STORE_DIR/CURRENT                         name of the active version directory
+#   STORE_DIR/v<version>/base/features.npy    float32 matrix (media x genres)
+#   STORE_DIR/v<version>/base/media_ids.npy   fixed width bytes, one tconst per row
+#   STORE_DIR/v<version>/base/<column>.npy    per media columns (rating, votes...)
+#   STORE_DIR/v<version>/delta/...            same files for media added or changed
+#                                             since the base was written
+#   STORE_DIR/v<version>/tombstones.npy       base rows removed or superseded by the delta
+#   STORE_DIR/v<version>/meta.json            version, base version, genre vocabulary
+#   STORE_DIR/v<version>/popular.npy          most voted tconsts of the version
+#   STORE_DIR/v<version>/popular_by_genre.npy same per genre (genres x n, padded)
+#   STORE_DIR/v<version>/hybrid/base/         sparse hybrid features: CSR data, indices and
+#                                             indptr .npy, media ids, columns, creators
+#   STORE_DIR/v<version>/hybrid/delta/        same for media changed since the hybrid base,
+#                                             creators added to the vocabulary since
+#   STORE_DIR/v<version>/hybrid/tombstones.npy hybrid base rows superseded by its delta
+# Rows of each segment are sorted by tconst, so a tconst is found with a binary
+# search. A delta version hard links the base files of the previous version,
+# only the (small) delta and tombstones are written.
+# The .npy files are opened with mmap_mode='r', so every worker process maps
+# the same file and the OS page cache keeps a single copy of the catalog.
+STORE_DIR = os.getenv("FEATURE_STORE_DIR", "/app/cache/genre_store")
+CURRENT_FILE = "CURRENT"
+FEATURES_FILE = "features.npy"
+MEDIA_IDS_FILE = "media_ids.npy"
+TOMBSTONES_FILE = "tombstones.npy"
+META_FILE = "meta.json"
+POPULAR_FILE = "popular.npy"
+POPULAR_BY_GENRE_FILE = "popular_by_genre.npy"
+HYBRID_DIR = "hybrid"
+HYBRID_CSR_FILES = ("data.npy", "indices.npy", "indptr.npy")
+HYBRID_CREATORS_FILE = "creators.npy"
+BASE_DIR = "base"
+DELTA_DIR = "delta"
+FORMAT_VERSION = 5  # Bump when the layout changes, older stores get rebuilt
+KEEP_VERSIONS = 2  # Older versions may still be mapped by other workers
+# Per media columns stored with the genre and hybrid segments, the search filter predicates read them
+CATALOG_COLUMN_DTYPES = {
+    "average_rating": np.float32,
+    "num_votes": np.int64,
+    "is_adult": np.bool_,
+    "title_type": 'S16',
+}
+
+def _version_dir(version):
+    return os.path.join(STORE_DIR, f"v{version}")
+
+def get_current_version():
+    try:
+        with open(os.path.join(STORE_DIR, CURRENT_FILE), 'r') as f:
+            return int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        return None
+
+def store_exists():
+    version = get_current_version()
+    if version is None:
+        return False
+    try:
+        with open(os.path.join(_version_dir(version), META_FILE), 'r') as f:
+            return json.load(f).get("format") == FORMAT_VERSION
+    except (FileNotFoundError, ValueError):
+        return False
+
+def _write_segment(path, media_features, media_ids, columns):
+    os.makedirs(path)
+    np.save(os.path.join(path, FEATURES_FILE), np.asarray(media_features, dtype=np.float32))
+    np.save(os.path.join(path, MEDIA_IDS_FILE), np.asarray(media_ids, dtype=np.bytes_))
+    for name, values in columns.items():
+        np.save(os.path.join(path, f"{name}.npy"), np.asarray(values))
+
+def _link_segment(source, path):
+    os.makedirs(path)
+    for name in os.listdir(source):
+        try:
+            os.link(os.path.join(source, name), os.path.join(path, name))
+        except OSError:
+            shutil.copy2(os.path.join(source, name), os.path.join(path, name))
+
+def _read_segment(path, column_names):
+    media_features = np.load(os.path.join(path, FEATURES_FILE), mmap_mode='r')
+    media_ids = np.load(os.path.join(path, MEDIA_IDS_FILE), mmap_mode='r')
+    columns = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in column_names}
+    return media_features, media_ids, columns
+
+def _publish(version, meta, write):
+    # Everything is written to a temporary directory, renamed, then CURRENT is
+    # repointed atomically, readers see either the old or the new version
+    os.makedirs(STORE_DIR, exist_ok=True)
+    final_dir = _version_dir(version)
+    tmp_dir = final_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    write(tmp_dir)
+    with open(os.path.join(tmp_dir, META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.rename(tmp_dir, final_dir)
+    current_tmp = os.path.join(STORE_DIR, CURRENT_FILE + ".tmp")
+    with open(current_tmp, 'w') as f:
+        f.write(str(version))
+    os.replace(current_tmp, os.path.join(STORE_DIR, CURRENT_FILE))
+    _remove_old_versions(version)
+    return final_dir
+
+def save_feature_store(media_features, media_ids, all_genres, version, columns=None):
+    # Full store: everything in the base segment, empty delta
+    columns = columns or {}
+    n_genres = len(all_genres)
+    empty_columns = {name: np.asarray(values)[:0] for name, values in columns.items()}
+
+    def write(path):
+        _write_segment(os.path.join(path, BASE_DIR), media_features, media_ids, columns)
+        _write_segment(os.path.join(path, DELTA_DIR), np.zeros((0, n_genres), dtype=np.float32), [], empty_columns)
+        np.save(os.path.join(path, TOMBSTONES_FILE), np.zeros(0, dtype=np.int64))
+
+    meta = {
+        "format": FORMAT_VERSION,
+        "version": version,
+        "base_version": version,
+        "columns": sorted(columns),
+        "genres": list(all_genres),
+        "rows": len(media_ids),
+        "delta_rows": 0,
+        "tombstones": 0,
+    }
+    path = _publish(version, meta, write)
+    print(f"Feature store version {version} saved to {path}")
+    return path
+
+def save_feature_delta(version, previous_version, media_features, media_ids, columns, tombstones):
+    """
+    New version sharing the base of previous_version, with a new delta
+    segment and tombstoned base rows.
+    """
+    with open(os.path.join(_version_dir(previous_version), META_FILE), 'r') as f:
+        previous_meta = json.load(f)
+    tombstones = np.unique(np.asarray(tombstones, dtype=np.int64))
+
+    def write(path):
+        _link_segment(os.path.join(_version_dir(previous_version), BASE_DIR), os.path.join(path, BASE_DIR))
+        _write_segment(os.path.join(path, DELTA_DIR), media_features, media_ids, columns)
+        np.save(os.path.join(path, TOMBSTONES_FILE), tombstones)
+
+    meta = dict(previous_meta, version=version, delta_rows=len(media_ids), tombstones=len(tombstones))
+    path = _publish(version, meta, write)
+    print(f"Feature store delta version {version} saved to {path} ({len(media_ids)} delta rows, {len(tombstones)} tombstones)")
+    return path
+
+def save_popularity(version, popular_ids, popular_by_genre):
+    """
+    Popularity rankings of an already published version, written next to its
+    segments. Each file is renamed into place, a reader sees it whole or not at all.
+    """
+    path = _version_dir(version)
+    for name, values in ((POPULAR_FILE, popular_ids), (POPULAR_BY_GENRE_FILE, popular_by_genre)):
+        tmp_file = os.path.join(path, name + ".tmp.npy")
+        np.save(tmp_file, np.asarray(values, dtype=np.bytes_))
+        os.replace(tmp_file, os.path.join(path, name))
+
+def _load_popularity(path):
+    try:
+        return np.load(os.path.join(path, POPULAR_FILE)), np.load(os.path.join(path, POPULAR_BY_GENRE_FILE))
+    except FileNotFoundError:
+        return None
+
+def _write_hybrid_segment(path, matrix, media_ids, columns, creators):
+    _write_segment(path, np.zeros((0, 0), dtype=np.float32), media_ids, columns)
+    for name, values in zip(HYBRID_CSR_FILES, (matrix.data, matrix.indices, matrix.indptr)):
+        np.save(os.path.join(path, name), np.asarray(values))
+    np.save(os.path.join(path, HYBRID_CREATORS_FILE), np.asarray(creators, dtype=np.bytes_))
+
+def _read_hybrid_segment(path, column_names, shape):
+    _, media_ids, columns = _read_segment(path, column_names)
+    data, indices, indptr = (np.load(os.path.join(path, name), mmap_mode='r') for name in HYBRID_CSR_FILES)
+    matrix = sp.csr_matrix((data, indices, indptr), shape=tuple(shape), copy=False)
+    return matrix, media_ids, columns, np.load(os.path.join(path, HYBRID_CREATORS_FILE), mmap_mode='r')
+
+def save_hybrid_features(version, base, delta, tombstones, settings, base_source=None):
+    """
+    Sparse hybrid features of an already published version. base and delta
+    are (matrix, media_ids, columns, creators). The base files of version
+    base_source are hard linked when it still exists, so a delta version
+    only writes the changed rows. settings (block weights, buckets) are kept
+    in the meta file, features built with other settings are not loaded back.
+    """
+    final_dir = os.path.join(_version_dir(version), HYBRID_DIR)
+    tmp_dir = final_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    source = os.path.join(_version_dir(base_source), HYBRID_DIR, BASE_DIR) if base_source is not None else None
+    if source is not None and base_source != version and os.path.isdir(source):
+        _link_segment(source, os.path.join(tmp_dir, BASE_DIR))
+    else:
+        _write_hybrid_segment(os.path.join(tmp_dir, BASE_DIR), *base)
+    _write_hybrid_segment(os.path.join(tmp_dir, DELTA_DIR), *delta)
+    np.save(os.path.join(tmp_dir, TOMBSTONES_FILE), np.unique(np.asarray(tombstones, dtype=np.int64)))
+    with open(os.path.join(tmp_dir, META_FILE), 'w') as f:
+        json.dump({
+            "settings": settings,
+            "columns": sorted(base[2]),
+            "base_shape": list(base[0].shape),
+            "delta_shape": list(delta[0].shape),
+        }, f)
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.rename(tmp_dir, final_dir)
+
+def load_hybrid_features(version, settings):
+    """
+    Returns {"base": (matrix, media_ids, columns, creators), "delta": same,
+    "tombstones": base rows} memory mapped read only, or None.
+    """
+    path = os.path.join(_version_dir(version), HYBRID_DIR)
+    try:
+        with open(os.path.join(path, META_FILE), 'r') as f:
+            meta = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if meta["settings"] != settings:
+        return None
+    return {
+        "base": _read_hybrid_segment(os.path.join(path, BASE_DIR), meta["columns"], meta["base_shape"]),
+        "delta": _read_hybrid_segment(os.path.join(path, DELTA_DIR), meta["columns"], meta["delta_shape"]),
+        "tombstones": np.load(os.path.join(path, TOMBSTONES_FILE)),
+    }
+
+def load_feature_store(version=None):
+    """
+    Returns a dict with the genre vocabulary, the base and delta segments as
+    (media_features, media_ids, columns) memory mapped read only, the
+    tombstoned base rows and the popularity rankings (None if not written yet).
+    """
+    if version is None:
+        version = get_current_version()
+    if version is None:
+        return None
+    path = _version_dir(version)
+    with open(os.path.join(path, META_FILE), 'r') as f:
+        meta = json.load(f)
+
+    all_genres = meta["genres"]
+    return {
+        "version": meta["version"],
+        "base_version": meta["base_version"],
+        "all_genres": all_genres,
+        "genre_index": {genre: idx for idx, genre in enumerate(all_genres)},
+        "base": _read_segment(os.path.join(path, BASE_DIR), meta["columns"]),
+        "delta": _read_segment(os.path.join(path, DELTA_DIR), meta["columns"]),
+        "tombstones": np.load(os.path.join(path, TOMBSTONES_FILE)),
+        "popularity": _load_popularity(path),
+    }
+
+def _remove_old_versions(current_version):
+    versions = []
+    for name in os.listdir(STORE_DIR):
+        if name.startswith("v") and name[1:].isdigit():
+            versions.append(int(name[1:]))
+    for version in sorted(versions)[:-KEEP_VERSIONS]:
+        if version != current_version:
+            shutil.rmtree(_version_dir(version), ignore_errors=True)
+
+def delete_feature_store():
+    if os.path.exists(STORE_DIR):
+        shutil.rmtree(STORE_DIR)
+        print(f"Feature store {STORE_DIR} deleted.")
+    else:
+        print(f"Feature store {STORE_DIR} does not exist.")
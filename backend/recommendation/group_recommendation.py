@@ -0,0 +1,163 @@
+import heapq
+import itertools
+import os
+import numpy as np
+import scipy.sparse as sp
+import db.user_preferences
+from recommendation.model_state import get_model_state
+from recommendation.search_filter import SearchFilter
+from recommendation.diversity import diversify, candidate_count
+from recommendation.hybrid_features import POPULARITY_WEIGHT
+from recommendation.knn_recommendation import (
+    build_user_profiles, hybrid_user_profiles, recommend_popular_media, POPULAR_LIST_SIZE
+)
+
+# average: best on average, least_misery: best for the least happy member, max: best for the happiest member
+GROUP_STRATEGIES = ("average", "least_misery", "max")
+GROUP_STRATEGY = os.getenv("GROUP_STRATEGY", "average")
+
+def aggregate_distances(member_distances, strategy):
+    # member_distances: (candidates x members), lower is better for every strategy
+    if strategy == "least_misery":
+        return member_distances.max(axis=1)
+    if strategy == "max":
+        return member_distances.min(axis=1)
+    return member_distances.mean(axis=1)
+
+class GenreGroup:
+    # Member profiles of the genre knn, euclidean distances
+    def __init__(self, state, member_preferences, alpha=0.5, beta=7.0):
+        self.state = state
+        self.profiles = build_user_profiles(state, member_preferences, alpha, beta)
+        self.size = len(member_preferences)
+
+    def neighbors(self, search_filter, n):
+        # Top-n (distance, row) of every member profile, one call on the batch index
+        distances, rows = self.state.kneighbors(self.profiles, n, batch=True, search_filters=[search_filter] * self.size)
+        return [list(zip(member_distances.tolist(), member_rows.tolist())) for member_distances, member_rows in zip(distances, rows)]
+
+    def features(self, rows):
+        return self.state.feature_rows(rows).astype(np.float64)
+
+    def member_distances(self, rows):
+        features = self.features(rows)
+        return np.sqrt(np.maximum(
+            (features ** 2).sum(axis=1)[:, None] - 2 * features @ self.profiles.T + (self.profiles ** 2).sum(axis=1)[None, :], 0))
+
+    def media_id(self, row):
+        return self.state.media_id(row)
+
+class HybridGroup:
+    # Sparse member profiles of the hybrid engine, cosine distances
+    def __init__(self, hybrid, member_preferences):
+        self.hybrid = hybrid
+        self.profiles = sp.csr_matrix(hybrid_user_profiles(hybrid, member_preferences))
+        self.size = len(member_preferences)
+
+    def neighbors(self, search_filter, n):
+        # Top-n (distance, row) of every member profile, one sparse search
+        return self.hybrid.search(self.profiles, n, [search_filter] * self.size)
+
+    def features(self, rows):
+        return self.hybrid.feature_rows(rows)
+
+    def member_distances(self, rows):
+        # Same score as HybridIndex.search, for every candidate and member
+        return 1.0 - (self.hybrid.feature_rows(rows) @ self.profiles.T).toarray() - POPULARITY_WEIGHT * self.hybrid.popularity[rows][:, None]
+
+    def media_id(self, row):
+        return self.hybrid.media_id(row)
+
+def _load_group(member_ids, alpha=0.5, beta=7.0, **predicates):
+    """
+    (group, search_filter) for the members with preferences, None when no
+    member has any or no model is ready. Media rated by any member are
+    excluded from the search.
+    """
+    state = get_model_state()
+    preferences_by_user = db.user_preferences.get_preferences_for_users(member_ids)
+    member_preferences = [preferences_by_user[m] for m in member_ids if preferences_by_user.get(m)]
+    if not state or not member_preferences:
+        return None, None
+    rated = {preference.media_id for preferences in member_preferences for preference in preferences}
+    search_filter = SearchFilter(exclude_tconsts=rated, **predicates)
+    if state.hybrid is not None:
+        return HybridGroup(state.hybrid, member_preferences), search_filter
+    return GenreGroup(state, member_preferences, alpha, beta), search_filter
+
+def iter_group_candidates(group, search_filter, strategy, block=20):
+    """
+    Candidate rows as (aggregated distance, row), in exact strategy order.
+    The members' neighbor lists come from one batched top-n call and are read
+    block rows at a time in turns (threshold algorithm): every new row is
+    scored against all members, and is released once its aggregate is at
+    most the aggregate of the last distance read from each list, which no
+    unread row can beat. Lists are refetched twice as deep, again for all
+    members at once, when the next block runs past them.
+    """
+    # The more members, the deeper the lists are read before the threshold releases a block
+    n = candidate_count(block) * group.size
+    neighbors = group.neighbors(search_filter, n)
+    last = np.zeros(len(neighbors))
+    depth = 0
+    seen = set()
+    heap = []
+    while True:
+        rows = []
+        if depth + block > n and all(len(hits) == n for hits in neighbors):
+            n = max(2 * n, depth + block)
+            neighbors = group.neighbors(search_filter, n)
+            # Ties may reorder the rows already read, any that were not seen are scored now
+            rows = list(dict.fromkeys(row for hits in neighbors for _, row in hits[:depth] if row not in seen))
+            seen.update(rows)
+        exhausted = False
+        for member, member_hits in enumerate(neighbors):
+            hits = member_hits[depth:depth + block]
+            if len(hits) < block:
+                # Every list covers the same rows, all of them have been read
+                exhausted = True
+            if hits:
+                last[member] = hits[-1][0]
+            for _, row in hits:
+                if row not in seen:
+                    seen.add(row)
+                    rows.append(row)
+        depth += block
+        if rows:
+            rows = np.array(rows, dtype=np.int64)
+            for distance, row in zip(aggregate_distances(group.member_distances(rows), strategy).tolist(), rows.tolist()):
+                heapq.heappush(heap, (distance, row))
+        threshold = np.inf if exhausted else aggregate_distances(last[None, :], strategy)[0]
+        while heap and heap[0][0] <= threshold:
+            yield heapq.heappop(heap)
+        if exhausted:
+            return
+
+def iter_group_media(member_ids, page_size=20, strategy=None, **predicates):
+    """
+    One endless list for a room, yielded page by page as tconsts. Member
+    preferences come from one query, candidates come in the order of the
+    strategy (aggregated distance to the members), resumed for every page,
+    and each chunk is reordered for diversity before being dealt. Media
+    rated by any member are left out. Without preferences the popular media
+    are dealt.
+    """
+    strategy = strategy if strategy in GROUP_STRATEGIES else GROUP_STRATEGY
+    group, search_filter = _load_group(member_ids, **predicates)
+    if group is None:
+        popular, _ = recommend_popular_media(POPULAR_LIST_SIZE)
+        for start in range(0, len(popular), page_size):
+            yield popular[start:start + page_size]
+        return
+
+    candidates = iter_group_candidates(group, search_filter, strategy, page_size)
+    while True:
+        chunk = list(itertools.islice(candidates, candidate_count(page_size)))
+        if not chunk:
+            return
+        distances = np.array([distance for distance, _ in chunk])
+        rows = np.array([row for _, row in chunk], dtype=np.int64)
+        # Every fetched candidate is dealt, diversity only orders the chunk
+        rows = rows[diversify(distances, group.features(rows), len(rows))]
+        for start in range(0, len(rows), page_size):
+            yield [group.media_id(row) for row in rows[start:start + page_size].tolist()]
@@ -0,0 +1,380 @@
+import os
+import numpy as np
+import scipy.sparse as sp
+import db.media
+import db.creators
+from recommendation.feature_store import save_hybrid_features, load_hybrid_features, CATALOG_COLUMN_DTYPES
+
+# Weight of each feature block in the cosine similarity
+GENRE_WEIGHT = float(os.getenv("HYBRID_GENRE_WEIGHT", 1.0))
+CREATOR_WEIGHT = float(os.getenv("HYBRID_CREATOR_WEIGHT", 1.0))
+YEAR_WEIGHT = float(os.getenv("HYBRID_YEAR_WEIGHT", 0.5))
+RUNTIME_WEIGHT = float(os.getenv("HYBRID_RUNTIME_WEIGHT", 0.25))
+# Share of log(numVotes) added to the cosine score, breaks ties towards known media
+POPULARITY_WEIGHT = float(os.getenv("HYBRID_POPULARITY_WEIGHT", 0.05))
+
+YEAR_MIN = 1870
+YEAR_BUCKET_SIZE = 10  # decades
+YEAR_BUCKETS = 18
+RUNTIME_EDGES = [15, 30, 45, 60, 75, 90, 105, 120, 150, 180, 240]  # minutes
+RUNTIME_BUCKETS = len(RUNTIME_EDGES) + 1
+
+PAGE_SIZE = 10000
+SEARCH_BLOCK_ROWS = 65536
+SEARCH_BLOCK_ELEMENTS = 2**24  # rows * queries of one dense score block
+
+def hybrid_settings(genres):
+    return {
+        "genres": list(genres),
+        "weights": [GENRE_WEIGHT, CREATOR_WEIGHT, YEAR_WEIGHT, RUNTIME_WEIGHT],
+        "year": [YEAR_MIN, YEAR_BUCKET_SIZE, YEAR_BUCKETS],
+        "runtime": RUNTIME_EDGES,
+    }
+
+class HybridFeatureBuilder:
+    """
+    Builds the sparse hybrid matrix from batches of catalog media (with
+    startYear and runtimeMinutes) and their creators. Columns are
+    [genres | year buckets | runtime buckets | creators], creator_index is
+    the vocabulary already in use and grows as new creators are seen. Every
+    block is scaled to unit length times its weight, then each row is
+    normalized, so the dot product of two rows is a weighted cosine similarity.
+    """
+    def __init__(self, genre_index, creator_index=None):
+        self.genre_index = genre_index
+        self.creator_index = dict(creator_index or {})
+        self.new_creators = []
+        self.creator_offset = creator_offset(genre_index)
+        self.blocks = []
+        self.media_ids = []
+        self.columns = {name: [] for name in CATALOG_COLUMN_DTYPES}
+
+    def _creator_column(self, creator):
+        idx = self.creator_index.get(creator)
+        if idx is None:
+            idx = self.creator_index[creator] = len(self.creator_index)
+            self.new_creators.append(creator)
+        return self.creator_offset + idx
+    def add(self, media_batch, creators_by_tconst):
+        n = len(media_batch)
+        if n == 0:
+            return
+        genres = [media.genres or [] for media in media_batch]
+        creators = [creators_by_tconst.get(media.tconst, []) for media in media_batch]
+        years = np.array([media.startYear or 0 for media in media_batch], dtype=np.int64)
+        runtimes = np.array([media.runtimeMinutes or 0 for media in media_batch], dtype=np.int64)
+
+        # Flat (row, column, value) triplets per block
+        rows, columns, values = [], [], []
+
+        def add_block(lengths, block_columns, weight):
+            lengths = np.asarray(lengths, dtype=np.int64)
+            block_rows = np.repeat(np.arange(n), lengths)
+            rows.append(block_rows)
+            columns.append(np.asarray(block_columns, dtype=np.int64))
+            values.append(np.repeat(weight / np.sqrt(np.maximum(lengths, 1)), lengths))
+
+        genre_lengths = [len(media_genres) for media_genres in genres]
+        add_block(genre_lengths, [self.genre_index[genre] for media_genres in genres for genre in media_genres], GENRE_WEIGHT)
+
+        has_year = years > 0
+        year_buckets = np.clip((years - YEAR_MIN) // YEAR_BUCKET_SIZE, 0, YEAR_BUCKETS - 1)
+        add_block(has_year, len(self.genre_index) + year_buckets[has_year], YEAR_WEIGHT)
+
+        has_runtime = runtimes > 0
+        runtime_buckets = np.digitize(runtimes, RUNTIME_EDGES)
+        add_block(has_runtime, len(self.genre_index) + YEAR_BUCKETS + runtime_buckets[has_runtime], RUNTIME_WEIGHT)
+
+        creator_lengths = [len(media_creators) for media_creators in creators]
+        add_block(creator_lengths, [self._creator_column(c) for media_creators in creators for c in media_creators], CREATOR_WEIGHT)
+
+        self.blocks.append((np.concatenate(rows), np.concatenate(columns), np.concatenate(values).astype(np.float32), n))
+        self.media_ids.extend(media.tconst for media in media_batch)
+        self.columns["average_rating"].extend(media.averageRating or 0 for media in media_batch)
+        self.columns["num_votes"].extend(media.numVotes or 0 for media in media_batch)
+        self.columns["is_adult"].extend(bool(media.isAdult) for media in media_batch)
+        self.columns["title_type"].extend(media.titleType or '' for media in media_batch)
+
+    def finish(self):
+        """
+        Returns (matrix, media_ids, columns, new_creators) with rows sorted by
+        tconst, new_creators are the ones appended to creator_index.
+        """
+        n_columns = self.creator_offset + len(self.creator_index)
+        matrix = sp.vstack([
+            sp.csr_matrix((values, (rows, columns)), shape=(n, n_columns))
+            for rows, columns, values, n in self.blocks
+        ] or [sp.csr_matrix((0, n_columns), dtype=np.float32)], format='csr')
+        media_ids = np.asarray(self.media_ids, dtype=np.bytes_)
+        columns = {name: np.asarray(self.columns[name], dtype=dtype) for name, dtype in CATALOG_COLUMN_DTYPES.items()}
+        order = np.argsort(media_ids, kind='stable')
+        if not np.array_equal(order, np.arange(len(order))):
+            matrix, media_ids = matrix[order], media_ids[order]
+            columns = {name: values[order] for name, values in columns.items()}
+        return normalize_rows(matrix), media_ids, columns, np.asarray(self.new_creators, dtype=np.bytes_)
+
+def creator_offset(genre_index):
+    return len(genre_index) + YEAR_BUCKETS + RUNTIME_BUCKETS
+
+def normalize_rows(matrix):
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    scale = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+    return sp.csr_matrix(sp.diags(scale.astype(np.float32)) @ matrix, dtype=np.float32)
+
+def widen(matrix, n_columns):
+    # Same rows with room for creators added to the vocabulary since they were built
+    return sp.csr_matrix((matrix.data, matrix.indices, matrix.indptr), shape=(matrix.shape[0], n_columns))
+
+class HybridSegment:
+    """
+    CSR rows sorted by tconst with their catalog columns and the creators
+    the segment added to the vocabulary.
+    """
+    def __init__(self, matrix, media_ids, columns, creators):
+        self.matrix = matrix
+        self.media_ids = media_ids
+        self.columns = columns
+        self.creators = creators
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def lookup_rows(self, keys):
+        if len(self) == 0:
+            return np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=bool)
+        rows = np.minimum(np.searchsorted(self.media_ids, keys), len(self) - 1)
+        return rows, self.media_ids[rows] == keys
+
+class HybridIndex:
+    """
+    Sparse hybrid features of the catalog with an exact cosine top-k search.
+    Like the genre store, rows are a large base segment plus a small delta
+    of media changed since the base was built, base rows superseded by the
+    delta are masked out by live. Global rows are the base rows followed by
+    the delta rows. The CSR matrices are never densified: scores for a block
+    of rows come from one sparse product with the (sparse) query profiles,
+    only the running top-k survives between blocks.
+    source_version is the store version whose files hold the base segment.
+    """
+    def __init__(self, base, delta, genre_index, live=None, source_version=None, creator_index=None):
+        self.base = base
+        self.delta = delta
+        self.segments = [base, delta]
+        self.offsets = [0, len(base)]
+        self.genre_index = genre_index
+        self.live = live
+        self.source_version = source_version
+        self.n_columns = creator_offset(genre_index) + len(base.creators) + len(delta.creators)
+        self._creator_index = creator_index
+        votes = np.log1p(np.concatenate([np.asarray(segment.columns["num_votes"], dtype=np.float64)
+                                         for segment in self.segments]))
+        self.popularity = (votes / votes.max() if len(votes) and votes.max() > 0 else votes).astype(np.float32)
+
+    def __len__(self):
+        return len(self.base) + len(self.delta)
+
+    def lookup_rows(self, tconsts):
+        # Global rows of live tconsts, a delta row supersedes the base row
+        keys = np.asarray(tconsts, dtype=np.bytes_)
+        rows, found = self.base.lookup_rows(keys)
+        if self.live is not None and len(self.base):
+            found &= self.live[rows]
+        delta_rows, in_delta = self.delta.lookup_rows(keys)
+        return np.where(in_delta, len(self.base) + delta_rows, rows), found | in_delta
+
+    def feature_rows(self, rows):
+        # CSR rows in the order given, across both segments
+        rows = np.asarray(rows, dtype=np.int64)
+        pieces, positions = [], []
+        for offset, segment in zip(self.offsets, self.segments):
+            in_segment = np.flatnonzero((rows >= offset) & (rows < offset + len(segment)))
+            pieces.append(widen(segment.matrix[rows[in_segment] - offset], self.n_columns))
+            positions.append(in_segment)
+        return sp.vstack(pieces, format='csr')[np.argsort(np.concatenate(positions), kind='stable')]
+
+    def profile(self, tconsts, weights):
+        # Weighted sum of the rated media rows, media outside the catalog are skipped
+        return self.profiles([tconsts], [weights])
+
+    def profiles(self, tconsts_by_user, weights_by_user):
+        # One profile row per user, every rated media of every user looked up at once
+        users = np.repeat(np.arange(len(tconsts_by_user)), [len(tconsts) for tconsts in tconsts_by_user])
+        tconsts = [tconst for user_tconsts in tconsts_by_user for tconst in user_tconsts]
+        weights = np.array([weight for user_weights in weights_by_user for weight in user_weights], dtype=np.float32)
+        rows, found = self.lookup_rows(tconsts)
+        if not found.any():
+            return sp.csr_matrix((len(tconsts_by_user), self.n_columns), dtype=np.float32)
+        n_found = int(found.sum())
+        user_weights = sp.csr_matrix((weights[found], (users[found], np.arange(n_found))), shape=(len(tconsts_by_user), n_found))
+        return normalize_rows(user_weights @ self.feature_rows(rows[found]))
+
+    def _excluded_rows(self, search_filter):
+        if search_filter is None or not search_filter.exclude_tconsts:
+            return np.zeros(0, dtype=np.int64)
+        rows, found = self.lookup_rows(search_filter.exclude_tconsts)
+        return rows[found]
+
+    def _allowed_mask(self, segment, search_filter):
+        # None when every row of the segment may be returned
+        mask = None
+        if search_filter is not None and search_filter.has_predicates():
+            mask = search_filter.predicate_mask(segment.columns, len(segment))
+        if segment is self.base and self.live is not None:
+            mask = self.live.copy() if mask is None else mask & self.live
+        return mask
+
+    def search(self, profiles, k, search_filters=None):
+        """
+        Top-k rows by cosine similarity (+ POPULARITY_WEIGHT * popularity) for
+        every profile row, honoring one SearchFilter per query. Returns lists
+        of (distance, row) with distance = 1 - score, ascending.
+        """
+        profiles = widen(sp.csr_matrix(profiles, dtype=np.float32), self.n_columns)
+        n_queries = profiles.shape[0]
+        search_filters = search_filters or [None] * n_queries
+        excluded = [self._excluded_rows(f) for f in search_filters]
+        k = min(k, len(self))
+        profiles_t = profiles.T.tocsr()
+        block_rows = max(k, min(SEARCH_BLOCK_ROWS, SEARCH_BLOCK_ELEMENTS // max(n_queries, 1)))
+        best_scores = np.full((0, n_queries), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((0, n_queries), dtype=np.int64)
+
+        for offset, segment in zip(self.offsets, self.segments):
+            allowed = [self._allowed_mask(segment, f) for f in search_filters]
+            # Segment columns stop at the creators it knew about
+            segment_profiles = profiles_t[:segment.matrix.shape[1]].tocsc()
+            for start in range(0, len(segment), block_rows):
+                end = min(start + block_rows, len(segment))
+                scores = (segment.matrix[start:end] @ segment_profiles).toarray()
+                scores += POPULARITY_WEIGHT * self.popularity[offset + start:offset + end, None]
+                for query, (query_allowed, query_excluded) in enumerate(zip(allowed, excluded)):
+                    if query_allowed is not None:
+                        scores[~query_allowed[start:end], query] = -np.inf
+                    in_block = query_excluded[(query_excluded >= offset + start) & (query_excluded < offset + end)]
+                    scores[in_block - offset - start, query] = -np.inf
+                scores = np.concatenate([best_scores, scores])
+                rows = np.concatenate([best_rows, np.broadcast_to(np.arange(offset + start, offset + end)[:, None],
+                                                                  (end - start, n_queries))])
+                if len(scores) > k:
+                    keep = np.argpartition(-scores, k - 1, axis=0)[:k]
+                    scores = np.take_along_axis(scores, keep, axis=0)
+                    rows = np.take_along_axis(rows, keep, axis=0)
+                best_scores, best_rows = scores, rows
+
+        hits = []
+        for query in range(n_queries):
+            order = np.lexsort((best_rows[:, query], -best_scores[:, query]))
+            hits.append([
+                (1.0 - float(best_scores[i, query]), int(best_rows[i, query]))
+                for i in order if np.isfinite(best_scores[i, query])
+            ])
+        return hits
+
+    def media_id(self, row):
+        if row >= len(self.base):
+            return self.delta.media_ids[row - len(self.base)].decode()
+        return self.base.media_ids[row].decode()
+
+    def creator_index(self):
+        # Built on the first update only, later indexes inherit the grown one
+        if self._creator_index is None:
+            creators = np.concatenate([np.asarray(self.base.creators), np.asarray(self.delta.creators)])
+            self._creator_index = {creator.decode(): idx for idx, creator in enumerate(creators.tolist())}
+        return self._creator_index
+
+    def updated(self, changed_tconsts):
+        """
+        New index with the changed tconsts re-read from the database: the
+        delta is rebuilt from its unchanged rows plus the current catalog
+        media, their base rows are tombstoned. The base is shared, only the
+        changed media are fetched.
+        """
+        changed = sorted(set(changed_tconsts))
+        changed_keys = np.asarray(changed, dtype=np.bytes_)
+        media_list = [
+            media for media in db.media.get_media_features_by_tconsts(changed, details=True, batch_size=PAGE_SIZE)
+            if db.media.is_catalog_media(media) and all(genre in self.genre_index for genre in media.genres)
+        ]
+        builder = HybridFeatureBuilder(self.genre_index, self.creator_index())
+        builder.add(media_list, db.creators.get_creators_by_tconsts([media.tconst for media in media_list]))
+        new_matrix, new_ids, new_columns, new_creators = builder.finish()
+
+        kept = np.flatnonzero(~np.isin(np.asarray(self.delta.media_ids), changed_keys))
+        matrix = sp.vstack([widen(self.delta.matrix[kept], new_matrix.shape[1]), new_matrix], format='csr')
+        media_ids = np.concatenate([np.asarray(self.delta.media_ids)[kept], new_ids]).astype(np.bytes_)
+        columns = {name: np.concatenate([np.asarray(self.delta.columns[name])[kept], new_columns[name]])
+                   for name in new_columns}
+        order = np.argsort(media_ids, kind='stable')
+        delta = HybridSegment(matrix[order], media_ids[order], {name: values[order] for name, values in columns.items()},
+                              np.concatenate([np.asarray(self.delta.creators, dtype=np.bytes_), new_creators]))
+
+        live = np.ones(len(self.base), dtype=bool) if self.live is None else self.live.copy()
+        base_rows, in_base = self.base.lookup_rows(changed_keys)
+        live[base_rows[in_base]] = False
+        return HybridIndex(self.base, delta, self.genre_index, None if live.all() else live, self.source_version,
+                           builder.creator_index)
+
+    def compacted(self):
+        # Live base rows and the delta merged into a new base, the delta left empty
+        live = np.flatnonzero(self.live) if self.live is not None else np.arange(len(self.base))
+        matrix = sp.vstack([widen(self.base.matrix[live], self.n_columns), self.delta.matrix], format='csr')
+        media_ids = np.concatenate([np.asarray(self.base.media_ids)[live], np.asarray(self.delta.media_ids)]).astype(np.bytes_)
+        order = np.argsort(media_ids, kind='stable')
+        columns = {
+            name: np.concatenate([np.asarray(self.base.columns[name])[live], np.asarray(self.delta.columns[name])])[order]
+            for name in self.base.columns
+        }
+        creators = np.concatenate([np.asarray(self.base.creators), np.asarray(self.delta.creators)]).astype(np.bytes_)
+        return HybridIndex(HybridSegment(matrix[order], media_ids[order], columns, creators),
+                           empty_segment(self.n_columns, columns), self.genre_index, creator_index=self._creator_index)
+
+def empty_segment(n_columns, columns):
+    return HybridSegment(sp.csr_matrix((0, n_columns), dtype=np.float32), np.zeros(0, dtype='S1'),
+                         {name: np.asarray(values)[:0] for name, values in columns.items()}, np.zeros(0, dtype='S1'))
+
+def build_hybrid_index(all_genres, genre_index):
+    # Streams the catalog in tconst order with its creators, one query each per page
+    builder = HybridFeatureBuilder(genre_index)
+    for media_batch in db.media.iter_catalog_media(PAGE_SIZE, details=True):
+        media_batch = [media for media in media_batch if all(genre in genre_index for genre in media.genres)]
+        builder.add(media_batch, db.creators.get_creators_by_tconsts([media.tconst for media in media_batch]))
+    matrix, media_ids, columns, creators = builder.finish()
+    print(f"Hybrid features built: {matrix.shape[0]} media x {matrix.shape[1]} columns, "
+          f"{len(creators)} creators, {matrix.nnz} non zeros")
+    return HybridIndex(HybridSegment(matrix, media_ids, columns, creators), empty_segment(matrix.shape[1], columns),
+                       genre_index, creator_index=builder.creator_index)
+
+def _segment_arrays(segment):
+    return segment.matrix, segment.media_ids, segment.columns, segment.creators
+
+def load_or_build_hybrid_index(version, all_genres, genre_index, hybrid=None, compact=False, load_only=False):
+    """
+    Hybrid index for a feature store version: the one given (already updated
+    by the caller, merged into a new base when compact), the one stored with
+    the version, or a full build. Whatever was not loaded is saved with the
+    version, sharing the base files of the version it came from, and served
+    memory mapped from there. load_only raises FileNotFoundError instead of
+    building when nothing is stored.
+    """
+    settings = hybrid_settings(all_genres)
+    if hybrid is None:
+        stored = load_hybrid_features(version, settings)
+        if stored is not None:
+            return hybrid_index_from_store(stored, genre_index, version)
+        if load_only:
+            raise FileNotFoundError(f"No hybrid features stored for version {version}")
+        hybrid = build_hybrid_index(all_genres, genre_index)
+    elif compact:
+        hybrid = hybrid.compacted()
+    tombstones = np.flatnonzero(~hybrid.live) if hybrid.live is not None else np.zeros(0, dtype=np.int64)
+    save_hybrid_features(version, _segment_arrays(hybrid.base), _segment_arrays(hybrid.delta), tombstones,
+                         settings, hybrid.source_version)
+    return hybrid_index_from_store(load_hybrid_features(version, settings), genre_index, version, hybrid._creator_index)
+
+def hybrid_index_from_store(stored, genre_index, version, creator_index=None):
+    live = None
+    if len(stored["tombstones"]):
+        live = np.ones(len(stored["base"][1]), dtype=bool)
+        live[stored["tombstones"]] = False
+    return HybridIndex(HybridSegment(*stored["base"]), HybridSegment(*stored["delta"]), genre_index, live, version,
+                       creator_index)
@@ -0,0 +1,134 @@
+import os
+import time
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+from recommendation.knn_index import KNNIndex, expanding_neighbors
+from recommendation.signature_knn import SignatureKNN
+from recommendation.ivf_index import IVFIndex
+from recommendation.brute_force_knn import BruteForceKNN
+from recommendation.sharded_index import ShardedIndex
+
+# Index backend used for genre knn: signature (exact, default), brute (exact, BLAS),
+# sklearn (exact) or ivf (approximate)
+KNN_INDEX = os.getenv("KNN_INDEX", "signature")
+KNN_IVF_LISTS = int(os.getenv("KNN_IVF_LISTS", 0)) or None  # Default: sqrt(number of media)
+KNN_IVF_PROBES = int(os.getenv("KNN_IVF_PROBES", 16))
+# Sampled queries of the recall/latency report after each full index build in the server, 0 disables it
+KNN_BENCHMARK_QUERIES = int(os.getenv("KNN_BENCHMARK_QUERIES", 100))
+# Partitions of the genre index, each with its own KNN_INDEX backend; 1 keeps a single index
+KNN_SHARDS = int(os.getenv("KNN_SHARDS", 1))
+KNN_SHARD_BY = os.getenv("KNN_SHARD_BY", "hash")  # hash (tconst), range (tconst order) or popularity (vote tiers)
+
+class SklearnKNN(KNNIndex):
+    # The previous NearestNeighbors engine, kept as a reference backend
+    def __init__(self, n_neighbors=50):
+        self.n_neighbors = n_neighbors
+        self.knn = NearestNeighbors(n_neighbors=n_neighbors, metric='euclidean')
+
+    def fit(self, media_features):
+        self.n_samples = len(media_features)
+        self.knn.fit(media_features)
+        return self
+
+    def kneighbors(self, X, n_neighbors=None):
+        n_neighbors = min(n_neighbors or self.n_neighbors, self.n_samples)
+        return self.knn.kneighbors(np.atleast_2d(X), n_neighbors=n_neighbors)
+
+    def iter_neighbors(self, query):
+        def search(query, n):
+            distances, rows = self.knn.kneighbors([query], n_neighbors=n)
+            return distances[0], rows[0]
+        return expanding_neighbors(search, query, self.n_samples, self.n_neighbors)
+
+def create_index(backend, n_neighbors=50):
+    if backend == "signature":
+        return SignatureKNN(n_neighbors=n_neighbors)
+    if backend == "brute":
+        return BruteForceKNN(n_neighbors=n_neighbors)
+    if backend == "sklearn":
+        return SklearnKNN(n_neighbors=n_neighbors)
+    if backend == "ivf":
+        return IVFIndex(n_neighbors=n_neighbors, n_lists=KNN_IVF_LISTS, n_probe=KNN_IVF_PROBES)
+    raise ValueError(f"Unknown KNN_INDEX backend: {backend}")
+
+def build_genre_index(media_features, backend=None, n_neighbors=50, shards=None, media_ids=None, num_votes=None,
+                      benchmark_queries=None):
+    """
+    media_ids and num_votes are only used to partition a sharded index
+    (shards > 1) by tconst hash or popularity tier. benchmark_queries
+    defaults to KNN_BENCHMARK_QUERIES, 0 skips the report.
+    """
+    backend = backend or KNN_INDEX
+    shards = shards or KNN_SHARDS
+    benchmark_queries = KNN_BENCHMARK_QUERIES if benchmark_queries is None else benchmark_queries
+    start = time.perf_counter()
+    if shards > 1:
+        index = ShardedIndex(lambda n: create_index(backend, n), shards, KNN_SHARD_BY, n_neighbors)
+        index.fit(media_features, media_ids, num_votes)
+    else:
+        index = create_index(backend, n_neighbors).fit(media_features)
+    label = f"{backend} x{shards} shards" if shards > 1 else backend
+    print(f"Built {label} genre index in {time.perf_counter() - start:.2f}s")
+
+    index.report = None
+    if benchmark_queries > 0 and len(media_features) > 0:
+        exact = index if backend == "signature" and shards <= 1 else SignatureKNN(n_neighbors).fit(media_features)
+        index.report = benchmark_index(index, exact, media_features, benchmark_queries, n_neighbors)
+        report = index.report
+        print(
+            f"Genre index {label}: recall@{report['k']}={report['recall']:.4f}, "
+            f"p50={report['p50_ms']:.2f}ms, p99={report['p99_ms']:.2f}ms "
+            f"(exact p50={report['exact_p50_ms']:.2f}ms, p99={report['exact_p99_ms']:.2f}ms)"
+        )
+    return index
+
+def sample_profiles(media_features, n_queries, seed=0):
+    # Profile like queries: rating weighted sums of a few random media
+    rng = np.random.default_rng(seed)
+    n_samples = len(media_features)
+    queries = np.zeros((n_queries, media_features.shape[1]))
+    for i in range(n_queries):
+        rows = np.sort(rng.choice(n_samples, size=min(int(rng.integers(1, 20)), n_samples), replace=False))
+        ratings = rng.uniform(1, 10, size=len(rows))
+        queries[i] = ratings @ np.asarray(media_features[rows], dtype=np.float64)
+    return queries
+
+def _timed_kneighbors(index, queries, k):
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        _, rows = index.kneighbors([query], n_neighbors=k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append(rows[0])
+    return results, np.array(latencies)
+
+def benchmark_index(index, exact_index, media_features, n_queries=100, k=50):
+    """
+    Recall@k of index against exact_index and p50/p99 query latency of both
+    on sampled profile queries.
+    """
+    queries = sample_profiles(media_features, n_queries)
+    found, latencies = _timed_kneighbors(index, queries, k)
+    expected, exact_latencies = _timed_kneighbors(exact_index, queries, k)
+
+    # Ties make row ids ambiguous, count a hit when the distance is within the exact k-th distance
+    hits = 0
+    total = 0
+    for query, rows, exact_rows in zip(queries, found, expected):
+        if len(exact_rows) == 0:
+            continue
+        exact_kth = np.sqrt(((np.asarray(media_features[exact_rows[-1]], dtype=np.float64) - query) ** 2).sum())
+        distances = np.sqrt(((np.asarray(media_features[np.sort(rows)], dtype=np.float64) - query) ** 2).sum(axis=1))
+        hits += min(int((distances <= exact_kth + 1e-6).sum()), len(exact_rows))
+        total += len(exact_rows)
+
+    return {
+        "k": k,
+        "queries": len(queries),
+        "recall": hits / total if total else 1.0,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "exact_p50_ms": float(np.percentile(exact_latencies, 50)),
+        "exact_p99_ms": float(np.percentile(exact_latencies, 99)),
+    }
@@ -0,0 +1,280 @@
+import os
+import threading
+import numpy as np
+import scipy.sparse as sp
+
+ITEM_CF_NEIGHBORS = int(os.getenv("ITEM_CF_NEIGHBORS", 50))
+ITEM_CF_CHUNK = 1024  # Items per sparse similarity product
+ITEM_CF_REFRESH_SECONDS = float(os.getenv("ITEM_CF_REFRESH_SECONDS", 5))  # Pending rating writes are applied this often
+
+_item_cf = None  # ItemCF served to requests, None until trained
+_item_cf_lock = threading.Lock()
+
+def top_neighbors(items, neighbors, sims, n_neighbors):
+    """
+    Best n_neighbors (neighbor, sim) of every item in flat triplets, ties
+    broken by neighbor row. Returns (items, neighbor_rows, neighbor_sims)
+    with one list per distinct item, padded with (-1, 0).
+    """
+    order = np.lexsort((neighbors, -sims, items))
+    items, neighbors, sims = items[order], neighbors[order], sims[order]
+    unique_items, first, counts = np.unique(items, return_index=True, return_counts=True)
+    rank = np.arange(len(items)) - np.repeat(first, counts)
+    keep = rank < n_neighbors
+    position = np.repeat(np.arange(len(unique_items)), counts)[keep]
+    neighbor_rows = np.full((len(unique_items), n_neighbors), -1, dtype=np.int32)
+    neighbor_sims = np.zeros((len(unique_items), n_neighbors), dtype=np.float32)
+    neighbor_rows[position, rank[keep]] = neighbors[keep]
+    neighbor_sims[position, rank[keep]] = sims[keep]
+    return unique_items, neighbor_rows, neighbor_sims
+
+class ItemNeighbors:
+    """
+    What recommend() reads: item ids and the (items x n_neighbors) neighbor
+    arrays. Never modified, refresh() builds a new one and replaces it.
+    """
+    def __init__(self, item_index, item_ids, neighbor_rows, neighbor_sims):
+        self.item_index = item_index
+        self.item_ids = item_ids
+        self.neighbor_rows = neighbor_rows
+        self.neighbor_sims = neighbor_sims
+
+class ItemCF:
+    """
+    Item-item collaborative filtering on the sparse user x item matrix of
+    user_preferences. Ratings are centered on each user's mean (adjusted
+    cosine) and every item keeps its n_neighbors most similar items in two
+    (items x n_neighbors) arrays, rows padded with -1. Similarities come
+    from chunked sparse products C[:, chunk].T @ C, so the cost follows the
+    number of co-ratings instead of users x items.
+
+    Rating writes are queued with record() and applied by refresh(), every
+    ITEM_CF_REFRESH_SECONDS on a background thread: the matrix gets one
+    sparse delta and only items rated by the changed users are recomputed,
+    their new similarities are patched into the lists of the other items. A
+    patched list can miss a replacement for a neighbor that dropped out
+    until the next fit.
+    """
+    def __init__(self, n_neighbors=ITEM_CF_NEIGHBORS, chunk_size=ITEM_CF_CHUNK):
+        self.n_neighbors = n_neighbors
+        self.chunk_size = chunk_size
+        self.user_index = {}
+        self.ratings = sp.csr_matrix((0, 0), dtype=np.float32)
+        self.neighbors = ItemNeighbors({}, [], np.full((0, n_neighbors), -1, dtype=np.int32),
+                                       np.zeros((0, n_neighbors), dtype=np.float32))
+        self._pending = {}  # (user_id, tconst) -> rating, None when deleted
+        self._lock = threading.Lock()  # pending writes
+        self._refresh_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def _user_row(self, user_id):
+        return self.user_index.setdefault(user_id, len(self.user_index))
+
+    def _resize(self, n_items):
+        # New users and items get empty matrix rows and columns
+        n_users = len(self.user_index)
+        if self.ratings.shape != (n_users, n_items):
+            R = self.ratings
+            self.ratings = sp.csr_matrix((R.data, R.indices, np.concatenate([R.indptr, np.full(n_users - R.shape[0], R.indptr[-1])])),
+                                         shape=(n_users, n_items))
+
+    def fit(self, preference_batches):
+        # preference_batches: iterable of [(user_id, tconst, rating), ...]
+        item_index, item_ids = {}, []
+        users, items, ratings = [], [], []
+        for batch in preference_batches:
+            for user_id, tconst, rating in batch:
+                item = item_index.get(tconst)
+                if item is None:
+                    item = item_index[tconst] = len(item_ids)
+                    item_ids.append(tconst)
+                users.append(self._user_row(user_id))
+                items.append(item)
+                ratings.append(rating)
+        users, items = np.asarray(users, dtype=np.int64), np.asarray(items, dtype=np.int64)
+        # A duplicated (user, item) keeps its last rating
+        _, last = np.unique((users * max(len(item_ids), 1) + items)[::-1], return_index=True)
+        keep = len(users) - 1 - last
+        self.ratings = sp.csr_matrix(
+            (np.asarray(ratings, dtype=np.float32)[keep], (users[keep], items[keep])),
+            shape=(len(self.user_index), len(item_ids)),
+        )
+        neighbor_rows = np.full((len(item_ids), self.n_neighbors), -1, dtype=np.int32)
+        neighbor_sims = np.zeros((len(item_ids), self.n_neighbors), dtype=np.float32)
+        for triplets in self._similarities(np.arange(len(item_ids))):
+            rows, chunk_rows, chunk_sims = top_neighbors(*triplets, self.n_neighbors)
+            neighbor_rows[rows], neighbor_sims[rows] = chunk_rows, chunk_sims
+        self.neighbors = ItemNeighbors(item_index, item_ids, neighbor_rows, neighbor_sims)
+        print(f"ItemCF fitted: {len(self.user_index)} users, {len(item_ids)} items, {self.ratings.nnz} ratings")
+        return self
+
+    def _centered(self):
+        R = self.ratings.tocsr()
+        counts = np.diff(R.indptr)
+        means = np.asarray(R.sum(axis=1)).ravel() / np.maximum(counts, 1)
+        C = R.astype(np.float32, copy=True)
+        C.data -= np.repeat(means, counts).astype(np.float32)
+        norms = np.sqrt(np.asarray(C.multiply(C).sum(axis=0)).ravel())
+        inverse_norms = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+        return C, inverse_norms
+
+    def _similarities(self, item_rows):
+        """
+        Yields, chunk by chunk, (items, neighbors, sims) triplets of the
+        positive similarities of item_rows with every other item. Only
+        positively correlated items are useful neighbors.
+        """
+        C, inverse_norms = self._centered()
+        C_items = C.T.tocsr()
+        C = C.tocsc()
+        for start in range(0, len(item_rows), self.chunk_size):
+            rows = item_rows[start:start + self.chunk_size]
+            S = sp.coo_matrix(sp.diags(inverse_norms[rows]) @ (C_items[rows] @ C) @ sp.diags(inverse_norms))
+            items = rows[S.row]
+            keep = (S.col != items) & (S.data > 0)
+            yield items[keep], S.col[keep].astype(np.int64), S.data[keep].astype(np.float32)
+
+    def _patch_neighbors(self, neighbor_rows, neighbor_sims, dirty, items, neighbors, sims):
+        """
+        Rewrites the lists of the other items that hold a dirty item or that
+        a dirty item now enters: their non dirty neighbors keep their
+        similarity, dirty items come from the new (symmetric) similarities.
+        """
+        is_dirty = np.zeros(len(neighbor_rows), dtype=bool)
+        is_dirty[dirty] = True
+        entering = ~is_dirty[neighbors]
+        new_rows, new_neighbors, new_sims = neighbors[entering], items[entering], sims[entering]
+
+        listed = (neighbor_rows >= 0) & is_dirty[np.maximum(neighbor_rows, 0)]
+        touched = np.union1d(np.flatnonzero(listed.any(axis=1) & ~is_dirty), new_rows)
+        old_rows, old_sims = neighbor_rows[touched], neighbor_sims[touched]
+        kept = (old_rows >= 0) & ~is_dirty[np.maximum(old_rows, 0)]
+        rows, patched_rows, patched_sims = top_neighbors(
+            np.concatenate([np.repeat(touched, self.n_neighbors)[kept.ravel()], new_rows]),
+            np.concatenate([old_rows[kept].astype(np.int64), new_neighbors]),
+            np.concatenate([old_sims[kept], new_sims]),
+            self.n_neighbors,
+        )
+        neighbor_rows[touched], neighbor_sims[touched] = -1, 0
+        neighbor_rows[rows], neighbor_sims[rows] = patched_rows, patched_sims
+        return len(touched)
+
+    def record(self, user_id, tconst, rating=None):
+        # rating None records a deletion, applied on the next refresh()
+        with self._lock:
+            self._pending[(user_id, tconst)] = rating
+
+    def refresh(self):
+        with self._refresh_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            try:
+                self._apply(pending)
+            except Exception:
+                # Writes recorded meanwhile are newer
+                with self._lock:
+                    self._pending = {**pending, **self._pending}
+                raise
+
+    def _apply(self, pending):
+        current = self.neighbors
+        item_index, item_ids = current.item_index, current.item_ids
+        new_items = list(dict.fromkeys(tconst for _, tconst in pending if tconst not in item_index))
+        if new_items:
+            # Copies, requests keep reading the current snapshot
+            item_index = dict(item_index)
+            item_index.update((tconst, len(item_ids) + i) for i, tconst in enumerate(new_items))
+            item_ids = item_ids + new_items
+        users = np.array([self._user_row(user_id) for user_id, _ in pending], dtype=np.int64)
+        items = np.array([item_index[tconst] for _, tconst in pending], dtype=np.int64)
+        self._resize(len(item_ids))
+        new = np.array([np.nan if rating is None else rating for rating in pending.values()], dtype=np.float64)
+        old = np.asarray(self.ratings[users, items]).ravel().astype(np.float64)
+        delta = np.where(np.isnan(new), -old, new - old)
+        self.ratings = (self.ratings + sp.csr_matrix((delta.astype(np.float32), (users, items)), shape=self.ratings.shape)).tocsr()
+        self.ratings.eliminate_zeros()
+
+        # A new rating moves the user's mean, every item the user rated is affected
+        changed_users = np.unique(users)
+        R = self.ratings
+        dirty = np.unique(np.concatenate([items] + [R.indices[R.indptr[u]:R.indptr[u + 1]] for u in changed_users]))
+        triplets = [np.concatenate(parts) for parts in zip(*self._similarities(dirty))]
+
+        padding = len(item_ids) - len(current.neighbor_rows)
+        neighbor_rows = np.concatenate([current.neighbor_rows, np.full((padding, self.n_neighbors), -1, dtype=np.int32)])
+        neighbor_sims = np.concatenate([current.neighbor_sims, np.zeros((padding, self.n_neighbors), dtype=np.float32)])
+        neighbor_rows[dirty], neighbor_sims[dirty] = -1, 0
+        rows, dirty_rows, dirty_sims = top_neighbors(*triplets, self.n_neighbors)
+        neighbor_rows[rows], neighbor_sims[rows] = dirty_rows, dirty_sims
+        patched = self._patch_neighbors(neighbor_rows, neighbor_sims, dirty, *triplets)
+
+        self.neighbors = ItemNeighbors(item_index, item_ids, neighbor_rows, neighbor_sims)
+        print(f"ItemCF refreshed: {len(pending)} rating changes, {len(dirty)} items recomputed, {patched} lists patched")
+
+    def start_refresher(self, interval=ITEM_CF_REFRESH_SECONDS):
+        # Rating writes are applied off the request path, until stop()
+        def run():
+            while not self._stopped.wait(interval):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"ItemCF refresh failed: {e}")
+        threading.Thread(target=run, name="item-cf-refresh", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def recommend(self, preferences, k, allowed=None):
+        """
+        preferences: [(tconst, rating), ...] of one user.
+        Candidates are the neighbors of the rated items, scored by the sum of
+        similarity * centered rating. allowed(tconsts) returns a mask of the
+        candidates that may be returned. Returns [(tconst, score)] best first.
+        """
+        if not preferences:
+            return []
+        neighbors = self.neighbors
+        tconsts, ratings = zip(*preferences)
+        ratings = np.asarray(ratings, dtype=np.float64)
+        # A single rating (or all equal) carries no preference direction, weight them equally
+        weights = ratings - ratings.mean() if np.ptp(ratings) > 0 else np.ones(len(ratings))
+        rows = np.array([neighbors.item_index.get(tconst, -1) for tconst in tconsts], dtype=np.int64)
+        known = rows >= 0
+        neighbor_rows = neighbors.neighbor_rows[rows[known]]
+        neighbor_weights = neighbors.neighbor_sims[rows[known]] * weights[known][:, None]
+        valid = neighbor_rows >= 0
+        candidates, inverse = np.unique(neighbor_rows[valid], return_inverse=True)
+        scores = np.bincount(inverse, weights=neighbor_weights[valid], minlength=len(candidates))
+
+        keep = ~np.isin(candidates, rows[known]) & (scores > 0)
+        candidates, scores = candidates[keep], scores[keep]
+        candidate_ids = [neighbors.item_ids[row] for row in candidates.tolist()]
+        if allowed is not None and len(candidate_ids):
+            mask = allowed(candidate_ids)
+            candidate_ids = [tconst for tconst, ok in zip(candidate_ids, mask) if ok]
+            scores = scores[mask]
+        order = np.lexsort((np.asarray(candidate_ids), -scores))[:k]
+        return [(candidate_ids[i], float(scores[i])) for i in order]
+
+def get_item_cf():
+    return _item_cf
+
+def set_item_cf(item_cf):
+    # The new model applies rating writes from now on, the previous one stops
+    global _item_cf
+    with _item_cf_lock:
+        previous, _item_cf = _item_cf, item_cf
+    if previous is not None:
+        previous.stop()
+    if item_cf is not None:
+        item_cf.start_refresher()
+    return item_cf
+
+def record_rating(user_id, tconst, rating=None):
+    # Called on every preference write, a no-op until an ItemCF is trained
+    item_cf = _item_cf
+    if item_cf is not None:
+        item_cf.record(user_id, tconst, rating)
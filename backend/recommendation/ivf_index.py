@@ -0,0 +1,116 @@
+import heapq
+import numpy as np
+from recommendation.knn_index import KNNIndex
+
+class IVFIndex(KNNIndex):
+    """
+    Approximate knn with an inverted file: k-means centroids act as a coarse
+    quantizer, every media is stored in the list of its nearest centroid and a
+    query only scans the n_probe lists whose centroids are closest to it.
+    kneighbors() is that approximate top-k. iter_neighbors() streams in exact
+    increasing distance order: it scans further lists only while the lower
+    bound of an unscanned list (centroid distance minus list radius) could
+    still beat the next candidate.
+    """
+    def __init__(self, n_neighbors=50, n_lists=None, n_probe=16, kmeans_iterations=20,
+                 sample_size=100000, chunk_size=65536, seed=0):
+        self.n_neighbors = n_neighbors
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.kmeans_iterations = kmeans_iterations
+        self.sample_size = sample_size
+        self.chunk_size = chunk_size
+        self.seed = seed
+
+    def fit(self, media_features):
+        self.media_features = media_features
+        self.n_samples = len(media_features)
+        rng = np.random.default_rng(self.seed)
+        n_lists = self.n_lists or max(1, int(np.sqrt(self.n_samples)))
+        n_lists = min(n_lists, max(self.n_samples, 1))
+
+        # Train centroids on a sample, then assign the whole catalog in chunks
+        sample_rows = np.sort(rng.choice(self.n_samples, size=min(self.sample_size, self.n_samples), replace=False))
+        sample = np.asarray(media_features[sample_rows], dtype=np.float32)
+        self.centroids = self._kmeans(sample, n_lists, rng)
+
+        assignments = np.empty(self.n_samples, dtype=np.int32)
+        self.list_radius = np.zeros(len(self.centroids), dtype=np.float64)
+        for start in range(0, self.n_samples, self.chunk_size):
+            chunk = np.asarray(media_features[start:start + self.chunk_size], dtype=np.float32)
+            labels = self._nearest_centroids(chunk)
+            assignments[start:start + len(chunk)] = labels
+            np.maximum.at(self.list_radius, labels, np.sqrt(((chunk - self.centroids[labels]) ** 2).sum(axis=1)))
+
+        counts = np.bincount(assignments, minlength=len(self.centroids))
+        self.list_rows = np.argsort(assignments, kind='stable').astype(np.int64)
+        self.list_end = np.cumsum(counts)
+        self.list_start = self.list_end - counts
+        self.row_norms = np.einsum('ij,ij->i', np.asarray(media_features, dtype=np.float32),
+                                   np.asarray(media_features, dtype=np.float32))
+        print(f"IVFIndex fitted: {self.n_samples} media in {len(self.centroids)} lists, n_probe={self.n_probe}")
+        return self
+
+    def _nearest_centroids(self, X):
+        centroid_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        return np.argmin(centroid_norms[None, :] - 2 * X @ self.centroids.T, axis=1)
+
+    def _kmeans(self, X, n_lists, rng):
+        if len(X) == 0:
+            return np.zeros((1, X.shape[1] if X.ndim == 2 else 0), dtype=np.float32)
+        self.centroids = X[rng.choice(len(X), size=n_lists, replace=False)].copy()
+        for _ in range(self.kmeans_iterations):
+            labels = self._nearest_centroids(X)
+            counts = np.bincount(labels, minlength=n_lists)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, labels, X)
+            empty = counts == 0
+            self.centroids[~empty] = sums[~empty] / counts[~empty, None]
+            # Restart empty lists on random points
+            self.centroids[empty] = X[rng.choice(len(X), size=int(empty.sum()))]
+        return self.centroids
+
+    def _scan(self, query, lists):
+        rows = np.concatenate([self.list_rows[self.list_start[l]:self.list_end[l]] for l in lists])
+        candidates = np.asarray(self.media_features[rows], dtype=np.float32)
+        dist2 = self.row_norms[rows] - 2 * (candidates @ query.astype(np.float32)) + query @ query
+        order = np.argsort(dist2, kind='stable')
+        return np.sqrt(np.maximum(dist2[order], 0)), rows[order]
+
+    def _list_order(self, query):
+        centroid_dist = np.sqrt(((self.centroids - query) ** 2).sum(axis=1))
+        return np.argsort(centroid_dist, kind='stable'), centroid_dist
+
+    def kneighbors(self, X, n_neighbors=None):
+        X = np.atleast_2d(np.asarray(X, dtype=np.float64))
+        n_neighbors = min(n_neighbors or self.n_neighbors, self.n_samples)
+        distances = np.zeros((len(X), n_neighbors), dtype=np.float64)
+        indices = np.zeros((len(X), n_neighbors), dtype=np.int64)
+        for i, query in enumerate(X):
+            list_order, _ = self._list_order(query)
+            query_distances, rows = self._scan(query, list_order[:self.n_probe])
+            if len(rows) < n_neighbors:
+                # Probed lists too small, continue with the exact stream
+                query_distances, rows = zip(*[hit for _, hit in zip(range(n_neighbors), self.iter_neighbors(query))])
+            distances[i] = query_distances[:n_neighbors]
+            indices[i] = rows[:n_neighbors]
+        return distances, indices
+
+    def iter_neighbors(self, query):
+        query = np.asarray(query, dtype=np.float64)
+        if self.n_samples == 0:
+            return
+        list_order, centroid_dist = self._list_order(query)
+        # remaining_bound[i]: no media of list_order[i:] is closer than this,
+        # lowered a little so float32 scan distances never cross it
+        bounds = np.maximum(centroid_dist[list_order] - self.list_radius[list_order], 0) * (1 - 1e-5)
+        remaining_bound = np.append(np.minimum.accumulate(bounds[::-1])[::-1], np.inf)
+        candidates = []
+        # Scan n_probe lists at a time, further lists only if the caller wants more
+        for start in range(0, len(list_order), self.n_probe):
+            distances, rows = self._scan(query, list_order[start:start + self.n_probe])
+            for candidate in zip(distances.tolist(), rows.tolist()):
+                heapq.heappush(candidates, candidate)
+            bound = remaining_bound[min(start + self.n_probe, len(list_order))]
+            while candidates and candidates[0][0] <= bound:
+                yield heapq.heappop(candidates)
@@ -0,0 +1,47 @@
+import numpy as np
+
+class KNNIndex:
+    """
+    Common interface of the genre knn engines. Subclasses implement fit() and
+    iter_neighbors(), which yields (distance, row) pairs in increasing
+    distance order. kneighbors() mirrors sklearn's NearestNeighbors.kneighbors.
+    """
+    n_neighbors = 50
+    n_samples = 0
+
+    def fit(self, media_features):
+        raise NotImplementedError
+
+    def iter_neighbors(self, query):
+        raise NotImplementedError
+
+    def kneighbors(self, X, n_neighbors=None):
+        X = np.atleast_2d(np.asarray(X, dtype=np.float64))
+        n_neighbors = min(n_neighbors or self.n_neighbors, self.n_samples)
+        distances = np.zeros((len(X), n_neighbors), dtype=np.float64)
+        indices = np.zeros((len(X), n_neighbors), dtype=np.int64)
+        for i, query in enumerate(X):
+            for j, (distance, row) in enumerate(self.iter_neighbors(query)):
+                if j == n_neighbors:
+                    break
+                distances[i, j] = distance
+                indices[i, j] = row
+        return distances, indices
+
+def expanding_neighbors(search, query, n_samples, first_k=50):
+    """
+    Turns a fixed size search(query, n) -> (distances, rows) into an
+    increasing distance stream by doubling n whenever the consumer needs more.
+    """
+    seen = set()
+    n = min(first_k, n_samples)
+    while n > 0:
+        distances, rows = search(query, n)
+        for distance, row in zip(distances, rows):
+            row = int(row)
+            if row not in seen:
+                seen.add(row)
+                yield float(distance), row
+        if n >= n_samples:
+            return
+        n = min(n * 2, n_samples)
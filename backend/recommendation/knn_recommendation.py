@@ -1,137 +1,569 @@
 import numpy as np
-import pickle
+import scipy.sparse as sp
 import os
-from sklearn.neighbors import NearestNeighbors
+import datetime
+import threading
+import time
 from db.models import Media, User, UserPreference
 import db.users
 import db.media
 import db.user_preferences
+import db.user_recommendations
+from recommendation.model_state import ModelState, FeatureSegment, get_model_state, swap_model_state, clear_model_state, next_model_version
+from recommendation.index_backends import build_genre_index
+from recommendation.brute_force_knn import BruteForceKNN
+from recommendation.search_filter import SearchFilter
+from recommendation.recommendation_cache import recommendation_cache
+from recommendation.popularity import build_popularity_rankings, decode_rankings
+from recommendation.hybrid_features import load_or_build_hybrid_index
+from recommendation.item_cf import ItemCF, get_item_cf, set_item_cf
+from recommendation.diversity import diversify, candidate_count
+from recommendation.executor import get_recommendation_executor
+from recommendation.feature_store import (
+    save_feature_store, save_feature_delta, save_popularity, load_feature_store, store_exists, delete_feature_store,
+    get_current_version, CATALOG_COLUMN_DTYPES
+)
 
-CACHE_FILE = '/app/cache/media_genre_features_cache.pkl'
+LEGACY_CACHE_FILE = '/app/cache/media_genre_features_cache.pkl'
 PAGE_SIZE = 10000
-genre_knn = None  # genre_knn model
 NUM_VOTES_WEIGHT_EXPONENT = 1.1  # Exponent for numVotes weighting
+# Delta rows + tombstones above this fraction of the base trigger a compaction
+FEATURE_COMPACTION_RATIO = float(os.getenv("FEATURE_COMPACTION_RATIO", 0.1))
+POPULAR_LIST_SIZE = int(os.getenv("POPULAR_LIST_SIZE", 500))
+# Age after which the database popular list (served before a model state exists) is re-read
+POPULAR_REFRESH_SECONDS = float(os.getenv("POPULAR_REFRESH_SECONDS", 300))
+# genre: dense genre knn, hybrid: sparse genres + creators + year/runtime cosine search,
+# item_cf: item-item collaborative filtering on user_preferences, topped up by the genre knn
+RECOMMENDATION_ENGINE = os.getenv("RECOMMENDATION_ENGINE", "genre")
+# Lists precomputed by batch_recommendations.py are served while younger than this
+STORED_RECOMMENDATION_MAX_AGE = float(os.getenv("STORED_RECOMMENDATION_MAX_AGE", 24))  # hours
 
-def save_to_cache_genre(media_genre_features, media_ids, all_genres, genre_index):
-    try:
-        with open(CACHE_FILE, 'wb') as f:
-            pickle.dump((media_genre_features, media_ids, all_genres, genre_index), f)
-        print(f"Cache file saved to {CACHE_FILE}")
-    except Exception as e:
-        print(f"Error saving cache file: {e}")
-
-def load_from_cache_genre():
-    with open(CACHE_FILE, 'rb') as f:
-        media_genre_features, media_ids, all_genres, genre_index = pickle.load(f)
-    return media_genre_features, media_ids, all_genres, genre_index
+_popular_media = []  # Most voted media from the database, served until a model state exists
+_popular_media_refreshed_at = 0.0
+_popular_media_lock = threading.Lock()
 
 def delete_cache():
-    if os.path.exists(CACHE_FILE):
-        os.remove(CACHE_FILE)
-        print(f"Cache file {CACHE_FILE} deleted.")
-    else:
-        print(f"Cache file {CACHE_FILE} does not exist.")
+    # Nothing keeps serving features whose store is gone, requests fall back to popular media until retrained
+    clear_model_state()
+    delete_feature_store()
+    if os.path.exists(LEGACY_CACHE_FILE):
+        os.remove(LEGACY_CACHE_FILE)
+        print(f"Legacy cache file {LEGACY_CACHE_FILE} deleted.")
+
+class FeatureRowsBuilder:
+    """
+    Fills preallocated feature, id and column arrays from batches of
+    (tconst, titleType, isAdult, genres, averageRating, numVotes) tuples. Each
+    batch is written with a handful of vectorized assignments, no per row
+    feature lists.
+    """
+    def __init__(self, genre_index, capacity):
+        self.genre_index = genre_index
+        self.size = 0
+        self.media_features = np.zeros((capacity, len(genre_index)), dtype=np.float32)
+        self.media_ids = np.zeros(capacity, dtype='S16')
+        self.columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in CATALOG_COLUMN_DTYPES.items()}
+
+    def _reserve(self, n):
+        # The catalog may grow while it is scanned
+        capacity = len(self.media_ids)
+        if self.size + n <= capacity:
+            return
+        extra = max(self.size + n - capacity, capacity // 4)
+        self.media_features = np.concatenate([self.media_features, np.zeros((extra, len(self.genre_index)), dtype=np.float32)])
+        self.media_ids = np.concatenate([self.media_ids, np.zeros(extra, dtype=self.media_ids.dtype)])
+        for name, values in self.columns.items():
+            self.columns[name] = np.concatenate([values, np.zeros(extra, dtype=values.dtype)])
+
+    def add(self, media_batch):
+        n = len(media_batch)
+        if n == 0:
+            return
+        self._reserve(n)
+        start, end = self.size, self.size + n
+        tconsts, title_types, is_adult, genres, average_ratings, num_votes = zip(*[
+            (media.tconst, media.titleType, media.isAdult, media.genres, media.averageRating, media.numVotes)
+            for media in media_batch
+        ])
+        votes = np.array([votes or 0 for votes in num_votes], dtype=np.int64)
+        self.media_ids[start:end] = tconsts
+        self.columns["average_rating"][start:end] = [rating or 0 for rating in average_ratings]
+        self.columns["num_votes"][start:end] = votes
+        self.columns["is_adult"][start:end] = [bool(adult) for adult in is_adult]
+        self.columns["title_type"][start:end] = [title_type or '' for title_type in title_types]
+
+        # One hot genres through flat (row, column) index arrays
+        lengths = np.fromiter((len(media_genres) for media_genres in genres), dtype=np.int64, count=n)
+        columns = np.fromiter((self.genre_index[genre] for media_genres in genres for genre in media_genres),
+                              dtype=np.int64, count=int(lengths.sum()))
+        self.media_features[np.repeat(np.arange(start, end), lengths), columns] = 1
+
+        # Multiply features by popularity weight, 1 for media without votes
+        popularity_weight = np.where(votes > 0, np.log1p(votes) ** NUM_VOTES_WEIGHT_EXPONENT, 1)
+        self.media_features[start:end] *= popularity_weight[:, None].astype(np.float32)
+        self.size = end
+
+    def finish(self):
+        """
+        Returns (media_features, media_ids, columns) sorted by tconst, so the
+        store can be searched by id.
+        """
+        n = self.size
+        media_ids = self.media_ids[:n]
+        if n:
+            media_ids = media_ids.astype(f"S{max(1, int(np.char.str_len(media_ids).max()))}")
+        media_features = self.media_features[:n]
+        columns = {name: values[:n] for name, values in self.columns.items()}
+        if n > 1 and not np.all(media_ids[:-1] <= media_ids[1:]):
+            order = np.argsort(media_ids, kind='stable')
+            media_ids, media_features = media_ids[order], media_features[order]
+            columns = {name: values[order] for name, values in columns.items()}
+        columns["popularity"] = popularity_weights(columns["num_votes"])
+        return media_features, media_ids, columns
 
-def get_media_features_for_genres():
-    all_genres = db.media.get_all_genres()
+def build_feature_rows(media_list, genre_index):
+    builder = FeatureRowsBuilder(genre_index, len(media_list))
+    builder.add(media_list)
+    return builder.finish()
+
+def get_media_features_for_genres(progress=None, rebuild=False):
+    """
+    progress: optional callback(done, total) called after each streamed page
+    rebuild: build a new version from the database even when a store exists
+    """
+    # Load from feature store if exists
+    if store_exists() and not rebuild:
+        print("Loading media features from feature store")
+        return load_feature_store()
+
+    all_genres = sorted(db.media.get_all_genres())
     genre_index = {genre: idx for idx, genre in enumerate(all_genres)}
-    media_ids = []
-    page = 0
-    media_genre_features = []
-
-    # Load from cache if exists
-    if os.path.exists(CACHE_FILE):
-        print(f"Loading media features from cache file {CACHE_FILE}")
-        media_genre_features, media_ids, all_genres, genre_index = load_from_cache_genre()
-        return media_genre_features, media_ids
-
-    # Loop through pages of media
-    while True:
-        media_list = db.media.get_media_page(page, PAGE_SIZE, 0)
-        if not media_list:
-            break
 
-        for media in media_list:
-            genre_features = [0] * len(all_genres)
-            for genre in media.genres:
-                genre_features[genre_index[genre]] = 1
+    # Stream the catalog in tconst order (keyset pagination) into preallocated arrays
+    builder = FeatureRowsBuilder(genre_index, db.media.count_catalog_media())
+    total = len(builder.media_ids)
+    for media_batch in db.media.iter_catalog_media(PAGE_SIZE):
+        builder.add(media_batch)
+        if progress:
+            progress(builder.size, total)
+    media_genre_features, media_ids, columns = builder.finish()
+
+    # Write the float32 store and hand back its memory mapped view
+    version = next_model_version()
+    save_feature_store(media_genre_features, media_ids, all_genres, version, columns)
+    return load_feature_store(version)
+
+def popularity_weights(num_votes):
+    # log1p(numVotes) ** NUM_VOTES_WEIGHT_EXPONENT, 0 for media without votes
+    num_votes = np.asarray(num_votes, dtype=np.float64)
+    return (np.log1p(num_votes) ** NUM_VOTES_WEIGHT_EXPONENT).astype(np.float32)
+
+def train_genre_knn(media_features, media_ids=None, num_votes=None, benchmark_queries=None):
+    # Backend is chosen with KNN_INDEX (sharded with KNN_SHARDS), KNN_BENCHMARK_QUERIES reports recall and latency
+    return build_genre_index(media_features, n_neighbors=50, media_ids=media_ids, num_votes=num_votes,
+                             benchmark_queries=benchmark_queries)
+
+def build_segment(media_features, media_ids, columns, live=None, small=False, benchmark_queries=None):
+    if small:
+        # Delta segments stay small, an exact brute force search is enough
+        genre_knn = BruteForceKNN(n_neighbors=50).fit(media_features)
+        return FeatureSegment(media_features, media_ids, columns, live, genre_knn, genre_knn)
+    genre_knn = train_genre_knn(media_features, media_ids, columns.get("num_votes"), benchmark_queries)
+    # Exact GEMM engine for many profiles at once (rooms, batch jobs), reads the memory mapped features
+    batch_knn = BruteForceKNN(n_neighbors=50).fit(media_features)
+    return FeatureSegment(media_features, media_ids, columns, live, genre_knn, batch_knn)
+
+def build_model_state(store, previous_state=None, hybrid=None, load_only=False):
+    """
+    ModelState for a loaded feature store. When the base segment is the one
+    previous_state already serves, its indexes are reused and only the delta
+    segment is indexed. hybrid is an already updated HybridIndex to attach
+    instead of loading or building one. load_only (recommendation workers)
+    never computes or writes anything stored with the version, it raises
+    FileNotFoundError when the popularity rankings or hybrid features are missing.
+    """
+    base_features, base_ids, base_columns = store["base"]
+    live = None
+    if len(store["tombstones"]):
+        live = np.ones(len(base_ids), dtype=bool)
+        live[store["tombstones"]] = False
+
+    if previous_state is not None and previous_state.base_version == store["base_version"]:
+        previous_base = previous_state.base
+        base = FeatureSegment(previous_base.media_features, previous_base.media_ids, previous_base.columns,
+                              live, previous_base.genre_knn, previous_base.batch_knn)
+    else:
+        # Workers map the index the server already benchmarked
+        base = build_segment(base_features, base_ids, base_columns, live, benchmark_queries=0 if load_only else None)
+    delta = build_segment(*store["delta"], small=True)
+    state = ModelState(store["all_genres"], store["genre_index"], [base, delta],
+                       version=store["version"], base_version=store["base_version"])
+
+    # Popularity rankings are computed once per store version and kept with it
+    popularity = store.get("popularity")
+    if popularity is None:
+        if load_only:
+            raise FileNotFoundError(f"No popularity rankings stored for version {state.version}")
+        popularity = build_popularity_rankings(state, POPULAR_LIST_SIZE)
+        save_popularity(state.version, *popularity)
+    state.popular_media, state.popular_by_genre = decode_rankings(state.all_genres, *popularity)
+
+    if RECOMMENDATION_ENGINE == "hybrid":
+        # A new genre base (full build or compaction) also compacts the hybrid delta
+        state.hybrid = load_or_build_hybrid_index(state.version, state.all_genres, state.genre_index, hybrid,
+                                                  compact=state.base_version == state.version, load_only=load_only)
+    return state
+
+def train_knns(progress=None, rebuild=False):
+    # Build the whole model aside and publish it in one swap, requests keep
+    # using the previous state until the new one is complete
+    store = get_media_features_for_genres(progress, rebuild)
+    state = build_model_state(store, get_model_state())
+    swap_model_state(state)
+    if RECOMMENDATION_ENGINE == "item_cf":
+        train_item_cf()
+    return state
+
+def load_knns():
+    """
+    Serves the feature store version CURRENT points to, for processes running
+    next to the server: nothing is rebuilt and no version is removed.
+    Returns None when no feature store has been written yet.
+    """
+    store = load_feature_store()
+    if store is None:
+        return None
+    state = build_model_state(store, get_model_state())
+    swap_model_state(state)
+    if RECOMMENDATION_ENGINE == "item_cf":
+        train_item_cf()
+    return state
+
+def train_item_cf():
+    # Ratings are streamed from user_preferences, later writes are applied incrementally
+    return set_item_cf(ItemCF().fit(db.user_preferences.iter_all_preferences(PAGE_SIZE)))
+
+def update_knns(changed_tconsts):
+    """
+    Applies added, changed or removed media to the feature store without a
+    full rebuild: changed media are re-read from the database and written to
+    the delta segment, their base rows are tombstoned and only the delta is
+    re-indexed. Compacts when the delta grows past FEATURE_COMPACTION_RATIO.
+    """
+    state = get_model_state()
+    if state is None or not store_exists() or state.version != get_current_version():
+        state = train_knns()
+    changed = sorted(set(changed_tconsts))
+    if not changed:
+        return state
+
+    media_list = [media for media in db.media.get_media_features_by_tconsts(changed, batch_size=PAGE_SIZE)
+                  if db.media.is_catalog_media(media)]
+    if any(genre not in state.genre_index for media in media_list for genre in media.genres):
+        # A new genre changes the feature dimensions: a full build published as a new version,
+        # older versions are left to _remove_old_versions as workers may still map them
+        print("New genre found, rebuilding feature store")
+        return train_knns(rebuild=True)
+
+    changed_keys = np.asarray(changed, dtype=np.bytes_)
+    new_features, new_ids, new_columns = build_feature_rows(media_list, state.genre_index)
+
+    # Delta = previous delta without the changed media + their new rows
+    delta = state.delta
+    kept = ~np.isin(np.asarray(delta.media_ids), changed_keys)
+    delta_ids = np.concatenate([np.asarray(delta.media_ids, dtype=np.bytes_)[kept], new_ids]).astype(np.bytes_)
+    order = np.argsort(delta_ids, kind='stable')
+    delta_ids = delta_ids[order]
+    delta_features = np.concatenate([np.asarray(delta.media_features)[kept], new_features])[order]
+    delta_columns = {
+        name: np.concatenate([np.asarray(delta.columns[name])[kept], new_columns[name]])[order]
+        for name in new_columns
+    }
+
+    # Every base row of a changed tconst is superseded or removed
+    base = state.base
+    base_rows, in_base = base.lookup_rows(changed_keys, include_dead=True)
+    previous_tombstones = np.flatnonzero(~base.live) if base.live is not None else np.zeros(0, dtype=np.int64)
+    tombstones = np.union1d(previous_tombstones, base_rows[in_base]).astype(np.int64)
+
+    # The hybrid engine re-reads only the changed media
+    hybrid = state.hybrid.updated(changed) if state.hybrid is not None else None
+
+    version = next_model_version()
+    if len(delta_ids) + len(tombstones) > FEATURE_COMPACTION_RATIO * max(len(base), 1):
+        return compact_knns(state, delta_features, delta_ids, delta_columns, tombstones, version, hybrid)
 
-            # Multiply features by popularity weight
-            popularity_weight = (np.log1p(media.numVotes) ** NUM_VOTES_WEIGHT_EXPONENT) if media.numVotes else 1
-            weighted_features = [f * popularity_weight for f in genre_features]
+    save_feature_delta(version, state.version, delta_features, delta_ids, delta_columns, tombstones)
+    new_state = build_model_state(load_feature_store(version), state, hybrid)
+    swap_model_state(new_state)
+    print(f"Applied {len(changed)} media changes: {len(delta_ids)} delta rows, {len(tombstones)} tombstones")
+    return new_state
 
-            media_genre_features.append(weighted_features)
-            media_ids.append(media.tconst)
+def compact_knns(state=None, delta_features=None, delta_ids=None, delta_columns=None, tombstones=None, version=None,
+                 hybrid=None):
+    """
+    Merges the live base rows and the delta into a new base and rebuilds the
+    indexes. Without arguments the current state is compacted as is.
+    """
+    state = state or get_model_state()
+    if state is None:
+        return train_knns()
+    base = state.base
+    if delta_ids is None:
+        delta = state.delta
+        delta_features, delta_ids, delta_columns = delta.media_features, delta.media_ids, delta.columns
+        tombstones = np.flatnonzero(~base.live) if base.live is not None else np.zeros(0, dtype=np.int64)
+        hybrid = state.hybrid
+    version = version or next_model_version()
+
+    live = np.ones(len(base), dtype=bool)
+    live[np.asarray(tombstones, dtype=np.int64)] = False
+    media_ids = np.concatenate([np.asarray(base.media_ids)[live], np.asarray(delta_ids)]).astype(np.bytes_)
+    order = np.argsort(media_ids, kind='stable')
+    media_features = np.concatenate([np.asarray(base.media_features)[live], np.asarray(delta_features)])[order]
+    columns = {
+        name: np.concatenate([np.asarray(base.columns[name])[live], np.asarray(delta_columns[name])])[order]
+        for name in base.columns
+    }
+    save_feature_store(media_features, media_ids[order], state.all_genres, version, columns)
+    new_state = build_model_state(load_feature_store(version), hybrid=hybrid)
+    swap_model_state(new_state)
+    print(f"Feature store compacted to {len(media_ids)} media")
+    return new_state
 
-        page += 1
+def recommend_media(user_id, k=5, **predicates):
+    """
+    predicates: catalog constraints passed to SearchFilter
+    (include_adult, title_types, min_rating)
+    """
+    key = recommendation_cache_key(user_id, k, predicates)
+    cached = recommendation_cache.get(key)
+    if cached is not None:
+        return cached
+    generation = recommendation_cache.generation(user_id)
 
-    media_genre_features = np.array(media_genre_features, dtype=float)
-    save_to_cache_genre(media_genre_features, media_ids, all_genres, genre_index)
-    return media_genre_features, media_ids
+    stored = get_stored_recommendation(user_id, k, predicates)
+    if stored is not None:
+        recommendation_cache.put(key, stored, generation)
+        return stored
 
-def train_genre_knn(media_features):
-    global genre_knn
-    genre_knn = NearestNeighbors(n_neighbors=50, metric='euclidean')
-    genre_knn.fit(media_features)
-    return genre_knn
+    state = get_model_state()
+    executor = get_recommendation_executor()
+    if executor is not None and state is not None and get_item_cf() is None:
+        # Computed in a worker process, identical concurrent requests share the job
+        result = executor.run(key, state.version, user_id, k, predicates,
+                              on_done=lambda result: recommendation_cache.put(key, result, generation))
+        if result is None:
+            # Refused or late: popular media for this request only, not cached
+            return recommend_popular_media(k)
+        return result
 
-def train_knns():
-    media_features, _ = get_media_features_for_genres()
-    train_genre_knn(media_features)
+    result = compute_media_for_user(user_id, k, **predicates)
+    recommendation_cache.put(key, result, generation)
+    return result
 
-def recommend_media(user_id, k=5):
-    user_preferences = db.user_preferences.get_user_preferences(user_id)
+def compute_media_for_user(user_id, k=5, **predicates):
+    # Model still training: popular media until it is ready
+    user_preferences = db.user_preferences.get_user_preferences(user_id) if get_model_state() else None
 
     # Cold start: no preferences
     if not user_preferences:
-        popular_media = db.media.get_most_pupular_media(limit=k)
-        media = [m.tconst for m in popular_media]
-        distances = [0] * len(media)
-        return media, distances
+        return recommend_popular_media(k)
+    if get_model_state().hybrid is not None:
+        return recommend_media_hybrid(user_preferences, k, **predicates)
+    if get_item_cf() is not None:
+        return recommend_media_item_cf(user_preferences, k, **predicates)
+    return recommend_media_based_on_genre(user_preferences, k, **predicates)
+
+def get_stored_recommendation(user_id, k, predicates):
+    """
+    Precomputed (media, distances) of the user, None when there is none or it
+    is stale: older than STORED_RECOMMENDATION_MAX_AGE, computed before the
+    served base store, too short for k or asked with catalog filters. Rating
+    writes delete the stored list.
+    """
+    state = get_model_state()
+    if state is None or SearchFilter(**predicates).has_predicates():
+        return None
+    stored = db.user_recommendations.get_user_recommendation(user_id)
+    if stored is None or stored.model_version < state.base_version or len(stored.media) < k:
+        return None
+    if datetime.datetime.utcnow() - stored.computed_at > datetime.timedelta(hours=STORED_RECOMMENDATION_MAX_AGE):
+        return None
+    return list(stored.media[:k]), list(stored.distances[:k])
+
+def recommendation_cache_key(user_id, k, predicates):
+    # A new model version makes older entries unreachable
+    state = get_model_state()
+    return (user_id, state.version if state else None, k, SearchFilter(**predicates).predicate_key())
+
+def _load_popular_media():
+    # Caller holds _popular_media_lock
+    global _popular_media, _popular_media_refreshed_at
+    _popular_media = [m.tconst for m in db.media.get_most_pupular_media(limit=POPULAR_LIST_SIZE)]
+    _popular_media_refreshed_at = time.monotonic()
+    return _popular_media
+
+def refresh_popular_media():
+    with _popular_media_lock:
+        return _load_popular_media()
 
-    media, distances = recommend_media_based_on_genre(user_preferences, k)
+def _popular_media_is_fresh():
+    # Never loaded or past its TTL. An empty list (catalog still loading) also
+    # waits for the TTL, startup refreshes it as soon as ingestion is done
+    return _popular_media_refreshed_at > 0 and time.monotonic() - _popular_media_refreshed_at < POPULAR_REFRESH_SECONDS
+
+def _database_popular_media():
+    # At most one query per POPULAR_REFRESH_SECONDS however many requests
+    # arrive, a short list (small catalog, ingestion running) is served as it is
+    if _popular_media_is_fresh():
+        return _popular_media
+    # With a stale list at hand only one request refreshes, the others serve it
+    if not _popular_media_lock.acquire(blocking=_popular_media_refreshed_at == 0):
+        return _popular_media
+    try:
+        return _popular_media if _popular_media_is_fresh() else _load_popular_media()
+    finally:
+        _popular_media_lock.release()
+
+def recommend_popular_media(k=5, genre=None):
+    # Rankings of the model state are served from memory
+    state = get_model_state()
+    if state is not None and state.popular_media:
+        popular_media = state.popular_by_genre.get(genre, []) if genre else state.popular_media
+    else:
+        popular_media = _database_popular_media()
+    media = popular_media[:k]
+    distances = [0] * len(media)
     return media, distances
 
-def recommend_media_based_on_genre(user_preferences, k=5, alpha=0.5, beta=7.0):
+def compute_media_for_users(user_ids, k=5, alpha=0.5, beta=7.0, **predicates):
+    preferences_by_user = db.user_preferences.get_preferences_for_users(user_ids)
+    state = get_model_state()
+    recommendations = {}
+    warm_users = [user_id for user_id in user_ids if preferences_by_user.get(user_id)]
+    if len(warm_users) < len(user_ids):
+        popular = recommend_popular_media(k)
+        for user_id in user_ids:
+            if user_id not in warm_users:
+                recommendations[user_id] = popular
+
+    if not warm_users or not state:
+        # Model still training
+        for user_id in warm_users:
+            recommendations[user_id] = recommend_popular_media(k)
+        return recommendations
+
+    search_filters = [rated_media_filter(preferences_by_user[user_id], **predicates) for user_id in warm_users]
+    if state.hybrid is not None:
+        # One sparse search for every profile
+        profiles = hybrid_user_profiles(state.hybrid, [preferences_by_user[user_id] for user_id in warm_users])
+        for user_id, hits in zip(warm_users, state.hybrid.search(profiles, candidate_count(k), search_filters)):
+            recommendations[user_id] = hybrid_hits_to_media(state.hybrid, hits, k)
+        return recommendations
+    if get_item_cf() is not None:
+        # Sparse neighbor lookups per user, no index search to batch
+        for user_id in warm_users:
+            recommendations[user_id] = recommend_media_item_cf(preferences_by_user[user_id], k, **predicates)
+        return recommendations
+
+    profiles = build_user_profiles(state, [preferences_by_user[user_id] for user_id in warm_users], alpha, beta)
+    distances, indices = state.kneighbors(profiles, n_neighbors=candidate_count(k), batch=True, search_filters=search_filters)
+    for user_id, user_indices, user_distances in zip(warm_users, indices, distances):
+        recommendations[user_id] = collect_unique_media(state, *diversify_neighbors(state, user_indices, user_distances, k), k)
+    return recommendations
+
+def rated_media_filter(user_preferences, **predicates):
+    # Already rated media are never recommended back
+    return SearchFilter(exclude_tconsts=[preference.media_id for preference in user_preferences], **predicates)
+
+def hybrid_user_profile(hybrid, user_preferences):
+    # Rated media weighted by the user's rating
+    return hybrid_user_profiles(hybrid, [user_preferences])
+
+def hybrid_user_profiles(hybrid, preferences_by_user):
+    # One hybrid_user_profile row per user, built in one pass
+    return hybrid.profiles([[preference.media_id for preference in preferences] for preferences in preferences_by_user],
+                           [[preference.rating for preference in preferences] for preferences in preferences_by_user])
+
+def hybrid_hits_to_media(hybrid, hits, k):
+    # Diverse top-k of the over-fetched hits, compared on their sparse hybrid rows
+    rows = np.array([row for _, row in hits], dtype=np.int64)
+    distances = np.array([distance for distance, _ in hits])
+    order = diversify(distances, hybrid.feature_rows(rows), k)
+    return [hybrid.media_id(row) for row in rows[order].tolist()], distances[order].tolist()
+
+def recommend_media_hybrid(user_preferences, k=5, **predicates):
     """
-    alpha: weight for average rating
-    beta: weight for popularity (numVotes)
+    Cosine search over the sparse hybrid features (genres, creators, year and
+    runtime buckets), distances are 1 - similarity.
     """
-    global genre_knn
-    if not genre_knn or not user_preferences:
+    state = get_model_state()
+    if not state or state.hybrid is None or not user_preferences:
         return [], []
+    profile = hybrid_user_profile(state.hybrid, user_preferences)
+    hits = state.hybrid.search(profile, candidate_count(k), [rated_media_filter(user_preferences, **predicates)])[0]
+    return hybrid_hits_to_media(state.hybrid, hits, k)
 
-    media_features, media_ids, all_genres, genre_index = load_from_cache_genre()
-    user_profile = np.zeros(len(all_genres))
+def recommend_media_item_cf(user_preferences, k=5, **predicates):
+    """
+    Media liked by users with similar ratings: neighbors of the rated media
+    in the item-item model. Distances are the negated scores (lower is
+    better). Users whose ratings have too few neighbors are topped up with
+    the genre knn.
+    """
+    state = get_model_state()
+    item_cf = get_item_cf()
+    if not state or item_cf is None or not user_preferences:
+        return [], []
+    search_filter = rated_media_filter(user_preferences, **predicates)
+    hits = item_cf.recommend(
+        [(preference.media_id, preference.rating) for preference in user_preferences], k,
+        allowed=lambda tconsts: state.allowed_tconsts(tconsts, search_filter),
+    )
+    media = [tconst for tconst, _ in hits]
+    distances = [-score for _, score in hits]
+    if len(media) < k:
+        genre_media, genre_distances = recommend_media_based_on_genre(user_preferences, k + len(media), **predicates)
+        chosen = set(media)
+        for tconst, distance in zip(genre_media, genre_distances):
+            if len(media) == k:
+                break
+            if tconst not in chosen:
+                media.append(tconst)
+                distances.append(distance)
+    return media, distances
 
-    # Build user profile vector
-    for preference in user_preferences:
-        media = db.media.get_media_by_tconst(preference.media_id)
-        if media:
-            genre_features = np.zeros(len(all_genres))
-            for genre in media.genres:
-                genre_features[genre_index[genre]] = 1
+def recommend_media_based_on_genre(user_preferences, k=5, alpha=0.5, beta=7.0, **predicates):
+    """
+    alpha: weight for average rating
+    beta: weight for popularity (numVotes)
+    predicates: include_adult, title_types, min_rating, applied inside the search
+    """
+    state = get_model_state()
+    if not state or not user_preferences:
+        return [], []
 
-            # Weight features by user rating
-            user_profile += genre_features * preference.rating
+    user_profile = build_user_profile(state, user_preferences, alpha, beta)
 
-            # Boost by average rating
-            if media.averageRating:
-                user_profile += genre_features * alpha * media.averageRating
+    # Get k nearest neighbors from KNN, the search keeps going until k media pass the filter
+    search_filter = rated_media_filter(user_preferences, **predicates)
+    distances, indices = state.kneighbors([user_profile], n_neighbors=candidate_count(k), search_filters=[search_filter])
 
-            # Strongly boost by popularity
-            if media.numVotes:
-                user_profile += genre_features * beta * (np.log1p(media.numVotes) ** NUM_VOTES_WEIGHT_EXPONENT)
+    return collect_unique_media(state, *diversify_neighbors(state, indices[0], distances[0], k), k)
 
-    # Get k nearest neighbors directly from KNN
-    distances, indices = genre_knn.kneighbors([user_profile], n_neighbors=k)
+def diversify_neighbors(state, indices, distances, k):
+    # Diverse top-k of the over-fetched neighbors, compared on their genre features
+    order = diversify(distances, state.feature_rows(indices), k)
+    return np.asarray(indices)[order], np.asarray(distances)[order]
 
+def collect_unique_media(state, indices, distances, k):
     # Collect unique media IDs
     recommended_ids = []
     recommended_distances = []
     seen = set()
-    for idx, dist in zip(indices[0], distances[0]):
-        media_id = media_ids[idx]
+    for idx, dist in zip(indices, distances):
+        media_id = state.media_id(idx)
         if media_id not in seen:
             recommended_ids.append(media_id)
             recommended_distances.append(dist)
@@ -141,6 +573,49 @@ def recommend_media_based_on_genre(user_preferences, k=5, alpha=0.5, beta=7.0):
 
     return recommended_ids, recommended_distances
 
+def build_user_profile(state, user_preferences, alpha=0.5, beta=7.0):
+    """
+    Sum of the genre vectors of rated media, each weighted by
+    rating + alpha * averageRating + beta * popularity.
+    Media are read from the resident feature store, only media missing from
+    it (e.g. tv episodes) are fetched, all with a single query.
+    """
+    return build_user_profiles(state, [user_preferences], alpha, beta)[0]
+
+def build_user_profiles(state, preferences_by_user, alpha=0.5, beta=7.0):
+    # One build_user_profile row per user: all rated media are looked up, fetched and weighted in one pass
+    users = np.repeat(np.arange(len(preferences_by_user)), [len(preferences) for preferences in preferences_by_user])
+    tconsts = [preference.media_id for preferences in preferences_by_user for preference in preferences]
+    ratings = np.array([preference.rating for preferences in preferences_by_user for preference in preferences], dtype=np.float64)
+    rows, found = state.lookup_rows(tconsts)
+    rows = rows[found]
+
+    genre_masks = state.feature_rows(rows) > 0
+    average_ratings = state.column("average_rating", rows).astype(np.float64)
+    popularity = state.column("popularity", rows).astype(np.float64)
+    rated_users, rated_ratings = users[found], ratings[found]
+
+    missing = np.flatnonzero(~found)
+    if len(missing):
+        fetched = {media.tconst: media for media in db.media.get_media_features_by_tconsts(sorted({tconsts[i] for i in missing}))}
+        missing = np.array([i for i in missing.tolist() if tconsts[i] in fetched], dtype=np.int64)
+        missing_media = [fetched[tconsts[i]] for i in missing.tolist()]
+        extra_masks = np.zeros((len(missing_media), len(state.all_genres)), dtype=bool)
+        for i, media in enumerate(missing_media):
+            columns = [state.genre_index[genre] for genre in media.genres or [] if genre in state.genre_index]
+            extra_masks[i, columns] = True
+        genre_masks = np.vstack([genre_masks, extra_masks])
+        average_ratings = np.concatenate([average_ratings, [m.averageRating or 0 for m in missing_media]])
+        popularity = np.concatenate([popularity, popularity_weights([m.numVotes or 0 for m in missing_media])])
+        rated_users = np.concatenate([rated_users, users[missing]])
+        rated_ratings = np.concatenate([rated_ratings, ratings[missing]])
+
+    weights = rated_ratings + alpha * average_ratings + beta * popularity
+    # (users x rated media) weights, one product for every profile
+    user_weights = sp.csr_matrix((weights, (rated_users, np.arange(len(weights)))),
+                                 shape=(len(preferences_by_user), len(weights)))
+    return np.asarray(user_weights @ genre_masks.astype(np.float64))
+
 def test_recommend_media(user_id, k=5):
     recommendations = recommend_media(user_id, k)
     if recommendations:
@@ -0,0 +1,279 @@
+import heapq
+import itertools
+import threading
+import time
+import numpy as np
+
+_model_state = None  # ModelState currently served to requests
+_model_state_lock = threading.Lock()
+_last_version = 0
+
+def next_model_version():
+    # Millisecond timestamp, forced to be strictly increasing inside the process
+    global _last_version
+    with _model_state_lock:
+        _last_version = max(_last_version + 1, int(time.time() * 1000))
+        return _last_version
+
+MAX_CACHED_MASKS = 32  # Distinct predicate combinations kept per segment
+
+class FeatureSegment:
+    """
+    Rows of the feature store sorted by tconst, either the large base or the
+    small delta of media added or changed since the base was written, with
+    their knn indexes. live is None when every row is part of the catalog,
+    otherwise a mask where tombstoned rows are False.
+    """
+    def __init__(self, media_features, media_ids, columns, live=None, genre_knn=None, batch_knn=None):
+        self.media_features = media_features
+        self.media_ids = media_ids
+        self.columns = columns
+        self.live = live
+        self.genre_knn = genre_knn
+        self.batch_knn = batch_knn
+        self._masks = {}
+        self._masks_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.media_ids)
+
+    def live_count(self):
+        return len(self) if self.live is None else int(self.live.sum())
+
+    def allowed_mask(self, search_filter=None):
+        """
+        Rows a search may return: live rows matching the filter predicates.
+        None means every row. Masks are cached per predicate combination.
+        """
+        if search_filter is None or not search_filter.has_predicates():
+            return self.live
+        key = search_filter.predicate_key()
+        with self._masks_lock:
+            mask = self._masks.get(key)
+        if mask is None:
+            mask = search_filter.predicate_mask(self.columns, len(self))
+            if self.live is not None:
+                mask &= self.live
+            with self._masks_lock:
+                if len(self._masks) >= MAX_CACHED_MASKS:
+                    self._masks.pop(next(iter(self._masks)))
+                self._masks[key] = mask
+        return mask
+
+    def lookup_rows(self, keys, include_dead=False):
+        rows = np.searchsorted(self.media_ids, keys)
+        if len(self) == 0:
+            return rows, np.zeros(len(keys), dtype=bool)
+        rows = np.minimum(rows, len(self) - 1)
+        found = self.media_ids[rows] == keys
+        if self.live is not None and not include_dead:
+            found &= self.live[rows]
+        return rows, found
+
+    def iter_neighbors(self, query, allowed=None, excluded=()):
+        # Keeps walking the index until the consumer has enough survivors
+        if self.genre_knn is None or len(self) == 0:
+            return
+        for distance, row in self.genre_knn.iter_neighbors(query):
+            if (allowed is None or allowed[row]) and row not in excluded:
+                yield distance, row
+
+    def kneighbors(self, query, k, allowed=None, excluded=()):
+        # One top-k call (scattered over the shards of a sharded index) covers the first page,
+        # the stream takes over when the filter or the exclusions leave fewer than k rows
+        if self.genre_knn is None or len(self) == 0:
+            return []
+        n = min(k + len(excluded), len(self))
+        distances, rows = self.genre_knn.kneighbors([query], n_neighbors=n)
+        hits = [
+            (d, r) for d, r in zip(distances[0].tolist(), rows[0].tolist())
+            if (allowed is None or allowed[r]) and r not in excluded
+        ][:k]
+        if len(hits) == k or n >= len(self):
+            return hits
+        return list(itertools.islice(self.iter_neighbors(query, allowed, excluded), k))
+
+    def batch_kneighbors(self, X, k, allowed_masks=None, excluded=None):
+        # Over-fetch from the batch index until every query has k surviving rows
+        if self.batch_knn is None or len(self) == 0:
+            return [[] for _ in X]
+        allowed_masks = allowed_masks or [self.live] * len(X)
+        excluded = excluded or [()] * len(X)
+        n = min(k, len(self))
+        while True:
+            distances, rows = self.batch_knn.kneighbors(X, n_neighbors=n)
+            hits = [
+                [
+                    (d, r) for d, r in zip(query_distances.tolist(), query_rows.tolist())
+                    if (allowed is None or allowed[r]) and r not in query_excluded
+                ][:k]
+                for query_distances, query_rows, allowed, query_excluded in zip(distances, rows, allowed_masks, excluded)
+            ]
+            if n >= len(self) or all(len(h) == k for h in hits):
+                return hits
+            n = min(n * 2, len(self))
+
+def _offset_stream(stream, offset):
+    for distance, row in stream:
+        yield distance, offset + row
+
+class ModelState:
+    """
+    Snapshot of everything a recommendation needs: the genre vocabulary and
+    the feature store segments (base + delta) with their knn indexes. Rows are
+    addressed globally, delta rows follow the base rows. It is never modified
+    after creation, retraining or applying a delta builds a new one and swaps
+    it in with swap_model_state().
+    """
+    def __init__(self, all_genres, genre_index, segments, version=None, base_version=None):
+        self.all_genres = all_genres
+        self.genre_index = genre_index
+        self.segments = segments
+        self.offsets = [int(offset) for offset in np.cumsum([0] + [len(segment) for segment in segments[:-1]])]
+        self.version = version if version is not None else next_model_version()
+        self.base_version = base_version if base_version is not None else self.version
+        self.created_at = time.time()
+        # Most voted media, global and per genre, filled by build_model_state before publishing
+        self.popular_media = []
+        self.popular_by_genre = {}
+        # Sparse hybrid engine (RECOMMENDATION_ENGINE=hybrid), also filled before publishing
+        self.hybrid = None
+
+    @property
+    def base(self):
+        return self.segments[0]
+
+    @property
+    def delta(self):
+        return self.segments[1] if len(self.segments) > 1 else None
+
+    def n_media(self):
+        return sum(segment.live_count() for segment in self.segments)
+
+    def lookup_rows(self, tconsts):
+        """
+        Maps tconsts to global rows with one binary search per segment over
+        the sorted media_ids. Returns (rows, found) where found masks live
+        tconsts, tombstoned rows are not found.
+        """
+        keys = np.asarray(tconsts, dtype=np.bytes_)
+        rows = np.zeros(len(keys), dtype=np.int64)
+        found = np.zeros(len(keys), dtype=bool)
+        for offset, segment in zip(self.offsets, self.segments):
+            segment_rows, segment_found = segment.lookup_rows(keys)
+            rows = np.where(segment_found, offset + segment_rows, rows)
+            found |= segment_found
+        return rows, found
+
+    def _gather(self, rows, values_of, shape, dtype):
+        rows = np.asarray(rows, dtype=np.int64)
+        result = np.zeros((len(rows),) + shape, dtype=dtype)
+        for offset, segment in zip(self.offsets, self.segments):
+            in_segment = (rows >= offset) & (rows < offset + len(segment))
+            if in_segment.any():
+                result[in_segment] = values_of(segment)[rows[in_segment] - offset]
+        return result
+
+    def feature_rows(self, rows):
+        return self._gather(rows, lambda segment: segment.media_features, (len(self.all_genres),), np.float32)
+
+    def column(self, name, rows):
+        return self._gather(rows, lambda segment: segment.columns[name], (), self.base.columns[name].dtype)
+
+    def media_id(self, row):
+        for offset, segment in zip(self.offsets[::-1], self.segments[::-1]):
+            if row >= offset:
+                return segment.media_ids[row - offset].decode()
+
+    def allowed_tconsts(self, tconsts, search_filter=None):
+        # Mask of tconsts that are live catalog media passing the filter predicates
+        rows, allowed = self.lookup_rows(tconsts)
+        for offset, segment in zip(self.offsets, self.segments):
+            mask = segment.allowed_mask(search_filter)
+            in_segment = allowed & (rows >= offset) & (rows < offset + len(segment))
+            if mask is not None and in_segment.any():
+                allowed[in_segment] = mask[rows[in_segment] - offset]
+        return allowed
+
+    def _excluded_rows(self, search_filter):
+        # Excluded tconsts as a set of local rows per segment
+        excluded = [set() for _ in self.segments]
+        if search_filter is None or not search_filter.exclude_tconsts:
+            return excluded
+        rows, found = self.lookup_rows(search_filter.exclude_tconsts)
+        for row in rows[found].tolist():
+            for i in range(len(self.segments) - 1, -1, -1):
+                if row >= self.offsets[i]:
+                    excluded[i].add(row - self.offsets[i])
+                    break
+        return excluded
+
+    def iter_neighbors(self, query, search_filter=None):
+        # Segments are searched independently and merged by distance
+        excluded = self._excluded_rows(search_filter)
+        streams = [
+            _offset_stream(segment.iter_neighbors(query, segment.allowed_mask(search_filter), segment_excluded), offset)
+            for offset, segment, segment_excluded in zip(self.offsets, self.segments, excluded)
+        ]
+        return heapq.merge(*streams)
+
+    def kneighbors(self, X, n_neighbors=50, batch=False, search_filters=None):
+        """
+        Like NearestNeighbors.kneighbors over the live catalog, optionally
+        with one SearchFilter per query. Single queries take the first page
+        from each segment's genre index top-k, batch=True searches all queries
+        at once with the segments' batch indexes. Returns lists of distance and
+        row arrays, one per query, shorter than n_neighbors only when fewer
+        media pass the filter.
+        """
+        X = np.atleast_2d(np.asarray(X, dtype=np.float64))
+        search_filters = search_filters or [None] * len(X)
+        if batch:
+            hits = [[] for _ in X]
+            # Queries sharing a filter (e.g. the members of a room) share its excluded rows
+            excluded_by_filter = {}
+            for search_filter in search_filters:
+                if id(search_filter) not in excluded_by_filter:
+                    excluded_by_filter[id(search_filter)] = self._excluded_rows(search_filter)
+            excluded = [excluded_by_filter[id(search_filter)] for search_filter in search_filters]
+            for i, (offset, segment) in enumerate(zip(self.offsets, self.segments)):
+                segment_hits = segment.batch_kneighbors(
+                    X, n_neighbors,
+                    [segment.allowed_mask(search_filter) for search_filter in search_filters],
+                    [query_excluded[i] for query_excluded in excluded],
+                )
+                for query_hits, query_segment_hits in zip(hits, segment_hits):
+                    query_hits.extend((distance, offset + row) for distance, row in query_segment_hits)
+            hits = [sorted(query_hits)[:n_neighbors] for query_hits in hits]
+        else:
+            hits = []
+            for query, search_filter in zip(X, search_filters):
+                excluded = self._excluded_rows(search_filter)
+                query_hits = [
+                    (distance, offset + row)
+                    for offset, segment, segment_excluded in zip(self.offsets, self.segments, excluded)
+                    for distance, row in segment.kneighbors(query, n_neighbors, segment.allowed_mask(search_filter), segment_excluded)
+                ]
+                hits.append(sorted(query_hits)[:n_neighbors])
+
+        distances = [np.array([distance for distance, _ in query_hits], dtype=np.float64) for query_hits in hits]
+        indices = [np.array([row for _, row in query_hits], dtype=np.int64) for query_hits in hits]
+        return distances, indices
+
+    def __repr__(self):
+        return f"ModelState(version={self.version}, media={self.n_media()}, genres={len(self.all_genres)})"
+
+def get_model_state():
+    # Requests should call this once and keep using the returned snapshot
+    return _model_state
+
+def swap_model_state(new_state):
+    global _model_state
+    with _model_state_lock:
+        old_state = _model_state
+        _model_state = new_state
+    print(f"Model state swapped: {old_state} -> {new_state}")
+    return old_state
+
+def clear_model_state():
+    return swap_model_state(None)
@@ -0,0 +1,48 @@
+import numpy as np
+
+RANKING_CHUNK = 4096  # Rows read at a time while filling the per genre lists
+
+def build_popularity_rankings(state, size):
+    """
+    Most voted live media of the model state, globally and per genre, as
+    tconst byte arrays. The global order is computed with one sort over the
+    num_votes column, then rows are read in that order until every genre list
+    is full, usually only the first few chunks.
+    Returns (global_ids, genre_ids) where genre_ids is a (genres x size)
+    array padded with empty ids.
+    """
+    rows, votes, ids = [], [], []
+    for offset, segment in zip(state.offsets, state.segments):
+        local = np.arange(len(segment)) if segment.live is None else np.flatnonzero(segment.live)
+        rows.append(offset + local)
+        votes.append(np.asarray(segment.columns["num_votes"])[local])
+        ids.append(np.asarray(segment.media_ids)[local])
+    rows, votes, ids = np.concatenate(rows), np.concatenate(votes), np.concatenate(ids)
+
+    # Most votes first, ties by tconst; media without votes are never popular
+    order = np.lexsort((ids, -votes))
+    order = order[votes[order] > 0]
+    global_ids = ids[order[:size]]
+
+    n_genres = len(state.all_genres)
+    genre_ids = np.zeros((n_genres, size), dtype=ids.dtype)
+    counts = np.zeros(n_genres, dtype=np.int64)
+    for start in range(0, len(order), RANKING_CHUNK):
+        chunk = order[start:start + RANKING_CHUNK]
+        member = state.feature_rows(rows[chunk]) > 0
+        for genre in np.flatnonzero(counts < size):
+            picked = ids[chunk[member[:, genre]]][:size - counts[genre]]
+            genre_ids[genre, counts[genre]:counts[genre] + len(picked)] = picked
+            counts[genre] += len(picked)
+        if np.all(counts >= size):
+            break
+    return global_ids, genre_ids
+
+def decode_rankings(all_genres, global_ids, genre_ids):
+    # Plain lists of str, served directly to requests
+    popular_media = [tconst.decode() for tconst in global_ids.tolist()]
+    popular_by_genre = {
+        genre: [tconst.decode() for tconst in genre_ids[i].tolist() if tconst]
+        for i, genre in enumerate(all_genres)
+    }
+    return popular_media, popular_by_genre
@@ -0,0 +1,89 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_SIZE = int(os.getenv("RECOMMENDATION_CACHE_SIZE", 10000))
+CACHE_TTL = float(os.getenv("RECOMMENDATION_CACHE_TTL", 300))  # seconds
+
+class RecommendationCache:
+    """
+    Bounded LRU cache of recommendation lists with a TTL. Keys are
+    (user_id, model_version, k, filter_key), so retraining (new model
+    version) makes every old entry unreachable, they age out of the LRU.
+    Preference writes call invalidate_user(); a per user generation
+    counter stops a computation that started before the write from
+    storing its stale result afterwards.
+    """
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._user_keys = {}  # user_id -> set of keys
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self, user_id):
+        with self._lock:
+            return self._generations.get(user_id, 0)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, generation):
+        user_id = key[0]
+        with self._lock:
+            if self.max_size <= 0 or self._generations.get(user_id, 0) != generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            self._user_keys.setdefault(user_id, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        del self._entries[key]
+        keys = self._user_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._user_keys[key[0]]
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            for key in self._user_keys.pop(user_id, ()):
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            for user_id in self._user_keys:
+                self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            self._entries.clear()
+            self._user_keys.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+recommendation_cache = RecommendationCache()
+
+def invalidate_user(user_id):
+    recommendation_cache.invalidate_user(user_id)
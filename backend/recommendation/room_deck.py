@@ -0,0 +1,47 @@
+import os
+import threading
+from recommendation.group_recommendation import iter_group_media
+
+ROOM_PAGE_SIZE = int(os.getenv("ROOM_PAGE_SIZE", 20))
+ROOM_PREFETCH = int(os.getenv("ROOM_PREFETCH", 10))  # Extend when fewer media remain ahead of a reader
+ROOM_DECK_MAX = int(os.getenv("ROOM_DECK_MAX", 1000))  # Media dealt per room at most
+
+class RoomDeck:
+    """
+    Recommendations of a room, produced page by page. The first page is
+    computed when the room starts, later pages resume the group's index
+    search only when a member reads close to the end of what was dealt.
+    The deck never holds more than max_size media.
+    """
+    def __init__(self, member_ids, strategy=None, page_size=ROOM_PAGE_SIZE, max_size=ROOM_DECK_MAX):
+        self.page_size = page_size
+        self.max_size = max_size
+        self.media = []
+        self._pages = iter_group_media(member_ids, page_size, strategy)
+        self._exhausted = False
+        self._lock = threading.Lock()
+        self._extend(page_size)
+
+    def _extend(self, size):
+        # Called with the lock held, or from __init__
+        while not self._exhausted and len(self.media) < min(size, self.max_size):
+            page = next(self._pages, None)
+            if page is None:
+                self._exhausted = True
+                break
+            seen = set(self.media)
+            self.media.extend(tconst for tconst in page if tconst not in seen)
+        if len(self.media) >= self.max_size:
+            del self.media[self.max_size:]
+            self._exhausted = True
+            self._pages = None
+
+    def page(self, offset=0, limit=None):
+        """
+        Media [offset, offset + limit) of the deck, limit defaults to one
+        page. Returns (media, has_more).
+        """
+        limit = limit or self.page_size
+        with self._lock:
+            self._extend(offset + limit + ROOM_PREFETCH)
+            return self.media[offset:offset + limit], offset + limit < len(self.media) or not self._exhausted
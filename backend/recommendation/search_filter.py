@@ -0,0 +1,34 @@
+import numpy as np
+
+class SearchFilter:
+    """
+    Constraints applied inside the knn search: tconsts to exclude (usually
+    the ones the user already rated) and catalog predicates. Predicates are
+    turned into boolean row masks once per distinct combination and cached
+    by the model state, exclusions are checked per visited row.
+    """
+    def __init__(self, exclude_tconsts=(), include_adult=True, title_types=None, min_rating=None):
+        self.exclude_tconsts = list(exclude_tconsts)
+        self.include_adult = include_adult
+        self.title_types = sorted(title_types) if title_types else None
+        self.min_rating = float(min_rating) if min_rating else None
+
+    def predicate_key(self):
+        # Filters with the same key share one cached mask
+        return (self.include_adult, tuple(self.title_types) if self.title_types else None, self.min_rating)
+
+    def has_predicates(self):
+        return self.predicate_key() != (True, None, None)
+
+    def predicate_mask(self, columns, size):
+        mask = np.ones(size, dtype=bool)
+        if not self.include_adult:
+            mask &= ~np.asarray(columns["is_adult"], dtype=bool)
+        if self.title_types:
+            mask &= np.isin(np.asarray(columns["title_type"]), np.asarray(self.title_types, dtype=np.bytes_))
+        if self.min_rating is not None:
+            mask &= np.asarray(columns["average_rating"]) >= self.min_rating
+        return mask
+
+    def __repr__(self):
+        return f"SearchFilter(excluded={len(self.exclude_tconsts)}, predicates={self.predicate_key()})"
@@ -0,0 +1,140 @@
+import heapq
+import itertools
+import zlib
+import concurrent.futures
+import numpy as np
+from recommendation.knn_index import KNNIndex
+
+def hash_partition(media_ids, n_shards):
+    # crc32 of the tconst, the same shard in every process and every build
+    return np.fromiter((zlib.crc32(bytes(tconst)) % n_shards for tconst in media_ids), dtype=np.int64, count=len(media_ids))
+
+def range_partition(n_samples, n_shards):
+    # Equal contiguous row ranges (tconst order), every shard is a plain slice of the matrix
+    return np.arange(n_samples) * n_shards // max(n_samples, 1)
+
+def popularity_partition(num_votes, n_shards):
+    # Equal sized tiers by number of votes, shard 0 holds the most voted media
+    order = np.lexsort((np.arange(len(num_votes)), -np.asarray(num_votes, dtype=np.float64)))
+    shards = np.empty(len(order), dtype=np.int64)
+    shards[order] = np.arange(len(order)) * n_shards // max(len(order), 1)
+    return shards
+
+class RowSubset:
+    """
+    Some rows of a shared (memory mapped) matrix seen as a matrix of their
+    own without copying them: indexing gathers only the rows asked for, so a
+    shard index reads the catalog through the page cache like the rest of
+    the process instead of holding a private copy.
+    """
+    ndim = 2
+
+    def __init__(self, matrix, rows):
+        self.matrix = matrix
+        self.rows = rows
+        self.shape = (len(rows),) + tuple(matrix.shape[1:])
+        self.dtype = matrix.dtype
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, key):
+        return self.matrix[self.rows[key]]
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.matrix[self.rows]
+        return values if dtype is None else values.astype(dtype, copy=False)
+
+def shard_rows(media_features, rows):
+    # A view of the shard rows, a slice when they are contiguous
+    if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+        return media_features[rows[0]:rows[-1] + 1]
+    return RowSubset(media_features, rows)
+
+class LocalShard:
+    """
+    One partition of the catalog with its own index over only its rows.
+    search() and stream() answer in global rows, the only interface the
+    scatter-gather layer uses, so a shard can be moved behind a process or
+    network boundary by implementing the same two methods.
+    """
+    def __init__(self, index, rows):
+        self.index = index
+        self.rows = rows  # shard row -> global row
+
+    def __len__(self):
+        return len(self.rows)
+
+    def search(self, X, k):
+        distances, local_rows = self.index.kneighbors(X, n_neighbors=min(k, len(self.rows)))
+        return distances, self.rows[local_rows]
+
+    def stream(self, query):
+        for distance, row in self.index.iter_neighbors(query):
+            yield distance, int(self.rows[row])
+
+class ShardedIndex(KNNIndex):
+    """
+    Genre knn split into n_shards partitions, by tconst hash, by contiguous
+    tconst range or by popularity tier, each indexed with
+    create_index(backend) over its own rows only. Shards see their rows
+    through views of the shared matrix (see shard_rows), not copies. Queries are scattered to every shard in parallel and the
+    per shard top-k lists, already sorted, are heap merged into the global
+    top-k. Results are the same as one index over the whole catalog.
+    kneighbors() serves the first page of single queries, iter_neighbors()
+    only runs past it.
+    """
+    def __init__(self, create_index, n_shards=4, partition="hash", n_neighbors=50, threads=None):
+        self.create_index = create_index
+        self.n_shards = n_shards
+        self.partition = partition
+        self.n_neighbors = n_neighbors
+        self.threads = threads or n_shards
+        self.shards = []
+        self._pool = None
+
+    def fit(self, media_features, media_ids=None, num_votes=None):
+        self.n_samples = len(media_features)
+        if self.partition == "popularity" and num_votes is not None:
+            assignment = popularity_partition(num_votes, self.n_shards)
+        elif self.partition == "range":
+            assignment = range_partition(self.n_samples, self.n_shards)
+        elif media_ids is not None:
+            assignment = hash_partition(media_ids, self.n_shards)
+        else:
+            assignment = np.arange(self.n_samples) % self.n_shards
+        self.shards = []
+        for shard in range(self.n_shards):
+            rows = np.flatnonzero(assignment == shard)
+            if len(rows) == 0:
+                continue
+            index = self.create_index(self.n_neighbors).fit(shard_rows(media_features, rows))
+            self.shards.append(LocalShard(index, rows))
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=min(self.threads, max(len(self.shards), 1)))
+        print(f"Sharded index: {len(self.shards)} {self.partition} shards, sizes {[len(shard) for shard in self.shards]}")
+        return self
+
+    def _scatter(self, call):
+        # BLAS and the numpy kernels release the GIL, shards run side by side
+        if len(self.shards) == 1:
+            return [call(self.shards[0])]
+        return list(self._pool.map(call, self.shards))
+
+    def kneighbors(self, X, n_neighbors=None):
+        X = np.atleast_2d(np.asarray(X, dtype=np.float64))
+        k = min(n_neighbors or self.n_neighbors, self.n_samples)
+        results = self._scatter(lambda shard: shard.search(X, k))
+        distances = np.zeros((len(X), k), dtype=np.float64)
+        indices = np.zeros((len(X), k), dtype=np.int64)
+        for i in range(len(X)):
+            # Every shard list is sorted by (distance, row), merge the k first
+            merged = heapq.merge(*(zip(shard_distances[i].tolist(), shard_rows[i].tolist())
+                                   for shard_distances, shard_rows in results))
+            for j, (distance, row) in enumerate(itertools.islice(merged, k)):
+                distances[i, j] = distance
+                indices[i, j] = row
+        return distances, indices
+
+    def iter_neighbors(self, query):
+        # Lazy merge of the shard streams, a shard is only read as far as needed
+        return heapq.merge(*(shard.stream(query) for shard in self.shards))
@@ -0,0 +1,90 @@
+import heapq
+import numpy as np
+from recommendation.knn_index import KNNIndex
+
+class SignatureKNN(KNNIndex):
+    """
+    Exact euclidean knn for rows of the form signature * weight, where the
+    signature is a binary genre vector and weight the popularity scalar.
+
+    Media sharing a signature s form a group whose weights are kept sorted.
+    For a query q the squared distance to s * w is
+        |q|^2 - 2 * w * (s.q) + w^2 * |s|
+    a parabola in w with its minimum at w* = (s.q) / |s|, so inside a group
+    the nearest media are found by a binary search for w* and walking left
+    and right from there. A heap merges those walks across groups, a query
+    costs O(groups * log n + k * log groups) instead of O(n * genres).
+    """
+    def __init__(self, n_neighbors=50):
+        self.n_neighbors = n_neighbors
+
+    def fit(self, media_features):
+        media_features = np.asarray(media_features)
+        self.n_samples = len(media_features)
+        signatures = media_features > 0
+        # All non zero entries of a row hold the same weight
+        weights = media_features.max(axis=1, initial=0).astype(np.float32)
+
+        packed = np.packbits(signatures, axis=1)
+        unique_packed, groups = np.unique(packed, axis=0, return_inverse=True)
+        groups = groups.reshape(-1)
+        rows = np.arange(self.n_samples)
+        order = np.lexsort((rows, weights, groups))
+
+        self.sorted_rows = order.astype(np.int32 if self.n_samples < 2**31 else np.int64)
+        self.sorted_weights = weights[order]
+        counts = np.bincount(groups, minlength=len(unique_packed))
+        self.group_end = np.cumsum(counts)
+        self.group_start = self.group_end - counts
+        self.signatures = np.unpackbits(unique_packed, axis=1, count=media_features.shape[1]).astype(np.float64)
+        self.signature_sizes = self.signatures.sum(axis=1)
+        print(f"SignatureKNN fitted: {self.n_samples} media in {len(self.signatures)} genre signatures")
+        return self
+
+    def _lower_bounds(self, targets):
+        # Vectorized binary search, first position in each group with weight >= target
+        lo = self.group_start.copy()
+        hi = self.group_end.copy()
+        active = lo < hi
+        while active.any():
+            mid = (lo + hi) // 2
+            below = np.zeros(len(lo), dtype=bool)
+            below[active] = self.sorted_weights[mid[active]] < targets[active]
+            lo = np.where(active & below, mid + 1, lo)
+            hi = np.where(active & ~below, mid, hi)
+            active = lo < hi
+        return lo
+
+    def iter_neighbors(self, query):
+        query = np.asarray(query, dtype=np.float64)
+        if self.n_samples == 0:
+            return
+        query_norm = float(query @ query)
+        dots = self.signatures @ query
+        sizes = self.signature_sizes
+        targets = np.divide(dots, sizes, out=np.zeros_like(dots), where=sizes > 0)
+        split = self._lower_bounds(targets)
+
+        def distance2(position, group):
+            w = float(self.sorted_weights[position])
+            return max(query_norm - 2 * w * dots[group] + w * w * sizes[group], 0.0)
+
+        # One walker per group and direction: (distance^2, row, position, step, group)
+        heap = []
+        group_ids = np.arange(len(self.signatures))
+        for positions, step, valid in (
+            (split, 1, split < self.group_end),
+            (split - 1, -1, split > self.group_start),
+        ):
+            positions, groups = positions[valid], group_ids[valid]
+            w = self.sorted_weights[positions].astype(np.float64)
+            dist2 = np.maximum(query_norm - 2 * w * dots[groups] + w * w * sizes[groups], 0.0)
+            heap.extend(zip(dist2.tolist(), self.sorted_rows[positions].tolist(), positions.tolist(), [step] * len(groups), groups.tolist()))
+        heapq.heapify(heap)
+
+        while heap:
+            dist2, row, position, step, group = heapq.heappop(heap)
+            yield np.sqrt(dist2), row
+            position += step
+            if self.group_start[group] <= position < self.group_end[group]:
+                heapq.heappush(heap, (distance2(position, group), int(self.sorted_rows[position]), position, step, group))
@@ -0,0 +1,65 @@
+import threading
+import time
+import traceback
+
+# Phases of the background startup, in order
+PHASES = ["starting", "loading_media", "loading_reviews", "loading_creators", "training", "updating", "self_test", "ready"]
+
+_status = {
+    "phase": "starting",
+    "progress": None,  # {"done": n, "total": m} inside a phase when it is known
+    "started_at": time.time(),
+    "phase_started_at": time.time(),
+    "ready_at": None,
+    "error": None,
+}
+_status_lock = threading.Lock()
+
+def set_phase(phase):
+    with _status_lock:
+        _status["phase"] = phase
+        _status["progress"] = None
+        _status["phase_started_at"] = time.time()
+        if phase == "ready":
+            _status["ready_at"] = time.time()
+    print(f"Startup phase: {phase}")
+
+def set_progress(done, total=None):
+    with _status_lock:
+        _status["progress"] = {"done": done, "total": total}
+
+def set_error(error):
+    with _status_lock:
+        _status["error"] = error
+
+def get_status():
+    with _status_lock:
+        status = dict(_status)
+    now = time.time()
+    status["ready"] = status["phase"] == "ready"
+    status["uptime"] = round(now - status["started_at"], 1)
+    status["phase_elapsed"] = round(now - status["phase_started_at"], 1)
+    status["step"] = PHASES.index(status["phase"]) if status["phase"] in PHASES else None
+    status["steps"] = len(PHASES) - 1
+    return status
+
+def start_background(steps):
+    """
+    Runs [(phase, function), ...] in a daemon thread so the server can accept
+    requests while the database is loaded and the model trained. A failing
+    step is reported through get_status() and stops the sequence.
+    """
+    def run():
+        for phase, step in steps:
+            set_phase(phase)
+            try:
+                step()
+            except Exception as e:
+                traceback.print_exc()
+                set_error(f"{phase}: {e}")
+                return
+        set_phase("ready")
+
+    worker = threading.Thread(target=run, name="startup", daemon=True)
+    worker.start()
+    return worker
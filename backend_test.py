@@ -2,9 +2,10 @@ import requests
 import socketio
 import time
 import sys
+import os
 from colorama import Fore, Style, Back
 import threading
-from collections import Counter
+from collections import Counter, namedtuple
 import numpy as np
 import math
 
@@ -159,6 +160,337 @@ def connect_user_socket(user: User, base_url: str):
         if user.sio.connected:
             user.sio.disconnect()
 
+# Unit tests of the recommendation engine, run with pytest from the repository root.
+# They import the backend modules directly and run on a synthetic catalog, no server needed.
+# The bulk load tests need a disposable Postgres in TEST_DATABASE_URL and are skipped without it.
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend")
+CATALOG_GENRES = ["Action", "Comedy", "Drama", "Horror", "Romance", "Thriller"]
+CatalogMedia = namedtuple("CatalogMedia", "tconst titleType isAdult genres averageRating numVotes")
+Preference = namedtuple("Preference", "user_id media_id rating")
+
+def import_backend():
+    # The db modules create their engines on import, no query runs against this url
+    os.environ.setdefault("DATABASE_URL", "sqlite://")
+    if BACKEND_DIR not in sys.path:
+        sys.path.insert(0, BACKEND_DIR)
+
+def make_catalog(size=2000, seed=7):
+    rng = np.random.default_rng(seed)
+    catalog = {}
+    for i in range(size):
+        tconst = f"tt{i:07d}"
+        genres = sorted(rng.choice(CATALOG_GENRES, size=int(rng.integers(1, 4)), replace=False).tolist())
+        catalog[tconst] = CatalogMedia(tconst, str(rng.choice(["movie", "short", "tvSeries"])), bool(rng.random() < 0.1),
+                                       genres, round(float(rng.uniform(1, 10)), 1), int(rng.integers(0, 20000)))
+    return catalog
+
+def sample_queries(media_features, n_queries=40, seed=3):
+    import_backend()
+    from recommendation.index_backends import sample_profiles
+    return sample_profiles(media_features, n_queries, seed)
+
+def sklearn_neighbors(media_features, queries, k):
+    from sklearn.neighbors import NearestNeighbors
+    return NearestNeighbors(n_neighbors=k, metric="euclidean").fit(media_features).kneighbors(queries)
+
+class FakeCatalog:
+    # Stands in for the db.media queries the feature store is built from
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def media(self):
+        import db.media
+        return [media for tconst, media in sorted(self.catalog.items()) if db.media.is_catalog_media(media)]
+
+    def get_all_genres(self):
+        return {genre for media in self.catalog.values() for genre in media.genres}
+
+    def count_catalog_media(self, min_num_votes=0):
+        return len(self.media())
+
+    def iter_catalog_media(self, batch_size=10000, min_num_votes=0, details=False):
+        media = self.media()
+        for start in range(0, len(media), batch_size):
+            yield media[start:start + batch_size]
+
+    def get_media_features_by_tconsts(self, tconsts, details=False, batch_size=10000):
+        return [self.catalog[tconst] for tconst in tconsts if tconst in self.catalog]
+
+def catalog_model(monkeypatch, tmp_path, catalog):
+    """
+    Points the feature store at tmp_path and db.media at catalog. Returns the
+    knn_recommendation module with no model state served yet.
+    """
+    import_backend()
+    import db.media
+    import recommendation.feature_store as feature_store
+    import recommendation.index_backends as index_backends
+    import recommendation.knn_recommendation as knn_recommendation
+    from recommendation.model_state import clear_model_state
+    from recommendation.recommendation_cache import recommendation_cache
+
+    fake = FakeCatalog(catalog)
+    for name in ("get_all_genres", "count_catalog_media", "iter_catalog_media", "get_media_features_by_tconsts"):
+        monkeypatch.setattr(db.media, name, getattr(fake, name))
+    monkeypatch.setattr(feature_store, "STORE_DIR", str(tmp_path / "genre_store"))
+    monkeypatch.setattr(index_backends, "KNN_BENCHMARK_QUERIES", 0)
+    monkeypatch.setattr(knn_recommendation, "RECOMMENDATION_ENGINE", "genre")
+    monkeypatch.setattr(knn_recommendation, "PAGE_SIZE", 700)
+    clear_model_state()
+    recommendation_cache.clear()
+    return knn_recommendation
+
+def neighbor_media(state, queries, k, **kwargs):
+    distances, rows = state.kneighbors(queries, n_neighbors=k, **kwargs)
+    return distances, [[state.media_id(row) for row in query_rows.tolist()] for query_rows in rows]
+
+def test_exact_knn_indexes_match_sklearn():
+    import_backend()
+    from recommendation.knn_recommendation import build_feature_rows
+    from recommendation.signature_knn import SignatureKNN
+    from recommendation.brute_force_knn import BruteForceKNN
+    from recommendation.index_backends import SklearnKNN
+    from recommendation.sharded_index import ShardedIndex
+
+    catalog = make_catalog()
+    genre_index = {genre: i for i, genre in enumerate(CATALOG_GENRES)}
+    media_features, media_ids, columns = build_feature_rows(list(catalog.values()), genre_index)
+    queries = sample_queries(media_features)
+    k = 25
+    expected, _ = sklearn_neighbors(media_features, queries, k)
+
+    indexes = {
+        "signature": SignatureKNN(k).fit(media_features),
+        "brute": BruteForceKNN(k).fit(media_features),
+    }
+    for partition in ("hash", "range", "popularity"):
+        for name, create_index in (("signature", SignatureKNN), ("brute", BruteForceKNN), ("sklearn", SklearnKNN)):
+            index = ShardedIndex(create_index, 3, partition, k, threads=1)
+            indexes[f"{name} sharded by {partition}"] = index.fit(media_features, media_ids, columns["num_votes"])
+
+    for name, index in indexes.items():
+        distances, rows = index.kneighbors(queries, n_neighbors=k)
+        # Ties make the rows ambiguous, the distances are not
+        assert np.allclose(distances, expected, atol=1e-4), name
+        for query, query_rows, query_distances in zip(queries, rows, distances):
+            recomputed = np.sqrt(((np.asarray(media_features[query_rows], dtype=np.float64) - query) ** 2).sum(axis=1))
+            assert np.allclose(recomputed, query_distances, atol=1e-4), name
+        # The stream keeps going past the first page in the same order
+        stream = [distance for _, (distance, _) in zip(range(2 * k), index.iter_neighbors(queries[0]))]
+        assert np.allclose(stream, sklearn_neighbors(media_features, queries[:1], 2 * k)[0][0], atol=1e-4), name
+
+def test_update_knns_matches_full_rebuild(monkeypatch, tmp_path):
+    catalog = make_catalog()
+    knn_recommendation = catalog_model(monkeypatch, tmp_path, catalog)
+    state = knn_recommendation.train_knns()
+    queries = sample_queries(np.asarray(state.base.media_features))
+
+    # Changed votes and genres, removed media, media leaving the catalog and new media
+    changed = [f"tt{i:07d}" for i in range(0, 60, 3)]
+    for tconst in changed[:10]:
+        media = catalog[tconst]
+        catalog[tconst] = media._replace(numVotes=media.numVotes * 3 + 11, genres=list(reversed(CATALOG_GENRES[:2])))
+    for tconst in changed[10:15]:
+        del catalog[tconst]
+    for tconst in changed[15:]:
+        catalog[tconst] = catalog[tconst]._replace(titleType="tvEpisode")
+    added = [f"tt9{i:06d}" for i in range(5)]
+    for i, tconst in enumerate(added):
+        catalog[tconst] = CatalogMedia(tconst, "movie", False, CATALOG_GENRES[i:i + 2], 7.5, 50000 + i)
+
+    updated = knn_recommendation.update_knns(changed + added)
+    assert updated.base_version == state.base_version and updated.version != state.version
+    assert len(updated.delta) == 15 and updated.base.live is not None and (~updated.base.live).sum() == 20
+
+    rebuilt = knn_recommendation.train_knns(rebuild=True)
+    assert rebuilt.n_media() == updated.n_media() == len(FakeCatalog(catalog).media())
+    gone = set(changed[10:])
+    for batch in (False, True):
+        expected_distances, expected_media = neighbor_media(rebuilt, queries, 30, batch=batch)
+        distances, media = neighbor_media(updated, queries, 30, batch=batch)
+        for query_distances, query_media, query_expected_distances, query_expected_media in zip(
+                distances, media, expected_distances, expected_media):
+            assert np.allclose(query_distances, query_expected_distances, atol=1e-4)
+            assert not gone & set(query_media)
+            # Rows strictly closer than the last distance are not ties at the cut
+            closer = query_distances < query_distances[-1] - 1e-4
+            assert set(np.array(query_media)[closer]) == set(np.array(query_expected_media)[closer])
+
+    # Tombstoned rows are not served by lookups either
+    rows, found = updated.lookup_rows(sorted(gone))
+    assert not found.any()
+
+def test_search_filter_masks(monkeypatch, tmp_path):
+    catalog = make_catalog()
+    knn_recommendation = catalog_model(monkeypatch, tmp_path, catalog)
+    from recommendation.search_filter import SearchFilter
+    state = knn_recommendation.train_knns()
+    media = FakeCatalog(catalog).media()
+    queries = sample_queries(np.asarray(state.base.media_features), 10)
+    excluded = [m.tconst for m in media[:300:2]]
+
+    for predicates in ({}, {"include_adult": False}, {"title_types": ["short", "movie"]}, {"min_rating": 6.5},
+                       {"include_adult": False, "title_types": ["tvSeries"], "min_rating": 4}):
+        def allowed(m):
+            return ((predicates.get("include_adult", True) or not m.isAdult)
+                    and m.titleType in predicates.get("title_types", [m.titleType])
+                    and m.averageRating >= predicates.get("min_rating", 0))
+        search_filter = SearchFilter(exclude_tconsts=excluded, **predicates)
+        mask = state.base.allowed_mask(search_filter)
+        expected = np.array([allowed(m) for m in media])
+        assert np.array_equal(expected, np.ones(len(media), dtype=bool) if mask is None else mask)
+        # Same predicates share the cached mask
+        assert mask is state.base.allowed_mask(SearchFilter(**predicates))
+
+        passing = {m.tconst for m in media if allowed(m)} - set(excluded)
+        for batch in (False, True):
+            distances, hits = neighbor_media(state, queries, 40, batch=batch, search_filters=[search_filter] * len(queries))
+            for query_hits in hits:
+                assert len(query_hits) == min(40, len(passing)) and set(query_hits) <= passing
+
+def test_popularity_rankings(monkeypatch, tmp_path):
+    catalog = make_catalog()
+    knn_recommendation = catalog_model(monkeypatch, tmp_path, catalog)
+    monkeypatch.setattr(knn_recommendation, "POPULAR_LIST_SIZE", 50)
+    knn_recommendation.train_knns()
+
+    def ranking(media):
+        # Most votes first, ties by tconst, media without votes are left out
+        return [m.tconst for m in sorted(media, key=lambda m: (-m.numVotes, m.tconst)) if m.numVotes > 0][:50]
+
+    media = FakeCatalog(catalog).media()
+    assert knn_recommendation.recommend_popular_media(50)[0] == ranking(media)
+    assert knn_recommendation.recommend_popular_media(10)[0] == ranking(media)[:10]
+    for genre in CATALOG_GENRES:
+        assert knn_recommendation.recommend_popular_media(50, genre)[0] == ranking([m for m in media if genre in m.genres])
+
+    # Rankings follow the delta: a removed top media drops out, a new one with the most votes leads
+    top = ranking(media)[0]
+    del catalog[top]
+    catalog["tt9000000"] = CatalogMedia("tt9000000", "movie", False, ["Drama"], 8.0, 10 ** 6)
+    knn_recommendation.update_knns([top, "tt9000000"])
+    assert knn_recommendation.recommend_popular_media(50)[0] == ranking(FakeCatalog(catalog).media())
+
+def test_recommendation_cache_generations():
+    import_backend()
+    from recommendation.recommendation_cache import RecommendationCache
+
+    cache = RecommendationCache(max_size=3, ttl=60)
+    key, other_key = (1, 100, 10, ()), (2, 100, 10, ())
+    cache.put(key, ["tt0000001"], cache.generation(1))
+    cache.put(other_key, ["tt0000002"], cache.generation(2))
+    assert cache.get(key) == ["tt0000001"]
+
+    # A computation that started before the write must not store its stale result
+    generation = cache.generation(1)
+    cache.invalidate_user(1)
+    assert cache.get(key) is None and cache.get(other_key) == ["tt0000002"]
+    cache.put(key, ["stale"], generation)
+    assert cache.get(key) is None
+    cache.put(key, ["fresh"], cache.generation(1))
+    assert cache.get(key) == ["fresh"]
+
+    generation = cache.generation(2)
+    cache.clear()
+    cache.put(other_key, ["stale"], generation)
+    assert cache.get(key) is None and cache.get(other_key) is None
+
+    # Bounded LRU, the least recently used entry leaves first
+    for user_id in range(3, 7):
+        cache.put((user_id, 100, 10, ()), [user_id], cache.generation(user_id))
+    assert cache.get((3, 100, 10, ())) is None and cache.get((6, 100, 10, ())) == [6]
+    assert cache.stats()["entries"] == 3
+
+def bulk_load_table(monkeypatch):
+    """
+    db.bulk_load pointed at TEST_DATABASE_URL with a fresh ratings table.
+    Returns (bulk_load module, table name, engine), skips without a database.
+    """
+    import pytest
+    url = os.getenv("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    import_backend()
+    from sqlalchemy import create_engine
+    import db.bulk_load as bulk_load
+
+    engine = create_engine(url)
+    monkeypatch.setattr(bulk_load, "engine", engine)
+    table = "bulk_load_test_ratings"
+    connection = engine.raw_connection()
+    cursor = connection.cursor()
+    cursor.execute(f"DROP TABLE IF EXISTS {table}")
+    cursor.execute(f'CREATE TABLE {table} (tconst varchar PRIMARY KEY, "averageRating" float, "numVotes" integer, genres varchar[])')
+    connection.commit()
+    connection.close()
+    return bulk_load, table, engine
+
+def table_rows(engine, table):
+    connection = engine.raw_connection()
+    cursor = connection.cursor()
+    cursor.execute(f'SELECT tconst, "averageRating", "numVotes", genres FROM {table} ORDER BY tconst')
+    rows = cursor.fetchall()
+    cursor.execute("SELECT to_regclass(%s), to_regclass(%s)", (f"{table}_staging", f"{table}_shared_staging"))
+    staging_tables = cursor.fetchone()
+    connection.close()
+    return rows, staging_tables
+
+def test_staged_loader_sql(monkeypatch):
+    bulk_load, table, engine = bulk_load_table(monkeypatch)
+    columns = ["tconst", "averageRating", "numVotes", "genres"]
+    loader = bulk_load.StagedLoader(table, columns, [bulk_load.insert_statement(table, columns, ["tconst"])])
+    loader.load([("tt0000001", 7.5, 10, ["Drama", "Comedy"]), ("tt0000002", None, 3, ['Sci "Fi"', "A,B"])])
+    # Keys already stored or repeated in the batch are skipped
+    loader.load([("tt0000001", 1.0, 1, []), ("tt0000003", 5.0, 0, None), ("tt0000003", 6.0, 0, None)])
+    assert loader.finish() is None and loader.rows == 5 and loader.affected == [3]
+
+    rows, staging_tables = table_rows(engine, table)
+    assert [row[:3] for row in rows] == [("tt0000001", 7.5, 10), ("tt0000002", None, 3), ("tt0000003", 5.0, 0)]
+    assert rows[0][3] == ["Drama", "Comedy"] and rows[1][3] == ['Sci "Fi"', "A,B"] and rows[2][3] is None
+    assert staging_tables == (None, None)
+
+    # Without batch statements the rows wait for final_statement in finish()
+    loader = bulk_load.StagedLoader(table, columns, final_statement=bulk_load.insert_statement(table, columns, ["tconst"]))
+    loader.load([("tt0000004", 8.0, 5, ["Horror"])])
+    assert table_rows(engine, table)[0][-1][0] == "tt0000003"
+    loader.finish()
+    assert table_rows(engine, table)[0][-1][0] == "tt0000004"
+
+def test_shared_staging_sql(monkeypatch):
+    bulk_load, table, engine = bulk_load_table(monkeypatch)
+    columns = ["tconst", "averageRating", "numVotes", "genres"]
+    loader = bulk_load.StagedLoader(table, columns, [bulk_load.insert_statement(table, columns)])
+    loader.load([(f"tt{i:07d}", 5.0, i, ["Drama"]) for i in range(6)])
+    loader.finish()
+
+    review_columns = ["tconst", "averageRating", "numVotes"]
+    staging = bulk_load.SharedStaging(table, review_columns, bulk_load.update_statement(table, "tconst", review_columns[1:]))
+    loaders = [staging.loader() for _ in range(2)]
+    loaders[0].load([("tt0000000", 5.0, 0), ("tt0000001", 6.0, 1)])
+    loaders[1].load([("tt0000002", 5.0, 20), ("tt0000009", 9.0, 9)])
+    for shared_loader in loaders:
+        shared_loader.finish()
+    # Nothing is applied before apply(), which returns the keys whose values changed
+    assert table_rows(engine, table)[0][1][1] == 5.0
+    assert sorted(tconst for (tconst,) in staging.apply()) == ["tt0000001", "tt0000002"]
+
+    rows, staging_tables = table_rows(engine, table)
+    assert [row[:3] for row in rows] == [("tt0000000", 5.0, 0), ("tt0000001", 6.0, 1), ("tt0000002", 5.0, 20),
+                                         ("tt0000003", 5.0, 3), ("tt0000004", 5.0, 4), ("tt0000005", 5.0, 5)]
+    assert staging_tables == (None, None)
+
+    # A failed statement leaves the table as it was, the staging table is recreated on the next load
+    import pytest
+    staging = bulk_load.SharedStaging(table, review_columns, "UPDATE {staging} SET missing_column = 1")
+    loader = staging.loader()
+    loader.load([("tt0000000", 1.0, 1)])
+    loader.finish()
+    with pytest.raises(Exception, match="missing_column"):
+        staging.apply()
+    staging.drop()
+    assert table_rows(engine, table) == (rows, (None, None))
+
 if __name__ == "__main__":
     
     BASE_URL = sys.argv[1] if len(sys.argv) > 1 else None
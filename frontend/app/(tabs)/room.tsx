@@ -13,6 +13,9 @@ import {
 import { createRoom, joinRoom, getRecommendations, getMovieDetails } from "../../lib/functions";
 import { get } from "react-native/Libraries/TurboModule/TurboModuleRegistry";
 
+const PAGE_SIZE = 20; // Recommendations fetched per request
+const PREFETCH_REMAINING = 5; // Fetch the next page when this few are left
+
 export default function Room() {
   const [roomCode, setRoomCode] = useState("");
   const [roomId, setRoomId] = useState("");
@@ -22,6 +25,8 @@ export default function Room() {
   const [currentMovie, setCurrentMovie] = useState<any>(null);
   const [roomActive, setRoomActive] = useState(false);
   const [finalMovie, setFinalMovie] = useState<any>(null);
+  const [hasMore, setHasMore] = useState(true);
+  const loadingMoreRef = useRef(false);
 
   const roomIdRef = useRef(roomId);
   useEffect(() => {
@@ -116,6 +121,25 @@ export default function Room() {
     }
   }, [recommendations, currentIndex]);
 
+  // Load the next page of the deck when getting close to its end
+  useEffect(() => {
+    const loadMore = async () => {
+      if (!roomActive || !hasMore || loadingMoreRef.current || !roomIdRef.current) return;
+      if (recommendations.length === 0 || recommendations.length - currentIndex > PREFETCH_REMAINING) return;
+      loadingMoreRef.current = true;
+      try {
+        const res = await getRecommendations(roomIdRef.current, recommendations.length, PAGE_SIZE);
+        if (res.success) {
+          setRecommendations((prev) => [...prev, ...res.recommendations]);
+          setHasMore(Boolean(res.hasMore) && res.recommendations.length > 0);
+        } else console.error("Failed to get more recommendations:", res.message);
+      } finally {
+        loadingMoreRef.current = false;
+      }
+    };
+    loadMore();
+  }, [currentIndex, recommendations, hasMore, roomActive]);
+
   const fetchMovie = async (tconst: string) => {
     try {
       const res = await getMovieDetails(tconst);
@@ -163,10 +187,11 @@ export default function Room() {
   const handleStartRoom = async (currentRoomId: string) => {
     console.log("Handling room start for room ID:", currentRoomId);
     if (currentRoomId) {
-      const res = await getRecommendations(currentRoomId);
+      const res = await getRecommendations(currentRoomId, 0, PAGE_SIZE);
       console.log("Recommendations fetched:", res);
       if (res.success) {
         setRecommendations(res.recommendations);
+        setHasMore(Boolean(res.hasMore));
         setCurrentIndex(0);
         fetchMovie(res.recommendations[0]);  
       } else console.error("Failed to get recommendations:", res.message);
@@ -190,6 +215,7 @@ export default function Room() {
     setRoomId("");
     setIsCreator(false);
     setRecommendations([]);
+    setHasMore(true);
     setCurrentIndex(0);
     setRoomActive(false);
     setCurrentMovie(null);
@@ -122,7 +122,7 @@ export async function joinRoom(roomId: string) {
 
 // ---------- RECOMMENDATIONS ----------
 
-export async function getRecommendations(roomId: string) {
+export async function getRecommendations(roomId: string, offset = 0, limit = 20) {
   try {
     const jwt = await AsyncStorage.getItem("jwt");
     if (!jwt) return { success: false, message: "Not logged in." };
@@ -130,12 +130,16 @@ export async function getRecommendations(roomId: string) {
     const response = await fetch(API_URL + "rooms/recommendations", {
       method: "POST",
       headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ jwt, room_id: roomId }),
+      body: JSON.stringify({ jwt, room_id: roomId, offset, limit }),
     });
 
     const data = await response.json();
     if (response.ok) {
-      return { success: true, recommendations: data.recommended_media || [] };
+      return {
+        success: true,
+        recommendations: data.recommended_media || [],
+        hasMore: Boolean(data.has_more),
+      };
     } else {
       return { success: false, message: data.message };
     }